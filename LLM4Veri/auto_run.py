@@ -7,6 +7,7 @@ import concurrent.futures
 import pickle
 import re
 import json
+import time
 from datetime import timedelta
 from collections import OrderedDict
 from tqdm import tqdm
@@ -20,6 +21,9 @@ sys.path.append(ROOT_DIR)
 # Import the configuration manager
 try:
     from LLM4Veri.src.config_manager import ConfigLoader, ModelConfig
+    from LLM4Veri.src.framac_cache import get_framac_cache_stats
+    from utils.llm_cache import get_llm_cache_stats
+    from LLM4Veri.src.veri_daemon import ensure_verification_daemon
 except ImportError:
     print("FATAL: Unable to import ConfigLoader. Please check the path of LLM4Veri/src/config_manager.py.")
     sys.exit(1)
@@ -52,12 +56,18 @@ def extract_metrics_from_pickle(pickle_file_path: str) -> Dict[str, Any]:
         # Extract time metrics (convert to seconds)
         llms_query_times = data.get('llms_query_times', timedelta(0)).total_seconds()
         total_solve_time = data.get('total_solve_time', timedelta(0)).total_seconds()
+        # Resources of the frama-c runs (solvers included), used to size the worker pools
+        resource_usage = data.get('resource_usage', {})
+        # Prompt + completion tokens of all the LLM queries of the file
+        tokens_usage = data.get('tokens_usage', 0)
         
         # Return the original status code (0 or 1)
         return {
             "Status": status, 
             "llm_time_sec": llms_query_times,
             "total_solve_time_sec": total_solve_time,
+            "resource_usage": resource_usage,
+            "tokens_usage": tokens_usage,
         }
 
     except Exception as e:
@@ -109,12 +119,14 @@ def run_single_model_experiment(model_name: str, model_config: ModelConfig, dupl
         
         try:
             # Execute the command
+            # Batch runs give way to interactive main.py runs in the verification daemon
             result = subprocess.run(
                 command, 
                 check=False, 
                 capture_output=True, 
                 text=True, 
                 encoding='utf-8',
+                env=dict(os.environ, AUTOSPEC_JOB_PRIORITY="batch"),
                 timeout=300 # Set a total timeout
             )
             
@@ -132,6 +144,8 @@ def run_single_model_experiment(model_name: str, model_config: ModelConfig, dupl
                         "Status": metrics["Status"],
                         "llm_time_sec": metrics["llm_time_sec"],
                         "total_solve_time_sec": metrics["total_solve_time_sec"],
+                        "resource_usage": metrics["resource_usage"],
+                        "tokens_usage": metrics["tokens_usage"],
                     })
                     # Successfully updated, clear the default error message
                     if 'error' in file_result:
@@ -188,8 +202,18 @@ def save_results_to_jsonl(final_results: List[Dict[str, Any]], original_input_di
             ('Status', result.get('Status', 'N/A')), 
             ('llm_time_sec', result.get('llm_time_sec', 0.0)),
             ('total_solve_time_sec', result.get('total_solve_time_sec', 0.0)),
+            ('tokens_usage', result.get('tokens_usage', 0)),
         ])
         
+        # Resource usage of the frama-c runs, next to total_solve_time_sec
+        resource_usage = result.get('resource_usage', {})
+        final_record['framac_runs'] = resource_usage.get('runs', 0)
+        final_record['cpu_user_sec'] = round(resource_usage.get('user_time', 0.0), 3)
+        final_record['cpu_sys_sec'] = round(resource_usage.get('sys_time', 0.0), 3)
+        final_record['max_rss_mb'] = round(resource_usage.get('max_rss_mb', 0.0), 1)
+        final_record['solver_processes'] = resource_usage.get('solver_processes', 0)
+        final_record['limit_kills'] = resource_usage.get('limit_kills', 0)
+        
         # Add optional error field
         if 'error' in result:
              final_record['error'] = result['error']
@@ -289,6 +313,15 @@ def main():
     # 3. Stage III: Concurrent scheduling
     results_futures: List[concurrent.futures.Future] = []
     MAX_WORKERS = len(copied_dirs)
+
+    # One LLM ledger per campaign: the token budgets (AUTOSPEC_LLM_*_TOKEN_BUDGET) count the calls of this run only
+    campaign_ledger = os.path.join(ROOT_DIR, 'experiment_results', f"llm_ledger_{os.path.basename(original_input_dir)}_{time.strftime('%Y%m%d_%H%M%S')}.jsonl")
+    os.environ.setdefault("AUTOSPEC_LLM_LEDGER", campaign_ledger)
+    print(f"--- 🧾 LLM ledger: {os.environ['AUTOSPEC_LLM_LEDGER']} ---")
+
+    # All the frama-c runs of all the models are admitted by one verification daemon
+    if ensure_verification_daemon():
+        print("--- 🚦 Verification daemon is admitting the frama-c runs ---")
     
     print(f"\n--- 🚀 Starting {MAX_WORKERS} concurrent tasks (Total {TOTAL_TASKS} file executions) ---")
     
@@ -321,6 +354,8 @@ def main():
             # Save final results to JSONL file
             ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) # Reconfirm the root directory
             save_results_to_jsonl(final_results, original_input_dir, ROOT_DIR)
+            print(f"\n--- 🗃️  Frama-C result cache: {get_framac_cache_stats().get('total', {})} ---")
+            print(f"--- 🗃️  LLM response cache ({get_llm_cache_stats()['mode']}): {get_llm_cache_stats().get('total', {})} ---")
 
     except Exception as e:
         print(f"❌ Experiment run exception: {e}")
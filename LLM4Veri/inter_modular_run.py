@@ -6,6 +6,8 @@ import subprocess
 import shutil
 import glob
 
+from src.wp_cache import get_wp_cache_args, get_wp_cache_env
+
 # ==========================================
 # Module 1: File Manager (FileManager)
 # Responsible for merging multiple files into a single context-complete temporary file,
@@ -390,8 +392,8 @@ def main():
         main_c = next((f for f in input_files if f.endswith('main.c')), None)
         if main_c and shutil.which("frama-c"):
             print(f"Attempting to verify main entry: {main_c}")
-            cmd = ["frama-c", "-wp"] + input_files
-            subprocess.run(cmd)
+            cmd = ["frama-c", "-wp"] + get_wp_cache_args() + input_files
+            subprocess.run(cmd, env=get_wp_cache_env())
 
     finally:
         # Cleanup
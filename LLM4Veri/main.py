@@ -80,6 +80,9 @@ def main(argv: List[str]) -> None:
             tokens_usage = tokens_usage + cur_tokens_usage
             if ret == True:
                 break
+            if is_llm_budget_exhausted(os.path.abspath(gpt_file)):
+                print("token budget exhausted:", format_llm_ledger_totals(os.path.abspath(gpt_file)))
+                break
         except Exception as e:
             print(e)
             raise e
@@ -87,6 +90,10 @@ def main(argv: List[str]) -> None:
     print("llms_query_times =", llms_query_times)
     print("total_solve_time =", total_solve_time)
     print("tokens_usage =", tokens_usage)
+    print("framac_cache =", format_framac_cache_stats())
+    print("framac_resources =", format_framac_resource_usage())
+    print("llm_cache =", format_llm_cache_stats())
+    print("llm_ledger =", format_llm_ledger_totals(os.path.abspath(gpt_file)))
     print("@@@", iteration_times, "@@@")
     # End
 
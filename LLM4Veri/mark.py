@@ -85,6 +85,7 @@ def MartkedSourceCode(file_name, SpecDictList):
     SAVE_PICKLE['Status'] = 0
     SAVE_PICKLE['llms_query_times'] = datetime.timedelta(0)
     SAVE_PICKLE['total_solve_time'] = datetime.timedelta(0)
+    SAVE_PICKLE['resource_usage'] = {} # cpu time, max RSS and solver processes of the frama-c runs
     SAVE_PICKLE['simplified_time'] = datetime.timedelta(0)
     SAVE_PICKLE['tokens_usage'] = 0
     SAVE_PICKLE['spec_num_original'] = 0
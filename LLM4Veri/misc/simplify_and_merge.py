@@ -77,64 +77,22 @@ def postprocess_for_file_pair(file_pair_list, folder_name):
     def simplify_acsl(pair_0, pair_1, infolder, outfolder):
         # create a list to store the information of all the failed goals
         fdict_list = []
-        # open the file and read the content into a list
-        with open(os.path.join(infolder, pair_1), 'r') as f:
-            content = f.readlines()
-            # iterate over each line in the content list
-            for line_index in range(len(content)):
-                # if the line contains the goal name, we check if it is a failed goal
-                if "file " + pair_0 in content[line_index] or "Goal Assigns " in content[line_index]:
-                    # two flags to indicate if the goal is proved true or proved false
-                    prove_true_flag = False
-                    prove_false_flag = False
-                    # the line index of the current line
-                    tmp_index =  line_index
-                    # iterate over each line until we reach the end of the file
-                    while tmp_index + 1 < len(content):
-                        # get the content of the next line
-                        next_line_content = content[tmp_index+1]
-                        # if the next line contains "Prove: true", the goal is proved true
-                        if "Prove: true." in next_line_content or ("Prover " in next_line_content and "returns Valid (" in next_line_content):
-                            prove_true_flag = True
-                            break
-                        # if the next line contains "Prove: false", the goal is proved false
-                        elif "Prove: false." in next_line_content or ("Prover " in next_line_content and "returns Timeout (" in next_line_content):
-                            #print(next_line_content)
-                            prove_false_flag = True
-                        # if the next line contains "----------", we reach the end of the file
-                        elif "----------" in next_line_content:
-                            break
-                        # if the next line does not contain anything useful, we continue
-                        else:
-                            pass
-                        # move to the next line
-                        tmp_index = tmp_index + 1
-
-                    # if the goal is proved true, we continue to the next goal
-                    if prove_true_flag:
-                        continue
-
-                    # if the goal is proved false, we extract the goal name and line number
-                    if prove_false_flag:
-                        if "Goal Assigns " in content[line_index]:
-                            merged_content = content[line_index].strip() + " " + content[line_index + 1].strip()
-                            # print(merged_content)
-                            [(goal, fnstr, linestr)] = re.findall(r"Goal (.*) in '(.*)' .*: Effect at line (.*)", merged_content)
-                        else:
-                            [(goal, linestr, fnstr)] = re.findall(r'Goal (.*)\(file .*.c, (.*)\)(.*):', content[line_index])
-                        goal = goal.strip()
-                        if ")" in linestr:
-                            linestr = linestr.split(")")[0]
-                        lineint = int(linestr.replace("line ", ""))
-                        if fnstr != '' and "in '" in fnstr:
-                            fnstr = fnstr.replace("in '", "").replace("'","")
-                        # print({"goal": goal, "line": lineint, "fn": fnstr})
-                        fdict_list.append({"goal": goal, "line": lineint, "fn": fnstr})
+        # the goals of the frama-c run, with their prover results
+        report = load_wp_report(os.path.join(infolder, pair_1))
+        for goal in report.goals:
+            # the goals of the generated file, and the assigns goals
+            if not goal.file.endswith(pair_0) and goal.kind != "assigns":
+                continue
+            # a goal proved by Qed or by one of the provers is kept
+            if not goal.is_failed():
+                continue
+            # print({"goal": goal.description, "line": goal.line, "fn": goal.function})
+            fdict_list.append({"goal": goal.description, "kind": goal.kind, "line": goal.line, "fn": goal.function})
                         
         # if fdict_list's goal are all assign
         all_assign_flag = True
         for each_dict in fdict_list:
-            if not "Assigns " in each_dict['goal']:
+            if each_dict['kind'] != "assigns":
                 all_assign_flag = False
         if fdict_list != [] and  all_assign_flag == True:
             return -1
@@ -146,7 +104,7 @@ def postprocess_for_file_pair(file_pair_list, folder_name):
             # For each dictionary in the list of dictionaries
             for each_dict in fdict_list:
                 # Replace the line in the file that is specified in the dictionary with a newline
-                if "Assigns " in each_dict['goal']:
+                if each_dict['kind'] == "assigns":
                     continue
                 content[each_dict['line'] - 1] = "//\n"
             
@@ -199,7 +157,7 @@ def postprocess_for_file_pair(file_pair_list, folder_name):
                 os.remove(framac_result_file)
             
             # run frama-c
-            framac_result_type, framac_result_file, _ = run_framac_with_wp(output_folder, each_pair[0])
+            framac_result_type, framac_result_file, _, _ = run_framac_with_wp(output_folder, each_pair[0])
             print("out:", framac_result_file)
             # The name of the folder to be generated
             infolder, outfolder = output_folder, output_folder
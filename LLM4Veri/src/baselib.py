@@ -286,6 +286,15 @@ def formateTime(seconds):
     return '{:0>2}:{:0>2}:{:08.5f}'.format(int(hours), int(minutes), s)
 
 
+# get (and create) a sub folder of the shared autospec cache folder
+# the root can be moved with the AUTOSPEC_CACHE_DIR environment variable
+def get_autospec_cache_dir(sub_dir = ""):
+    cache_root = os.environ.get("AUTOSPEC_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "autospec"))
+    cache_dir = os.path.join(cache_root, sub_dir) if sub_dir != "" else cache_root
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
 # write to file
 def write_to_file(file_name, content):
     with open(file_name, 'w') as f:
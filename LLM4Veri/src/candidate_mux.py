@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Multiplexed verification of contract candidates.
+#
+# The contract candidates of a task (_gen_N.c) are the same file with a different
+# contract above the task function f. Instead of one frama-c per candidate, a batch of
+# candidates becomes one translation unit: the first candidate as it is, followed by
+# one clone of f per candidate (f__cand0, f__cand1, ...) carrying that candidate's
+# contract. One WP run restricted to the clones (-wp-fct) proves the whole batch, and
+# the goals of every clone are mapped back to the lines of its candidate, which gets
+# its own _fstd_ artifact as if it had been verified alone. The batches run
+# concurrently; a batch that cannot be multiplexed (Invalid, no goal report) falls
+# back to one run per candidate.
+#
+# Only the per-goal report of the compact output tells the clones apart, so the
+# multiplexing needs it (framac.WP_COMPACT_OUTPUT with -wp-report-json).
+
+import os, sys, re
+import logging
+import datetime
+from .framac import *
+
+CANDIDATE_MUX_BATCH_SIZE = 8        # candidates per multiplexed translation unit
+CANDIDATE_MUX_SUFFIX = "__cand"
+
+
+# (block_start, function_name, function_end) of the candidates: the 0-based first line of the
+# clone block (the contract region, from its comment opening) and the 1-based last line of
+# the function in the first candidate; None when the candidates do not differ by a contract
+def get_candidate_contract_block(contents, function_name):
+    lines_list = [content.split("\n") for content in contents]
+    first_lines = lines_list[0]
+    prefix_len = min(len(first_lines), min(len(lines) for lines in lines_list))
+    for lines in lines_list[1:]:
+        common = 0
+        while common < prefix_len and lines[common] == first_lines[common]:
+            common += 1
+        prefix_len = common
+    suffix_len = min(len(lines) for lines in lines_list) - prefix_len
+    for lines in lines_list[1:]:
+        common = 0
+        while common < suffix_len and lines[len(lines) - 1 - common] == first_lines[len(first_lines) - 1 - common]:
+            common += 1
+        suffix_len = common
+
+    region_end = len(first_lines) - suffix_len          # 0-based, exclusive
+    functions = [(start_line, end_line) for name, start_line, end_line in find_function_definitions(contents[0]) if name == function_name]
+    if len(functions) != 1:
+        return None
+    start_line, end_line = functions[0]
+    # the contract must end above the line of the function name
+    if region_end >= start_line or get_owning_function(contents[0], prefix_len + 1) != function_name:
+        return None
+    block_start = prefix_len
+    head_text = "\n".join(first_lines[:prefix_len])
+    if head_text.rfind("/*") > head_text.rfind("*/"):
+        # the differing lines are inside an annotation opened in the common part
+        block_start = head_text[:head_text.rfind("/*")].count("\n")
+    return block_start, end_line
+
+
+def _rename_function(text, function_name, new_name):
+    return re.sub(r"\b" + re.escape(function_name) + r"\b", new_name, text)
+
+
+# write the multiplexed file of a batch of candidates
+# return (mux_file, {clone: (gfile, mux_block_start, candidate_block_start)}) with 1-based block starts, None when impossible
+def write_candidate_mux_file(Output_folder, gfile_list, function_name):
+    contents = []
+    for gfile in gfile_list:
+        with open(os.path.join(Output_folder, gfile), "r") as f:
+            contents.append(f.read())
+    block = get_candidate_contract_block(contents, function_name)
+    if block is None:
+        return None
+    block_start, function_end = block
+    first_len = len(contents[0].split("\n"))
+
+    mux_lines = contents[0].split("\n")
+    clones = {}
+    for index, (gfile, content) in enumerate(zip(gfile_list, contents)):
+        lines = content.split("\n")
+        # the function moves with the length of the contract
+        candidate_function_end = function_end + len(lines) - first_len
+        clone = function_name + CANDIDATE_MUX_SUFFIX + str(index)
+        mux_lines.append("")
+        clones[clone] = (gfile, len(mux_lines) + 1, block_start + 1)
+        mux_lines.extend(_rename_function("\n".join(lines[block_start:candidate_function_end]), function_name, clone).split("\n"))
+
+    fleft, fright = os.path.splitext(gfile_list[0])
+    # hidden, so that it is not taken for a generated candidate
+    mux_file = "." + fleft + "_mux" + fright
+    with open(os.path.join(Output_folder, mux_file), "w") as f:
+        f.write("\n".join(mux_lines))
+    return mux_file, clones
+
+
+# the stdout of a candidate rebuilt from the goals of its clone, in the compact output format
+def _format_candidate_output(goals, proved_goals, mux_file, clone):
+    lines = ["[wp] Multiplexed in " + mux_file + " as " + clone, "[wp] %d goals scheduled" % len(goals)]
+    for goal in goals:
+        if not goal.proved:
+            lines.append("[wp] [%s] %s" % (goal.get_status(), goal.name))
+    lines.append("[wp] Proved goals: %4d / %d" % (proved_goals, len(goals)))
+    return ("\n".join(lines) + "\n" + "".join(format_wp_goal_line(goal) for goal in goals)).encode("utf-8")
+
+
+# one multiplexed batch: {gfile: (result_type, output_std_file_name, output_err_file_name, solve_time)}, None to fall back
+def run_candidate_mux_batch(Output_folder, gfile_list, function_name, time_out = 8, cancel_event = None):
+    starttime = datetime.datetime.now()
+    written = write_candidate_mux_file(Output_folder, gfile_list, function_name)
+    if written is None:
+        return None
+    mux_file, clones = written
+    mux_path = os.path.join(Output_folder, mux_file)
+    parser = WPOutputParser(scoped = True)
+    FRAMAC_Command = build_framac_command(Output_folder, mux_file, time_out, list(clones.keys()))
+    try:
+        stdout_file, stderr_file, stop_reason = run_framac_command(FRAMAC_Command, mux_path, parser, cancel_event)
+        stderr_data = stderr_file.read()
+        stdout_file.close()
+        stderr_file.close()
+    finally:
+        os.remove(mux_path)
+    report = parser.report()
+    goals_of = {clone: [goal for goal in report.goals if goal.function == clone] for clone in clones}
+    # every goal must be told apart, or the batch is verified candidate by candidate
+    if stop_reason not in ("", "abort") or not report.result_type.startswith(("Pass_", "Fail_")) or \
+        report.all_goals != sum(len(goals) for goals in goals_of.values()):
+        logging.info("[MUX] " + report.result_type + " for the batch of " + str(len(gfile_list)) + " candidates in " + mux_file + ", verifying them one by one")
+        return None
+
+    solve_time = datetime.datetime.now() - starttime
+    results = {}
+    for clone, (gfile, mux_block_start, candidate_block_start) in clones.items():
+        candidate_goals = []
+        for goal in goals_of[clone]:
+            # back to the candidate: its file, its lines, the name of the function
+            candidate_goal = WPGoal(goal.description, goal.kind, function_name, os.path.join(Output_folder, gfile),
+                                    goal.line - mux_block_start + candidate_block_start if goal.line >= mux_block_start else 0)
+            candidate_goal.name = goal.name.replace("typed_" + clone + "_", "typed_" + function_name + "_", 1)
+            candidate_goal.description = candidate_goal.name
+            candidate_goal.provers = goal.provers
+            candidate_goal.proved = goal.proved
+            candidate_goals.append(candidate_goal)
+        proved_goals = sum(1 for goal in candidate_goals if goal.proved)
+        timeout_in_requires = sum(1 for goal in candidate_goals if not goal.proved and is_requires_goal(goal.name) and goal.get_status() == "Timeout")
+        result_type = ("Pass_" if proved_goals + timeout_in_requires == len(candidate_goals) else "Fail_") + str(proved_goals) + "_" + str(len(candidate_goals))
+        stdoutdata = _format_candidate_output(candidate_goals, proved_goals, mux_file, clone)
+        output_result_type, output_std_file_name, output_err_file_name = write_framac_artifacts(Output_folder, gfile, stdoutdata, stderr_data, result_type)
+        results[gfile] = (output_result_type, output_std_file_name, output_err_file_name, solve_time)
+    logging.info("[MUX] " + str(len(gfile_list)) + " candidates of " + function_name + " verified by one frama-c run in " + str(solve_time))
+    return results
+
+
+# verify the contract candidates of function_name, CANDIDATE_MUX_BATCH_SIZE per frama-c run, the batches concurrently
+# return ({gfile: (output_result_type, output_std_file_name, output_err_file_name, solve_time)}, wall time) like run_framac_on_files()
+def run_multiplexed_candidates(Output_folder, gfile_list, function_name, time_out = 8, stop_on_full_pass = False, max_workers = None):
+    if len(gfile_list) < 2 or not is_compact_wp_command(build_framac_command(Output_folder, gfile_list[0], time_out)):
+        return run_framac_on_files(Output_folder, gfile_list, time_out, stop_on_full_pass, max_workers, [function_name])
+    batches = [gfile_list[i:i + CANDIDATE_MUX_BATCH_SIZE] for i in range(0, len(gfile_list), CANDIDATE_MUX_BATCH_SIZE)]
+    executor = VerificationExecutor(max_workers=max_workers)
+    stop_when = None
+    if stop_on_full_pass:
+        stop_when = lambda result: result is not None and any(is_full_pass(candidate_result[0]) for candidate_result in result.values())
+    batch_results = executor.run(run_candidate_mux_batch, [(Output_folder, batch, function_name, time_out) for batch in batches], stop_when)
+    solve_time = datetime.timedelta(seconds=executor.wall_time)
+
+    results = {}
+    fallback_list = []
+    for batch, batch_result in zip(batches, batch_results):
+        if batch_result is not None:
+            results.update(batch_result)
+        elif not executor.cancel_event.is_set():
+            fallback_list.extend(batch)
+    if fallback_list != []:
+        fallback_results, fallback_time = run_framac_on_files(Output_folder, fallback_list, time_out, stop_on_full_pass, max_workers, [function_name])
+        results.update(fallback_results)
+        solve_time = solve_time + fallback_time
+    # the candidates in their original order
+    return {gfile: results[gfile] for gfile in gfile_list if gfile in results}, solve_time
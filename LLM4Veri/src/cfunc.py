@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Lightweight lookup of the C function definitions of a source file.
+#
+# This is not a C parser: comments (ACSL included), string and character literals
+# are blanked, then every top-level "name(...) {" is a function definition. That is
+# enough for the single-file benchmarks, and the result is only used to scope WP.
+
+import re
+
+C_NOT_FUNCTION_NAMES = ("if", "while", "for", "switch", "return", "sizeof", "do", "else")
+C_IDENTIFIER_RE = re.compile(r"[A-Za-z_]\w*$")
+
+
+# replace comments and literals by spaces, newlines are kept so line numbers do not move
+def blank_c_comments_and_literals(source):
+    out = list(source)
+    i = 0
+    length = len(source)
+    while i < length:
+        if source.startswith("//", i):
+            end = source.find("\n", i)
+            end = length if end == -1 else end
+        elif source.startswith("/*", i):
+            end = source.find("*/", i + 2)
+            end = length if end == -1 else end + 2
+        elif source[i] == '"' or source[i] == "'":
+            end = i + 1
+            while end < length and source[end] != source[i] and source[end] != "\n":
+                end += 2 if source[end] == "\\" else 1
+            end = min(end + 1, length)
+        else:
+            i += 1
+            continue
+        for j in range(i, end):
+            if out[j] != "\n":
+                out[j] = " "
+        i = end
+    return "".join(out)
+
+
+# return [(name, start_line, end_line)], 1-based, start_line is the line of the name
+def find_function_definitions(source):
+    text = blank_c_comments_and_literals(source)
+    functions = []
+    depth = 0
+    body_start = -1
+    name = ""
+    for i, char in enumerate(text):
+        if char == "{":
+            if depth == 0:
+                body_start = i
+                name = _get_function_name_before(text, i)
+            depth += 1
+        elif char == "}" and depth > 0:
+            depth -= 1
+            if depth == 0 and name != "":
+                name_pos = text.rfind(name, 0, body_start)
+                functions.append((name, text.count("\n", 0, name_pos) + 1, text.count("\n", 0, i) + 1))
+                name = ""
+    return functions
+
+
+# "int foo(int n) {" -> "foo", "" when the brace does not open a function body
+def _get_function_name_before(text, brace_pos):
+    head = text[:brace_pos].rstrip()
+    if not head.endswith(")"):
+        return ""
+    depth = 0
+    for i in range(len(head) - 1, -1, -1):
+        if head[i] == ")":
+            depth += 1
+        elif head[i] == "(":
+            depth -= 1
+            if depth == 0:
+                identifier = C_IDENTIFIER_RE.search(head[:i].rstrip())
+                if identifier is None or identifier.group() in C_NOT_FUNCTION_NAMES:
+                    return ""
+                return identifier.group()
+    return ""
+
+
+# the function whose body contains line_num, or the next definition when line_num is
+# in between (a function contract is written right above the function it belongs to)
+def get_owning_function(source, line_num):
+    functions = find_function_definitions(source)
+    for name, start_line, end_line in functions:
+        if start_line <= line_num <= end_line:
+            return name
+    for name, start_line, end_line in functions:
+        if start_line > line_num:
+            return name
+    return ""
+
+
+# the function that owns the ">>> INFILL <<<" location of a task file
+def get_infill_owning_function(source):
+    for line_num, line in enumerate(source.split("\n"), 1):
+        if ">>> INFILL <<<" in line:
+            return get_owning_function(source, line_num)
+    return ""
@@ -12,12 +12,13 @@ class ModelConfig:
         self.platform = data.get('platform', 'Unknown')
         self.model_name = data.get('model_name', config_id)
         self.base_url = data.get('base_url')
+        self.template_id = data.get('template_id')     # ConfigTemplates 中的模板，同一模板（平台账号）的模型共享限流器
         self.api_key = resolved_api_key        # 已从环境变量中读取到的 Key
         
         # 将所有其他参数存储在 params 字典中，方便 LLMCaller 使用
         self.params = {
             k: v for k, v in data.items() 
-            if k not in ['platform', 'model_name', 'api_key_env', 'base_url', 'api_key']
+            if k not in ['platform', 'model_name', 'api_key_env', 'base_url', 'api_key', 'template_id']
         }
 
 class ConfigLoader:
@@ -88,6 +89,7 @@ class ConfigLoader:
         # 3. 合并配置
         final_config_data = template_config.copy() 
         final_config_data['model_name'] = model_name
+        final_config_data['template_id'] = template_id
         
         # 用 ModelMap 中的参数覆盖模板中的参数
         for key, value in model_mapping.items():
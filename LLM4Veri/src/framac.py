@@ -1,117 +1,721 @@
 #!/usr/bin/env python3
 # -*- coding: UTF-8 -*-
 
-import os, io, sys, time
+import os, io, sys, re, time
 import openai
 import logging
+import signal
+import resource
+import shutil
+import tempfile
+import threading
 import subprocess
 import datetime
+import functools
 from typing import List
+from .framac_cache import *
+from .veri_executor import *
+from .veri_daemon import *
+from .wp_report import *
+from .wp_cache import *
+from .cfunc import *
+from .prover_portfolio import *
+from .framac_splice import *
 
 Check_STDOUT = 1                    # Set 1 if you want to record std result
 Check_STDERR = 1                    # Set 1 if you want to record err result
 SubprocessTimeout = 500             # Set the timeout of subprocess
+FRAMAC_OUTPUT_BUFFER_BYTES = 4 * 1024 * 1024    # frama-c output above this size is spilled to disk
+FAIL_FAST_ANY_GOAL = r"typed_"      # fail_fast_goal_pattern that stops frama-c at the first unproved goal
+WP_PROVERS = "Alt-Ergo,Z3"
+WP_ESCALATION_ENABLE = 1            # Set 1 to prove in tiers: Qed only, short prover timeout, then longer timeouts on the unproved goals
+WP_ESCALATION_QED_TIER = 1          # Set 1 to try Qed alone (-wp-prover none) before the SMT provers
+WP_ESCALATION_TIMEOUTS = [1, 3]     # prover timeouts of the tiers below the caller's time_out, which is always the last tier
+WP_ESCALATION_BUDGET = 60           # seconds of frama-c time per file, the remaining tiers are skipped beyond it
+WP_SHARDING_ENABLE = int(os.environ.get("AUTOSPEC_WP_SHARDING", "1"))    # Set 1 to split the goals of large files into concurrent -wp-fct shards
+WP_SHARDING_MIN_FUNCTIONS = 6       # files with fewer functions to prove are not sharded, every shard parses the whole file again
+WP_COMPACT_OUTPUT = int(os.environ.get("AUTOSPEC_WP_COMPACT", "1"))     # Set 1 to replace the -wp-print dump by one compact line per goal
+FRAMAC_CPU_LIMIT_SECONDS = int(os.environ.get("AUTOSPEC_FRAMAC_CPU_LIMIT", "600"))           # RLIMIT_CPU of frama-c and of each solver, 0 for none
+FRAMAC_MEMORY_LIMIT_MB = int(os.environ.get("AUTOSPEC_FRAMAC_MEMORY_LIMIT_MB", "8192"))     # RLIMIT_AS of frama-c and of each solver, 0 for none
+
+# resources of the frama-c runs of this process (the solvers they spawned included), see record_framac_resource_usage()
+FRAMAC_RESOURCE_USAGE = {"runs": 0, "user_time": 0.0, "sys_time": 0.0, "max_rss_mb": 0.0, "solver_processes": 0, "limit_kills": 0}
+FRAMAC_RESOURCE_USAGE_LOCK = threading.Lock()
+
+
+# resource limits of a started frama-c, that every solver it spawns inherits. They are set from the
+# parent with prlimit() right after the spawn: a preexec_fn is not safe while other threads run
+def limit_FRAMAC_process(pid):
+    try:
+        if FRAMAC_CPU_LIMIT_SECONDS > 0:
+            # SIGXCPU at the soft limit, SIGKILL at the hard one
+            resource.prlimit(pid, resource.RLIMIT_CPU, (FRAMAC_CPU_LIMIT_SECONDS, FRAMAC_CPU_LIMIT_SECONDS + 5))
+        if FRAMAC_MEMORY_LIMIT_MB > 0:
+            limit_bytes = FRAMAC_MEMORY_LIMIT_MB * 1024 * 1024
+            resource.prlimit(pid, resource.RLIMIT_AS, (limit_bytes, limit_bytes))
+    except ProcessLookupError:
+        # already exited
+        pass
 
 
 # create subprocess according to the value of Check_STDOUT and Check_STDERR
-def create_FRAMAC_subprocess(FRAMAC_Command, Check_STDOUT, Check_STDERR):
+# in its own session (process group), so that it is killed as a whole
+def create_FRAMAC_subprocess(FRAMAC_Command, Check_STDOUT, Check_STDERR, env = None):
     # Create the FRAMAC command
     # Check_STDOUT and Check_STDERR are used to check the standard output and error of the FRAMAC subprocess
     if (Check_STDOUT == 1 and Check_STDERR == 1):
-        process = subprocess.Popen(FRAMAC_Command, close_fds=True, preexec_fn=os.setpgrp, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        process = subprocess.Popen(FRAMAC_Command, close_fds=True, start_new_session=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
     elif (Check_STDOUT == 1 and Check_STDERR == 0):
-        process = subprocess.Popen(FRAMAC_Command, close_fds=True, preexec_fn=os.setpgrp, stdout=subprocess.PIPE)
+        process = subprocess.Popen(FRAMAC_Command, close_fds=True, start_new_session=True, stdout=subprocess.PIPE, env=env)
     elif (Check_STDOUT == 0 and Check_STDERR == 1):
-        process = subprocess.Popen(FRAMAC_Command, close_fds=True, preexec_fn=os.setpgrp, stderr=subprocess.PIPE)
+        process = subprocess.Popen(FRAMAC_Command, close_fds=True, start_new_session=True, stderr=subprocess.PIPE, env=env)
     else:
-        process = subprocess.Popen(FRAMAC_Command, close_fds=True, preexec_fn=os.setpgrp)
+        process = subprocess.Popen(FRAMAC_Command, close_fds=True, start_new_session=True, env=env)
+    limit_FRAMAC_process(process.pid)
     return process
 
 
+# communicate() that gives up early when cancel_event is set by a VerificationExecutor
+def communicate_FRAMAC_subprocess(process, timeout, cancel_event = None):
+    if cancel_event is None:
+        return process.communicate(timeout=timeout)
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return process.communicate(timeout=max(0.0, min(0.5, deadline - time.time())))
+        except subprocess.TimeoutExpired:
+            if cancel_event.is_set():
+                kill_FRAMAC_process_group(process)
+                process.communicate()
+                return None, None
+            if time.time() >= deadline:
+                raise
+
+
 def get_result_type(context_bytes):
-    # Convert from bytes to a list of strings (split by newline characters).
-    result_type = "UK"
+    return parse_wp_report(context_bytes).result_type
+
+
+# resources of one finished run: rusage of frama-c (wait4, it includes the solvers it waited for)
+# and solver processes started, counted as the goals sent to a prover that were not answered from the cache
+def record_framac_resource_usage(rusage, returncode, summary_lines):
+    summary = parse_wp_cache_summary(summary_lines)
+    solver_processes = sum(max(0, prover_summary["goals"] - prover_summary["cached"])
+                           for prover, prover_summary in summary["provers"].items() if prover not in ("Qed", "Terminating", "Unreachable"))
+    with FRAMAC_RESOURCE_USAGE_LOCK:
+        FRAMAC_RESOURCE_USAGE["runs"] += 1
+        FRAMAC_RESOURCE_USAGE["user_time"] += rusage.ru_utime
+        FRAMAC_RESOURCE_USAGE["sys_time"] += rusage.ru_stime
+        # ru_maxrss is in KB on Linux
+        FRAMAC_RESOURCE_USAGE["max_rss_mb"] = max(FRAMAC_RESOURCE_USAGE["max_rss_mb"], rusage.ru_maxrss / 1024.0)
+        FRAMAC_RESOURCE_USAGE["solver_processes"] += solver_processes
+        if returncode in (-signal.SIGXCPU, -signal.SIGKILL, -signal.SIGSEGV):
+            FRAMAC_RESOURCE_USAGE["limit_kills"] += 1
+    return solver_processes
+
+
+# usage accumulated since the snapshot since (a previous get_framac_resource_usage()), or in total
+def get_framac_resource_usage(since = None):
+    with FRAMAC_RESOURCE_USAGE_LOCK:
+        usage = dict(FRAMAC_RESOURCE_USAGE)
+    if since is not None:
+        for name in usage:
+            if name != "max_rss_mb":
+                usage[name] = usage[name] - since.get(name, 0)
+    return usage
+
+
+# usage of the runs of total followed by the ones of usage, e.g. over the rounds saved in a pickle
+def add_framac_resource_usage(total, usage):
+    total = dict(total or {})
+    for name, value in usage.items():
+        if name == "max_rss_mb":
+            total[name] = max(total.get(name, 0.0), value)
+        else:
+            total[name] = total.get(name, 0) + value
+    return total
+
+
+def format_framac_resource_usage(usage = None):
+    usage = usage or get_framac_resource_usage()
+    return "runs = %d, user = %.1fs, sys = %.1fs, max_rss = %.0fMB, solver_processes = %d, limit_kills = %d" % (
+        usage.get("runs", 0), usage.get("user_time", 0.0), usage.get("sys_time", 0.0), usage.get("max_rss_mb", 0.0),
+        usage.get("solver_processes", 0), usage.get("limit_kills", 0))
+
+
+# kill frama-c together with the solvers it spawned
+def kill_FRAMAC_process_group(process):
+    # frama-c is the leader of its own process group (start_new_session)
     try:
-        context_strings = context_bytes.decode("utf-8")
-        context_io = io.StringIO(context_strings)
-        context = context_io.readlines()
-    except:
-        return result_type
-    
-    # Iterate through each line in the context.
-    timeout_in_requires = 0
-    for line in context:
-        # If the line contains the string "[kernel] Frama-C aborted:", then the
-        # build is invalid.
-        if "[kernel] Frama-C aborted:" in line or "[kernel] Plug-in wp aborted" in line or "[wp] Warning: No goal generated" in line or "error: invalid preprocessing directive" in line:
-            result_type = "Invalid"
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+# read the frama-c stdout line by line while it is running
+# the output goes to bounded buffers that spill to disk, and the parser can stop frama-c early
+# return (stdout_spool, stderr_spool, stop_reason) with stop_reason in "", "abort", "timeout", "cancel"
+def stream_FRAMAC_subprocess(process, timeout, parser, cancel_event = None):
+    stdout_spool = tempfile.SpooledTemporaryFile(max_size=FRAMAC_OUTPUT_BUFFER_BYTES)
+    stderr_spool = tempfile.SpooledTemporaryFile(max_size=FRAMAC_OUTPUT_BUFFER_BYTES)
+    stop_reason = [""]
+    stop_lock = threading.Lock()
+    # frama-c is reaped by wait4() below, the watchdog must not poll() it
+    finished = threading.Event()
+
+    def stop(reason):
+        with stop_lock:
+            if stop_reason[0] == "":
+                stop_reason[0] = reason
+                kill_FRAMAC_process_group(process)
+
+    # the deadline and the cancellation are checked beside the (blocking) line reader
+    def watchdog():
+        deadline = time.time() + timeout
+        while not finished.is_set():
+            if cancel_event is not None and cancel_event.is_set():
+                stop("cancel")
+                return
+            if time.time() >= deadline:
+                stop("timeout")
+                return
+            time.sleep(0.2)
+
+    stderr_thread = threading.Thread(target=shutil.copyfileobj, args=(process.stderr, stderr_spool), daemon=True)
+    watchdog_thread = threading.Thread(target=watchdog, daemon=True)
+    stderr_thread.start()
+    watchdog_thread.start()
+
+    for line in iter(process.stdout.readline, b''):
+        stdout_spool.write(line)
+        if stop_reason[0] == "" and parser.feed(line.decode("utf-8", errors="replace")):
+            stop("abort")
+            parser.abort()
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    finished.set()
+    # solvers left behind by frama-c are not waited for by anyone
+    kill_FRAMAC_process_group(process)
+    stderr_thread.join()
+    watchdog_thread.join()
+    # the runs stopped here are killed on purpose, not by their limits
+    solver_processes = record_framac_resource_usage(rusage, process.returncode if stop_reason[0] == "" else 0, parser.summary_lines)
+    logging.info("[CMD] frama-c used %.2fs user, %.2fs sys, %.0fMB max RSS, %d solver processes" % (
+        rusage.ru_utime, rusage.ru_stime, rusage.ru_maxrss / 1024.0, solver_processes))
+
+    stdout_spool.seek(0)
+    stderr_spool.seek(0)
+    return stdout_spool, stderr_spool, stop_reason[0]
+
+
+# the installed frama-c can write the per goal JSON report of the compact output
+@functools.lru_cache(maxsize=None)
+def framac_supports_wp_report_json():
+    try:
+        ret = subprocess.run(["frama-c", "-wp-h"], capture_output=True, timeout=30)
+    except Exception:
+        return False
+    return b"-wp-report-json" in ret.stdout + ret.stderr
+
+
+def is_compact_wp_command(FRAMAC_Command):
+    return "-wp" in FRAMAC_Command and "-wp-print" not in FRAMAC_Command and WP_COMPACT_OUTPUT == 1 and framac_supports_wp_report_json()
+
+
+# wp_functions: only prove the goals of these functions (-wp-fct), the callee contracts are assumed
+# wp_props: only prove these properties or @categories (-wp-prop)
+# the goals are printed (-wp-print) unless the compact output is on, or when print_goals is set
+def build_framac_command(Output_folder, gfile, time_out = 8, wp_functions = None, wp_props = None, provers = WP_PROVERS, print_goals = False):
+    scope_args = []
+    if wp_functions:
+        scope_args = scope_args + ["-wp-fct", ",".join(wp_functions)]
+    if wp_props:
+        scope_args = scope_args + ["-wp-prop", ",".join(wp_props)]
+    print_args = ["-wp-print"]
+    if not print_goals and WP_COMPACT_OUTPUT == 1 and framac_supports_wp_report_json():
+        # the JSON report is added by run_framac_command(), its path is not part of the cache key
+        print_args = []
+    return ["frama-c", "-wp", "-wp-precond-weakening", "-wp-no-callee-precond", "-wp-prover", provers] + print_args + ["-wp-timeout", str(time_out)] + \
+        scope_args + get_wp_cache_args() + [get_framac_input_path(Output_folder, gfile)]
+
+
+def _is_empty_output(data):
+    if isinstance(data, bytes):
+        return data == b''
+    data.seek(0, os.SEEK_END)
+    is_empty = data.tell() == 0
+    data.seek(0)
+    return is_empty
+
+
+def _write_output(file_name, data):
+    with open (file_name, "wb") as f:
+        if isinstance(data, bytes):
+            f.write(data)
+        else:
+            shutil.copyfileobj(data, f)
+
+
+# write the _fstd_ and _ferr_ artifacts of one frama-c run
+# stdoutdata/stderrdata are bytes or file objects; the WPReport of stdoutdata is parsed from it when not given,
+# result_type overrides the one of the report; the report is then what load_wp_report() returns for the _fstd_ file
+def write_framac_artifacts(Output_folder, gfile, stdoutdata, stderrdata, result_type = None, report = None):
+    output_std_file_name = ""
+    output_err_file_name = ""
+    output_result_type = ""
+    fleft, fright = gfile.split(".")
+    fright = "." + fright
+    if not _is_empty_output(stdoutdata):
+        if report is None:
+            if isinstance(stdoutdata, bytes):
+                report = parse_wp_report(stdoutdata)
+            else:
+                report = parse_wp_report(line.decode("utf-8", errors="replace") for line in stdoutdata)
+                stdoutdata.seek(0)
+        if result_type is None:
+            result_type = report.result_type
+        elif result_type != report.result_type:
+            report.set_result_type(result_type)
+        output_result_type = result_type
+        fleft = fleft.replace("_gen_", "_fstd_")
+        fstd_file_name = fleft + "_" + result_type
+        output_std_file_name = os.path.join(Output_folder, fstd_file_name + ".txt")
+        #stdfile.write(bytes(str(pattern)+"\n", encoding = "utf8"))
+        _write_output(output_std_file_name, stdoutdata)
+        register_wp_report(output_std_file_name, report)
+    if not _is_empty_output(stderrdata):
+        fleft = fleft.replace("_gen_", "_ferr_")
+        output_err_file_name = os.path.join(Output_folder, fleft + ".txt")
+        _write_output(output_err_file_name, stderrdata)
+    return output_result_type, output_std_file_name, output_err_file_name
+
+
+# the goals of the JSON report of a finished run -> compact goal lines at the end of stdout, fed to parser
+def _append_compact_goal_lines(json_file_name, stdout_spool, parser, stop_reason):
+    goals = []
+    try:
+        if stop_reason in ("", "abort") and os.path.exists(json_file_name):
+            goals = read_wp_json_goals(json_file_name)
+    except (OSError, ValueError) as e:
+        logging.warning("[CMD] cannot read the WP report " + json_file_name + ": " + str(e))
+    finally:
+        if os.path.exists(json_file_name):
+            os.remove(json_file_name)
+    if goals == []:
+        return
+    stdout_spool.seek(0, os.SEEK_END)
+    for goal in goals:
+        line = format_wp_goal_line(goal)
+        stdout_spool.write(line.encode("utf-8"))
+        parser.feed(line)
+    stdout_spool.seek(0)
+
+
+# run one frama-c command (or replay it from the result cache) and feed its stdout to parser
+# return (stdout_file, stderr_file, stop_reason), see stream_FRAMAC_subprocess(); the caller closes the files
+def run_framac_command(FRAMAC_Command, target_path, parser, cancel_event = None):
+    starttime = datetime.datetime.now()
+
+    # an identical file has already been verified with the same command and provers
+    cache_key = ""
+    if FRAMAC_CACHE_ENABLE == 1:
+        cache_key = make_framac_cache_key(FRAMAC_Command, target_path)
+        cached = lookup_framac_result(cache_key, target_path)
+        if cached is not None:
+            cached_result_type, stdoutdata, stderrdata, cached_solve_time = cached
+            logging.info("[CACHE] Reusing frama-c result of `" + ' '.join(FRAMAC_Command) + "` (" + str(cached_solve_time) + "s)")
+            for line in io.StringIO(stdoutdata.decode("utf-8", errors="replace")):
+                parser.feed(line)
+            # the replayed output is complete, it is never a fail-fast result
+            parser.result_type = cached_result_type
+            parser.done = True
+            parser.fail_fast_goal = ""
+            parser.replayed = True
+            return io.BytesIO(stdoutdata), io.BytesIO(stderrdata), ""
+
+    # machine-wide admission by the verification daemon, which also decides the -wp-par of the run
+    slot = VerificationSlot().acquire(cancel_event)
+    if slot.cancelled:
+        return io.BytesIO(b""), io.BytesIO(b""), "cancel"
+    run_command = FRAMAC_Command
+    if slot.wp_par is not None and "-wp" in FRAMAC_Command:
+        run_command = run_command[:-1] + ["-wp-par", str(slot.wp_par)] + run_command[-1:]
+
+    # compact output: the goals come from a JSON report, appended to stdout as compact goal lines
+    json_file_name = ""
+    if is_compact_wp_command(FRAMAC_Command):
+        json_fd, json_file_name = tempfile.mkstemp(prefix="autospec_wp_", suffix=".json")
+        os.close(json_fd)
+        os.remove(json_file_name)
+        run_command = run_command[:-1] + ["-wp-report-json", json_file_name] + run_command[-1:]
+
+    # the shared prover cache must not be evicted while frama-c is replaying it
+    wp_cache_lock = WPCacheLock().acquire()
+    try:
+        process = create_FRAMAC_subprocess(run_command, 1, 1, get_wp_cache_env())
+        logging.info("[CMD] Running `" + ' '.join(run_command) + "`")
+        stdout_spool, stderr_spool, stop_reason = stream_FRAMAC_subprocess(process, SubprocessTimeout, parser, cancel_event)
+    finally:
+        wp_cache_lock.release()
+        slot.release()
+    if json_file_name != "":
+        _append_compact_goal_lines(json_file_name, stdout_spool, parser, stop_reason)
+    record_wp_cache_run(target_path, parser.summary_lines)
+    record_prover_results(parser.goals)
+    record_function_costs(target_path, parser.goals)
+
+    if stop_reason == "abort":
+        logging.info("[CMD] Stopped early (" + (parser.fatal_line or parser.fail_fast_goal) + ")")
+    # a fail-fast result depends on the caller's pattern, it is not the result of the file
+    if cache_key != "" and stop_reason in ("", "abort") and parser.result_type != "UK" and not parser.is_fail_fast_abort() \
+        and not _is_empty_output(stdout_spool):
+        store_framac_result(cache_key, target_path, parser.result_type, stdout_spool.read(), stderr_spool.read(),
+                            (datetime.datetime.now() - starttime).total_seconds())
+        stdout_spool.seek(0)
+        stderr_spool.seek(0)
+    return stdout_spool, stderr_spool, stop_reason
+
+
+# goals that are still unproved after a tier -> (-wp-fct functions, -wp-prop categories) that cover them,
+# None when they cannot be told apart (the next tier then proves the whole file again)
+def get_escalation_scope(target_path, unproved_goals):
+    with open(target_path, "r", encoding="utf-8", errors="replace") as f:
+        function_names = [name for name, _, _ in find_function_definitions(f.read())]
+    functions = []
+    categories = []
+    for goal_name in unproved_goals:
+        function_name = get_goal_function(goal_name, function_names)
+        category = get_goal_category(goal_name, function_name)
+        if function_name == "" or category == "":
+            return None
+        if function_name not in functions:
+            functions.append(function_name)
+        if category not in categories:
+            categories.append(category)
+    if functions == []:
+        return None
+    return functions, categories
+
+
+# "[wp] Proved goals:   x / y" of the last tier is replaced by the count over the whole file
+def _rewrite_proved_goals_line(stdout_file, proved_goals, all_goals):
+    content = stdout_file.read()
+    stdout_file.close()
+    content = re.sub(rb"\[wp\] Proved goals:\s*\d+\s*/\s*\d+",
+                     ("[wp] Proved goals: %4d / %d" % (proved_goals, all_goals)).encode("utf-8"), content)
+    return io.BytesIO(content)
+
+
+# tiered proof: Qed only, then the SMT provers with a short timeout, then only the goals that are
+# still unproved (-wp-fct/-wp-prop) with longer timeouts up to time_out, within WP_ESCALATION_BUDGET
+# return (result_type, stdout_file, stderr_file, stop_reason) of the merged run
+def run_framac_escalation(Output_folder, gfile, time_out = 8, cancel_event = None, fail_fast_goal_pattern = None, wp_functions = None):
+    starttime = time.time()
+    target_path = os.path.join(Output_folder, gfile)
+    scoped = bool(wp_functions)
+
+    tiers = []
+    if WP_ESCALATION_QED_TIER == 1:
+        # the timeout does not matter to Qed, a fixed one keeps the cache key of the tier
+        tiers.append(("none", 1))
+    for tier_time_out in WP_ESCALATION_TIMEOUTS:
+        if tier_time_out < time_out:
+            tiers.append((WP_PROVERS, tier_time_out))
+    tiers.append((WP_PROVERS, time_out))
+
+    stdout_file, stderr_file = None, None
+    result_type = ""
+    all_goals = -1                  # goals of the whole (scoped) run, known after the first SMT tier
+    escalation_scope = None
+    unproved_goal_kinds = []
+    portfolio_failed = False        # a tier restricted to the historical winners did not pass
+    for tier_index, (provers, tier_time_out) in enumerate(tiers):
+        is_last_tier = tier_index == len(tiers) - 1
+        # the remaining goals only go to the provers that win their kinds
+        if provers != "none" and not portfolio_failed:
+            provers = select_provers(unproved_goal_kinds, provers)
+        if stdout_file is not None:
+            if time.time() - starttime >= WP_ESCALATION_BUDGET:
+                logging.info("[ESCALATION] Budget of " + str(WP_ESCALATION_BUDGET) + "s spent on " + gfile)
+                break
+            stdout_file.close()
+            stderr_file.close()
+
+        # the fail-fast pattern only makes sense once the goals had their full timeout and all the provers
+        tier_fail_fast_goal_pattern = fail_fast_goal_pattern if is_last_tier and provers == tiers[tier_index][0] else None
+        if escalation_scope is not None:
+            parser = WPOutputParser(tier_fail_fast_goal_pattern, scoped = True)
+            FRAMAC_Command = build_framac_command(Output_folder, gfile, tier_time_out, escalation_scope[0], escalation_scope[1], provers)
+            stdout_file, stderr_file, stop_reason = run_framac_command(FRAMAC_Command, target_path, parser, cancel_event)
+            if stop_reason in ("", "abort") and not parser.is_fail_fast_abort() and \
+                (parser.result_type == "Pass_0_0" or not parser.result_type.startswith(("Pass_", "Fail_"))):
+                # the scope did not select the unproved goals, prove the whole file at this timeout
+                logging.info("[ESCALATION] Scope " + str(escalation_scope) + " selected no goal of " + gfile)
+                stdout_file.close()
+                stderr_file.close()
+                escalation_scope = None
+        if escalation_scope is None:
+            parser = WPOutputParser(tier_fail_fast_goal_pattern, scoped = scoped)
+            FRAMAC_Command = build_framac_command(Output_folder, gfile, tier_time_out, wp_functions, None, provers)
+            stdout_file, stderr_file, stop_reason = run_framac_command(FRAMAC_Command, target_path, parser, cancel_event)
+        if stop_reason in ("cancel", "timeout"):
+            return "", stdout_file, stderr_file, stop_reason
+
+        result_type = parser.result_type
+        if not result_type.startswith(("Pass_", "Fail_")) or parser.is_fail_fast_abort():
             break
-        elif "[wp] [Timeout] typed_" in line and ("_requires (" in line or "_requires_" in line):
-            timeout_in_requires += 1
-            continue
-        # If the line contains the string "[wp] Proved goals:", then the build
-        # is valid. The number of proved goals is given in the form "x/y",
-        # where x is the number of proved goals and y is the number of total
-        # goals. If x == y, then the build is a pass. Otherwise, the build is
-        # a fail.
-        elif "[wp] Proved goals:" in line:
-            proportion = line.split(":")[-1]
-            left, right = proportion.split("/")
-            left = left.strip()
-            right = right.strip()
-            if int(left) + int(timeout_in_requires) == int(right):
-                result_type = "Pass_" + left + "_" + right
+        _, proved_str, all_str = result_type.split("_")
+        if escalation_scope is not None:
+            # the goals outside the scope were proved by the previous tiers
+            proved_goals = all_goals - (int(all_str) - int(proved_str))
+            if proved_goals + parser.timeout_in_requires == all_goals:
+                result_type = "Pass_" + str(proved_goals) + "_" + str(all_goals)
             else:
-                result_type = "Fail_" + left + "_" + right
+                result_type = "Fail_" + str(proved_goals) + "_" + str(all_goals)
+            stdout_file = _rewrite_proved_goals_line(stdout_file, proved_goals, all_goals)
+        elif provers != "none":
+            all_goals = int(all_str)
+        if result_type.startswith("Pass_"):
             break
 
-    return result_type
+        logging.info("[ESCALATION] " + result_type + " after tier " + str(tier_index) + " (" + provers + ", " + str(tier_time_out) + "s) on " + gfile)
+        if provers != "none":
+            escalation_scope = get_escalation_scope(target_path, parser.unproved_goals)
+            if provers != tiers[tier_index][0]:
+                portfolio_failed = True
+                if is_last_tier:
+                    # the provers left out get their chance at the same timeout
+                    tiers.append(tiers[tier_index])
+        unproved_goal_kinds = [goal.kind for goal in parser.goals if not goal.proved]
+    return result_type, stdout_file, stderr_file, stop_reason
+
+
+# one (escalated) proof of the goals of wp_functions, the whole file when None
+# return (result_type, stdout_file, stderr_file, stop_reason), see run_framac_escalation()
+def run_framac_scoped(Output_folder, gfile, time_out = 8, wp_functions = None, fail_fast_goal_pattern = None, cancel_event = None):
+    if WP_ESCALATION_ENABLE == 1:
+        return run_framac_escalation(Output_folder, gfile, time_out, cancel_event, fail_fast_goal_pattern, wp_functions)
+    parser = WPOutputParser(fail_fast_goal_pattern, scoped = bool(wp_functions))
+    FRAMAC_Command = build_framac_command(Output_folder, gfile, time_out, wp_functions)
+    stdout_file, stderr_file, stop_reason = run_framac_command(FRAMAC_Command, os.path.join(Output_folder, gfile), parser, cancel_event)
+    return parser.result_type, stdout_file, stderr_file, stop_reason
+
+
+# the -wp-print text of a goal of a compact run, printed again by a Qed only run of its function and property category
+# only the goals that need it (e.g. to show a failure) pay for it; "" when it cannot be found
+def load_wp_goal_text(Output_folder, gfile, goal):
+    if goal.text is not None:
+        return goal.text
+    category = get_goal_category(goal.name, goal.function) if goal.name != "" else ""
+    FRAMAC_Command = build_framac_command(Output_folder, gfile, 1, [goal.function] if goal.function != "" else None,
+                                          [category] if category != "" else None, "none", print_goals = True)
+    parser = WPOutputParser(scoped = goal.function != "", keep_text = True)
+    stdout_file, stderr_file, stop_reason = run_framac_command(FRAMAC_Command, os.path.join(Output_folder, gfile), parser)
+    stdout_file.close()
+    stderr_file.close()
+    goal.text = ""
+    for printed_goal in parser.goals:
+        if printed_goal.line == goal.line and printed_goal.kind == goal.kind and printed_goal.text is not None:
+            goal.text = goal.text + printed_goal.text
+    return goal.text
+
+
+# the functions to prove split into at most shard_num groups of about the same historical cost
+# (longest first onto the lightest shard); the functions without history weigh their line count
+def get_wp_shards(target_path, function_lines, shard_num):
+    costs = load_function_costs(target_path)
+    known = [name for name in function_lines if name in costs]
+    cost_per_line = 1.0
+    if known != [] and sum(function_lines[name] for name in known) > 0:
+        cost_per_line = max(1.0, sum(costs[name] for name in known) / sum(function_lines[name] for name in known))
+    weights = {name: costs.get(name, function_lines[name] * cost_per_line) for name in function_lines}
+
+    shards = [[] for _ in range(shard_num)]
+    shard_weights = [0.0] * shard_num
+    for name in sorted(weights, key=lambda name: (-weights[name], name)):
+        lightest = shard_weights.index(min(shard_weights))
+        shards[lightest].append(name)
+        shard_weights[lightest] += weights[name]
+    return [shard for shard in shards if shard != []]
+
+
+# the per-shard "[wp] Proved goals:" summaries are replaced by one over all the shards
+def _merge_shard_outputs(shard_outputs, proved_goals, all_goals):
+    merged_lines = []
+    prover_goals = {}
+    for shard_functions, stdout_bytes in shard_outputs:
+        lines = stdout_bytes.decode("utf-8", errors="replace").split("\n")
+        summary = parse_wp_cache_summary(lines)
+        for prover, prover_summary in summary["provers"].items():
+            goals, cached = prover_goals.get(prover, (0, 0))
+            prover_goals[prover] = (goals + prover_summary["goals"], cached + prover_summary["cached"])
+        merged_lines.append("[wp] Shard -wp-fct " + ",".join(shard_functions))
+        in_summary = False
+        for line in lines:
+            if "[wp] Proved goals:" in line:
+                in_summary = True
+                continue
+            if in_summary and WP_PROVER_SUMMARY_RE.match(line) is not None:
+                continue
+            in_summary = False
+            if line != "":
+                merged_lines.append(line)
+    merged_lines.append("[wp] Proved goals: %4d / %d" % (proved_goals, all_goals))
+    for prover, (goals, cached) in prover_goals.items():
+        merged_lines.append("  %-15s %4d" % (prover + ":", goals) + (" (cached: %d)" % cached if cached > 0 else ""))
+    return ("\n".join(merged_lines) + "\n").encode("utf-8")
+
+
+# goal sharding of a large file: the functions are proved by concurrent frama-c runs (-wp-fct groups
+# balanced by historical cost) and the shard results are merged into one Pass_x_y/Fail_x_y
+# return (result_type, stdout_file, stderr_file, stop_reason) like run_framac_scoped(), None when the file is not sharded
+def run_framac_sharded(Output_folder, gfile, time_out = 8, wp_functions = None, fail_fast_goal_pattern = None):
+    target_path = os.path.join(Output_folder, gfile)
+    with open(target_path, "r", encoding="utf-8", errors="replace") as f:
+        functions = find_function_definitions(f.read())
+    function_lines = {name: end_line - start_line + 1 for name, start_line, end_line in functions if not wp_functions or name in wp_functions}
+    if len(function_lines) < WP_SHARDING_MIN_FUNCTIONS:
+        return None
+    shard_num = get_verification_worker_num(len(function_lines))
+    if shard_num < 2:
+        return None
+    shards = get_wp_shards(target_path, function_lines, shard_num)
+    logging.info("[SHARD] " + str(len(function_lines)) + " functions of " + gfile + " in " + str(len(shards)) + " shards")
 
-def run_framac_with_wp(Output_folder, gfile, time_out = 8):
+    # every shard frama-c would otherwise write the same spliced input at once
+    get_framac_input_path(Output_folder, gfile)
+    executor = VerificationExecutor(max_workers=len(shards))
+    # an Invalid file, or an unproved goal under fail-fast, decides the result of the whole file
+    stop_when = lambda result: result[0] == "Invalid" or (fail_fast_goal_pattern is not None and result[0].startswith("Fail_"))
+    job_fn = functools.partial(run_framac_scoped, fail_fast_goal_pattern=fail_fast_goal_pattern)
+    results = executor.run(job_fn, [(Output_folder, gfile, time_out, shard) for shard in shards], stop_when)
+
+    shard_outputs = []
+    stderr_data = b""
+    proved_goals, all_goals = 0, 0
+    all_pass = True
+    decided = None                  # (result_type, stdout) of a shard that is neither Pass nor Fail
+    for shard, result in zip(shards, results):
+        # None or "cancel": stopped once another shard decided the result
+        if result is None:
+            continue
+        shard_result_type, stdout_file, stderr_file, stop_reason = result
+        stdout_data = stdout_file.read()
+        stderr_data = stderr_data + stderr_file.read()
+        stdout_file.close()
+        stderr_file.close()
+        if stop_reason == "timeout":
+            return "", io.BytesIO(b""), io.BytesIO(stderr_data), "timeout"
+        if stop_reason == "cancel":
+            continue
+        if not shard_result_type.startswith(("Pass_", "Fail_")):
+            if decided is None or shard_result_type == "Invalid":
+                decided = (shard_result_type, stdout_data)
+            continue
+        _, proved_str, all_str = shard_result_type.split("_")
+        proved_goals += int(proved_str)
+        all_goals += int(all_str)
+        # the timeouts of requires goals only count in the classification of their own shard
+        all_pass = all_pass and shard_result_type.startswith("Pass_")
+        shard_outputs.append((shard, stdout_data))
+
+    if decided is not None:
+        return decided[0], io.BytesIO(decided[1]), io.BytesIO(stderr_data), ""
+    if all_goals == 0 and not wp_functions:
+        # what an unscoped run says of a file without goals
+        return "Invalid", io.BytesIO((WP_NO_GOAL_MARKER + "\n").encode("utf-8")), io.BytesIO(stderr_data), ""
+    result_type = ("Pass_" if all_pass else "Fail_") + str(proved_goals) + "_" + str(all_goals)
+    return result_type, io.BytesIO(_merge_shard_outputs(shard_outputs, proved_goals, all_goals)), io.BytesIO(stderr_data), ""
+
+
+# fail_fast_goal_pattern: stop frama-c as soon as a goal whose name matches it is not proved,
+# the result is then a partial "Fail_0_<goals>", for callers that only need pass/fail
+# wp_functions: task-scoped run, see build_framac_command(); a scoped function without goals is "Pass_0_0"
+# large files are sharded (run_framac_sharded) unless the caller already runs files concurrently (cancel_event)
+def run_framac_with_wp(Output_folder, gfile, time_out = 8, cancel_event = None, fail_fast_goal_pattern = None, wp_functions = None):
     starttime = datetime.datetime.now()
-    FRAMAC_Command = ["frama-c", "-wp", "-wp-precond-weakening", "-wp-no-callee-precond", "-wp-prover", "Alt-Ergo,Z3", "-wp-print", "-wp-timeout", str(time_out),  os.path.join(Output_folder, gfile)]
-    
-    # create subprocess according to the value of check_STDOUT and check_STDERR
-    process = create_FRAMAC_subprocess(FRAMAC_Command, Check_STDOUT, Check_STDERR)
-    logging.info("[CMD] Running `" + ' '.join(FRAMAC_Command) + "`")
+    target_path = os.path.join(Output_folder, gfile)
 
     output_std_file_name = ""
     output_err_file_name = ""
     output_result_type = ""
+    if Check_STDOUT == 1 and Check_STDERR == 1:
+        sharded = None
+        if WP_SHARDING_ENABLE == 1 and cancel_event is None:
+            sharded = run_framac_sharded(Output_folder, gfile, time_out, wp_functions, fail_fast_goal_pattern)
+        if sharded is not None:
+            result_type, stdout_file, stderr_file, stop_reason = sharded
+        else:
+            result_type, stdout_file, stderr_file, stop_reason = run_framac_scoped(Output_folder, gfile, time_out, wp_functions, fail_fast_goal_pattern, cancel_event)
+        if stop_reason == "cancel":
+            logging.info("[CMD] Cancelled frama-c on " + target_path)
+            output_result_type = "Cancelled"
+        elif stop_reason == "timeout":
+            logging.error("Timeout for subprocess when running frama-c on " + target_path)
+        else:
+            output_result_type, output_std_file_name, output_err_file_name = write_framac_artifacts(Output_folder, gfile, stdout_file, stderr_file, result_type)
+        stdout_file.close()
+        stderr_file.close()
+        return output_result_type, output_std_file_name, output_err_file_name, datetime.datetime.now() - starttime
+
+    # create subprocess according to the value of check_STDOUT and check_STDERR
+    FRAMAC_Command = build_framac_command(Output_folder, gfile, time_out, wp_functions)
+    wp_cache_lock = WPCacheLock().acquire()
+    process = create_FRAMAC_subprocess(FRAMAC_Command, Check_STDOUT, Check_STDERR, get_wp_cache_env())
+    logging.info("[CMD] Running `" + ' '.join(FRAMAC_Command) + "`")
     try:
         # join subprocess
         if Check_STDOUT == 1 or Check_STDERR == 1:
-            stdoutdata, stderrdata = process.communicate(timeout=SubprocessTimeout)
-            fleft, fright = gfile.split(".")
-            fright = "." + fright
-            if stdoutdata != b'':
-                result_type = get_result_type(stdoutdata)
-                output_result_type = result_type
-                fleft = fleft.replace("_gen_", "_fstd_")
-                fstd_file_name = fleft + "_" + result_type
-                output_std_file_name = os.path.join(Output_folder, fstd_file_name + ".txt")
-                with open (output_std_file_name, "wb") as stdfile:
-                    #stdfile.write(bytes(str(pattern)+"\n", encoding = "utf8"))
-                    stdfile.write(stdoutdata)
-            if stderrdata != b'':
-                fleft = fleft.replace("_gen_", "_ferr_")
-                output_err_file_name = os.path.join(Output_folder, fleft + ".txt")
-                with open (output_err_file_name, "wb") as errfile:
-                    errfile.write(stderrdata)
+            stdoutdata, stderrdata = communicate_FRAMAC_subprocess(process, SubprocessTimeout, cancel_event)
+            output_result_type, output_std_file_name, output_err_file_name = write_framac_artifacts(Output_folder, gfile, stdoutdata or b'', stderrdata or b'')
         else:
-            process.communicate(timeout=SubprocessTimeout)
+            communicate_FRAMAC_subprocess(process, SubprocessTimeout, cancel_event)
     
     except subprocess.TimeoutExpired:
-        # process.kill()
-        # process.terminate()
-        subprocess.check_call(["sudo", "kill", str(process.pid)])
-        #os.waitpid(process.pid, 0)
-        logging.error("Timeout for subprocess when running frama-c on" + ' '.join(os.path.join(Output_folder, gfile)))
+        kill_FRAMAC_process_group(process)
+        process.communicate()
+        logging.error("Timeout for subprocess when running frama-c on " + target_path)
     
     except Exception as e:
         print("\033[34m\tUnknown Exception" + "\033[0m")
         print(e)
         raise e
+
+    finally:
+        wp_cache_lock.release()
     endtime = datetime.datetime.now()
     solve_time = endtime - starttime
     return output_result_type, output_std_file_name, output_err_file_name, solve_time
+
+
+
+# "Pass_x_y" -> (x, y), (-1, -1) for the other result types
+def get_pass_goal_num(result_type):
+    if result_type is None or not result_type.startswith("Pass_"):
+        return -1, -1
+    _, pgstr, agstr = result_type.split("_")
+    return int(pgstr), int(agstr)
+
+
+def is_full_pass(result_type):
+    pass_goal, all_goal = get_pass_goal_num(result_type)
+    return pass_goal >= 0 and pass_goal == all_goal
+
+
+# verify independent files concurrently, bounded by cores and available memory
+# return {gfile: (output_result_type, output_std_file_name, output_err_file_name, solve_time)} and the wall time;
+# with stop_on_full_pass the remaining runs are cancelled once one file fully passes and are missing from the dict
+def run_framac_on_files(Output_folder, gfile_list, time_out = 8, stop_on_full_pass = False, max_workers = None, wp_functions = None):
+    executor = VerificationExecutor(max_workers=max_workers)
+    stop_when = None
+    if stop_on_full_pass:
+        stop_when = lambda result: is_full_pass(result[0])
+    job_fn = functools.partial(run_framac_with_wp, wp_functions=wp_functions)
+    results_list = executor.run(job_fn, [(Output_folder, gfile, time_out) for gfile in gfile_list], stop_when)
+
+    results = {}
+    for gfile, result in zip(gfile_list, results_list):
+        if result is None or result[0] == "Cancelled":
+            continue
+        results[gfile] = result
+    return results, datetime.timedelta(seconds=executor.wall_time)
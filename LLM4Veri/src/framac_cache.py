@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Content-addressed cache of Frama-C/WP results.
+#
+# A result is keyed by the normalized content of the verified file (and of the
+# local headers it includes), the Frama-C command line and the prover versions.
+# The stored stdout/stderr artifacts have the verified path replaced by a
+# placeholder, so a hit can be replayed for a file living in any output folder.
+
+import os, sys, re
+import time
+import json
+import logging
+import sqlite3
+import hashlib
+import subprocess
+import functools
+from .baselib import *
+from .framac_splice import FRAMAC_SPLICED_SUFFIX
+
+FRAMAC_CACHE_ENABLE = int(os.environ.get("AUTOSPEC_FRAMAC_CACHE", "1"))      # Set 0 to always run frama-c
+FRAMAC_CACHE_MAX_BYTES = int(os.environ.get("AUTOSPEC_FRAMAC_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+FRAMAC_CACHE_TARGET_PLACEHOLDER = b"@@AUTOSPEC_TARGET_FILE@@"
+
+# hit/miss counters of the current process
+FRAMAC_CACHE_STATS = {"hit": 0, "miss": 0, "store": 0, "evict": 0, "saved_ms": 0}
+
+
+def get_framac_cache_dir():
+    return os.environ.get("AUTOSPEC_FRAMAC_CACHE_DIR", get_autospec_cache_dir("framac"))
+
+
+def _connect_framac_cache():
+    db = sqlite3.connect(os.path.join(get_framac_cache_dir(), "index.db"), timeout=60)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, result_type TEXT, stdout BLOB, stderr BLOB, "
+               "solve_time REAL, size INTEGER, created REAL, last_access REAL)")
+    db.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)")
+    return db
+
+
+def _get_tool_version(tool_command):
+    try:
+        ret = subprocess.run(tool_command, capture_output=True, timeout=30)
+        return (ret.stdout + ret.stderr).decode("utf-8", errors="replace").strip()
+    except Exception:
+        return "missing"
+
+
+# the versions only change between processes, so ask the tools once
+@functools.lru_cache(maxsize=None)
+def get_prover_versions():
+    versions = []
+    for tool_command in (["frama-c", "-version"], ["alt-ergo", "-version"], ["z3", "-version"]):
+        versions.append(tool_command[0] + "=" + _get_tool_version(tool_command))
+    return "\n".join(versions)
+
+
+def normalize_source(content):
+    # line endings and trailing spaces do not change goals nor line numbers
+    return "\n".join(line.rstrip() for line in content.replace("\r\n", "\n").split("\n"))
+
+
+def _hash_source_tree(hasher, file_path, visited):
+    abs_path = os.path.abspath(file_path)
+    if abs_path in visited or not os.path.exists(abs_path):
+        return
+    visited.add(abs_path)
+    with open(abs_path, "r", encoding="utf-8", errors="replace") as f:
+        content = f.read()
+    hasher.update(os.path.basename(abs_path).encode("utf-8") + b"\0")
+    hasher.update(normalize_source(content).encode("utf-8") + b"\0")
+    # local headers are part of what frama-c proves
+    for header in re.findall(r'^\s*#\s*include\s+"([^"]+)"', content, re.MULTILINE):
+        _hash_source_tree(hasher, os.path.join(os.path.dirname(abs_path), header), visited)
+
+
+def make_framac_cache_key(FRAMAC_Command, target_path):
+    hasher = hashlib.sha256()
+    _hash_source_tree(hasher, target_path, set())
+    command_args = []
+    for arg in FRAMAC_Command:
+        if arg == target_path:
+            continue
+        if arg.endswith(FRAMAC_SPLICED_SUFFIX) and os.path.exists(arg):
+            # the spliced skeleton lives in the output folder and its line markers name the
+            # candidate: hash its content with the candidate path abstracted, not its path
+            with open(arg, "r", encoding="utf-8", errors="replace") as f:
+                hasher.update(normalize_source(f.read().replace(target_path, FRAMAC_CACHE_TARGET_PLACEHOLDER.decode("utf-8"))).encode("utf-8") + b"\0")
+            arg = FRAMAC_CACHE_TARGET_PLACEHOLDER.decode("utf-8") + FRAMAC_SPLICED_SUFFIX
+        command_args.append(arg)
+    hasher.update(b"\0".join(arg.encode("utf-8") for arg in command_args) + b"\0")
+    hasher.update(get_prover_versions().encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def _bump_stat(db, name, value = 1):
+    FRAMAC_CACHE_STATS[name] += value
+    db.execute("INSERT INTO stats (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + ?", (name, value, value))
+
+
+# return (result_type, stdoutdata, stderrdata, solve_time) or None
+def lookup_framac_result(cache_key, target_path):
+    try:
+        db = _connect_framac_cache()
+        with db:
+            row = db.execute("SELECT result_type, stdout, stderr, solve_time FROM results WHERE key = ?", (cache_key,)).fetchone()
+            if row is None:
+                _bump_stat(db, "miss")
+            else:
+                db.execute("UPDATE results SET last_access = ? WHERE key = ?", (time.time(), cache_key))
+                _bump_stat(db, "hit")
+                _bump_stat(db, "saved_ms", int(row[3] * 1000))
+        db.close()
+    except sqlite3.Error as e:
+        logging.warning("framac cache lookup failed: " + str(e))
+        return None
+    if row is None:
+        return None
+    result_type, stdoutdata, stderrdata, solve_time = row
+    target_bytes = target_path.encode("utf-8")
+    return result_type, stdoutdata.replace(FRAMAC_CACHE_TARGET_PLACEHOLDER, target_bytes), \
+        stderrdata.replace(FRAMAC_CACHE_TARGET_PLACEHOLDER, target_bytes), solve_time
+
+
+def store_framac_result(cache_key, target_path, result_type, stdoutdata, stderrdata, solve_time):
+    target_bytes = target_path.encode("utf-8")
+    stdoutdata = (stdoutdata or b"").replace(target_bytes, FRAMAC_CACHE_TARGET_PLACEHOLDER)
+    stderrdata = (stderrdata or b"").replace(target_bytes, FRAMAC_CACHE_TARGET_PLACEHOLDER)
+    size = len(stdoutdata) + len(stderrdata)
+    now = time.time()
+    try:
+        db = _connect_framac_cache()
+        with db:
+            db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       (cache_key, result_type, stdoutdata, stderrdata, solve_time, size, now, now))
+            _bump_stat(db, "store")
+            evict_framac_cache(db)
+        db.close()
+    except sqlite3.Error as e:
+        logging.warning("framac cache store failed: " + str(e))
+
+
+# drop the least recently used results until the cache fits in FRAMAC_CACHE_MAX_BYTES
+def evict_framac_cache(db, max_bytes = None):
+    if max_bytes is None:
+        max_bytes = FRAMAC_CACHE_MAX_BYTES
+    total_size = db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+    if total_size <= max_bytes:
+        return 0
+    evicted = 0
+    for key, size in db.execute("SELECT key, size FROM results ORDER BY last_access ASC").fetchall():
+        if total_size <= max_bytes:
+            break
+        db.execute("DELETE FROM results WHERE key = ?", (key,))
+        total_size -= size
+        evicted += 1
+    _bump_stat(db, "evict", evicted)
+    return evicted
+
+
+def get_framac_cache_stats():
+    stats = {"process": dict(FRAMAC_CACHE_STATS)}
+    try:
+        db = _connect_framac_cache()
+        stats["total"] = dict(db.execute("SELECT name, value FROM stats").fetchall())
+        stats["entries"], stats["bytes"] = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+        db.close()
+    except sqlite3.Error as e:
+        stats["error"] = str(e)
+    return stats
+
+
+def format_framac_cache_stats():
+    hit = FRAMAC_CACHE_STATS["hit"]
+    miss = FRAMAC_CACHE_STATS["miss"]
+    rate = 100.0 * hit / (hit + miss) if hit + miss > 0 else 0.0
+    return "hit = %d, miss = %d, hit_rate = %.1f%%, saved_solve_time = %.1fs" % (hit, miss, rate, FRAMAC_CACHE_STATS["saved_ms"] / 1000.0)
+
+
+def clear_framac_cache():
+    db = _connect_framac_cache()
+    with db:
+        db.execute("DELETE FROM results")
+        db.execute("DELETE FROM stats")
+    db.execute("VACUUM")
+    db.close()
+
+
+# python3 -m src.framac_cache [stats|clear]
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "clear":
+        clear_framac_cache()
+        print("framac cache cleared:", get_framac_cache_dir())
+    else:
+        print(json.dumps(get_framac_cache_stats(), indent=4))
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Preprocess the task skeleton once, splice every candidate annotation into it.
+#
+# All the candidates of a task are the same question with a different ACSL block at
+# the ">>> INFILL <<<" line. The skeleton (with that line replaced by a sentinel
+# comment) goes through the Frama-C preprocessing once; a candidate is then given to
+# frama-c as the preprocessed .i with its annotation region spliced at the sentinel,
+# so the system headers are not preprocessed again for every run. Line markers are
+# rewritten so that messages and goals still point to the candidate .c file.
+#
+# A saved session (-save/-load) cannot take new ACSL, so the kernel still parses and
+# types the .i; only the preprocessing is shared.
+
+import os, sys, re
+import logging
+import hashlib
+import subprocess
+import functools
+
+FRAMAC_SPLICE_ENABLE = int(os.environ.get("AUTOSPEC_FRAMAC_SPLICE", "1"))      # Set 0 to give frama-c the candidate .c files
+FRAMAC_SPLICE_SENTINEL = "/* AUTOSPEC_SPLICE_POINT */"
+FRAMAC_SPLICE_MACHDEP = "__FC_MACHDEP_X86_64"                                   # frama-c default machdep
+FRAMAC_LINE_MARKER_RE = re.compile(r'^# (\d+) "([^"]*)"(.*)$')
+FRAMAC_SPLICED_SUFFIX = ".spliced.i"
+
+# Output_folder -> skeleton of the current task, see register_splice_skeleton()
+SPLICE_SKELETONS = {}
+# candidate path -> (skeleton key, candidate content hash, spliced .i path)
+SPLICED_INPUTS = {}
+
+
+# same preprocessing as frama-c: comments kept (they carry the ACSL), macro definitions kept, frama-c libc
+@functools.lru_cache(maxsize=None)
+def get_framac_cpp_command():
+    try:
+        share_path = subprocess.run(["frama-c", "-print-share-path"], capture_output=True, timeout=30).stdout.decode("utf-8").strip()
+    except Exception:
+        return None
+    if share_path == "":
+        return None
+    return ["gcc", "-E", "-C", "-dD", "-nostdinc", "-D__FRAMAC__", "-D" + FRAMAC_SPLICE_MACHDEP, "-I" + os.path.join(share_path, "libc")]
+
+
+def _find_marker_line(lines):
+    for i, line in enumerate(lines):
+        if ">>> INFILL <<<" in line:
+            return i
+    return -1
+
+
+# preprocess the skeleton of the candidates that will be written to Output_folder
+def register_splice_skeleton(Output_folder, question):
+    SPLICE_SKELETONS.pop(Output_folder, None)
+    if FRAMAC_SPLICE_ENABLE != 1:
+        return False
+    cpp_command = get_framac_cpp_command()
+    lines = question.split("\n")
+    marker_index = _find_marker_line(lines)
+    if cpp_command is None or marker_index < 0:
+        return False
+
+    skeleton_lines = lines[:marker_index] + [FRAMAC_SPLICE_SENTINEL] + lines[marker_index + 1:]
+    skeleton_name = "autospec_splice_" + hashlib.sha1(question.encode("utf-8")).hexdigest()[:12] + ".c"
+    skeleton_path = os.path.abspath(os.path.join(Output_folder, skeleton_name))
+    with open(skeleton_path, "w") as f:
+        f.write("\n".join(skeleton_lines))
+    try:
+        ret = subprocess.run(cpp_command + ["-I" + os.path.dirname(skeleton_path), skeleton_path], capture_output=True, timeout=60)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logging.warning("[SPLICE] cannot preprocess the skeleton: " + str(e))
+        return False
+    finally:
+        os.remove(skeleton_path)
+    if ret.returncode != 0:
+        logging.warning("[SPLICE] cannot preprocess the skeleton: " + ret.stderr.decode("utf-8", errors="replace"))
+        return False
+
+    preprocessed_lines = ret.stdout.decode("utf-8", errors="replace").split("\n")
+    sentinel_index = -1
+    for i, line in enumerate(preprocessed_lines):
+        if FRAMAC_SPLICE_SENTINEL in line:
+            sentinel_index = i
+            break
+    if sentinel_index < 0 or preprocessed_lines[sentinel_index].strip() != FRAMAC_SPLICE_SENTINEL:
+        return False
+
+    head_text = "\n".join(lines[:marker_index])
+    SPLICE_SKELETONS[Output_folder] = {
+        "key": skeleton_name,
+        # line markers are not read inside a comment, e.g. an infill line within "/*@ ... */"
+        "in_comment": head_text.rfind("/*") > head_text.rfind("*/"),
+        "head": lines[:marker_index],
+        "tail": lines[marker_index + 1:],
+        "skeleton_path": skeleton_path,
+        "preprocessed_head": preprocessed_lines[:sentinel_index],
+        "preprocessed_tail": preprocessed_lines[sentinel_index + 1:],
+        # an annotation using one of them needs the preprocessor (-pp-annot), it cannot be spliced
+        "macros": set(re.findall(r"^\s*#\s*define\s+([A-Za-z_]\w*)", ret.stdout.decode("utf-8", errors="replace"), re.MULTILINE)),
+    }
+    logging.info("[SPLICE] Preprocessed the skeleton of " + Output_folder)
+    return True
+
+
+# line markers of the skeleton name the candidate, shifted by line_delta
+def _rewrite_line_markers(preprocessed_lines, skeleton_path, candidate_path, line_delta):
+    rewritten = []
+    for line in preprocessed_lines:
+        marker = FRAMAC_LINE_MARKER_RE.match(line)
+        if marker is not None and marker.group(2) == skeleton_path:
+            line = '# %d "%s"%s' % (int(marker.group(1)) + line_delta, candidate_path, marker.group(3))
+        rewritten.append(line)
+    return rewritten
+
+
+# the file frama-c should be given for Output_folder/gfile: a spliced .i, or the file itself
+def get_framac_input_path(Output_folder, gfile):
+    candidate_path = os.path.join(Output_folder, gfile)
+    skeleton = SPLICE_SKELETONS.get(Output_folder)
+    if skeleton is None or not os.path.exists(candidate_path):
+        return candidate_path
+    with open(candidate_path, "r") as f:
+        content = f.read()
+    content_hash = hashlib.sha1(content.encode("utf-8")).hexdigest()
+    spliced = SPLICED_INPUTS.get(candidate_path)
+    if spliced is not None and spliced[0] == skeleton["key"] and spliced[1] == content_hash and os.path.exists(spliced[2]):
+        return spliced[2]
+
+    lines = content.split("\n")
+    head = skeleton["head"]
+    tail = skeleton["tail"]
+    if len(lines) < len(head) + len(tail) or lines[:len(head)] != head or lines[len(lines) - len(tail):] != tail:
+        return candidate_path
+    region = lines[len(head):len(lines) - len(tail)]
+    region_text = "\n".join(region)
+    if "#" in region_text or set(re.findall(r"[A-Za-z_]\w*", region_text)) & skeleton["macros"]:
+        return candidate_path
+
+    # the sentinel took one line, the region takes len(region)
+    first_region_line = len(head) + 1
+    if len(region) == 1:
+        region_lines = region
+    elif not skeleton["in_comment"]:
+        region_lines = ['# %d "%s"' % (first_region_line, candidate_path)] + region + ['# %d "%s"' % (first_region_line + len(region), candidate_path)]
+    else:
+        return candidate_path
+    spliced_lines = _rewrite_line_markers(skeleton["preprocessed_head"], skeleton["skeleton_path"], candidate_path, 0) + region_lines + \
+        _rewrite_line_markers(skeleton["preprocessed_tail"], skeleton["skeleton_path"], candidate_path, len(region) - 1)
+    # hidden, so that it is not taken for a generated candidate
+    spliced_path = os.path.join(Output_folder, "." + os.path.splitext(gfile)[0] + FRAMAC_SPLICED_SUFFIX)
+    with open(spliced_path, "w") as f:
+        f.write("\n".join(spliced_lines))
+    SPLICED_INPUTS[candidate_path] = (skeleton["key"], content_hash, spliced_path)
+    return spliced_path
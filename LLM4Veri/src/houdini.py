@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Houdini pruning of the candidate annotations of a file.
+#
+# Every ACSL clause line of the file is a candidate; the kept candidates are an int
+# bitset (bit i is the i-th candidate line). Each round proves the file with the kept
+# candidates and drops at once every candidate whose own goal is not proved, until a
+# round drops nothing: the kept set is then the greatest inductive subset. A round
+# that drops nothing ends the search, so there are at most one round per candidate
+# plus one (plus one more when the last rounds were partitioned).
+#
+# The dropped lines are blanked while iterating so that the goal lines reported by WP
+# keep pointing to the same candidates; they are removed from the file at the end.
+# Large candidate sets are checked as concurrent partitions, one frama-c per owning
+# function and property category (-wp-fct/-wp-prop): all the candidates stay in the
+# file as hypotheses, so the union of the partitions sees the same failures as one
+# run over the file. A round without failure is always confirmed by a whole run.
+
+import os, sys, re
+import logging
+import datetime
+from .framac import *
+
+HOUDINI_PARTITION_MIN_CANDIDATES = 8     # fewer kept candidates are checked by one frama-c run
+# clause -> -wp-prop category of its goals, the first match wins; the other clauses are only checked by whole runs
+HOUDINI_CLAUSE_CATEGORIES = (
+    ("loop invariant ", "@invariant"),
+    ("loop assigns ", "@assigns"),
+    ("loop variant ", "@variant"),
+    ("ensures ", "@ensures"),
+    ("assigns ", "@assigns"),
+)
+# structure of a contract, never dropped on their own
+HOUDINI_NOT_CANDIDATES = ("behavior ", "assumes ", "complete behaviors", "disjoint behaviors", "requires ")
+
+
+# [(line_index, clause, line_text)] of the ACSL clauses of a file, asserts excluded
+# clause is the annotation without its "//@" prefix, used to categorize the goals; line_text
+# is the stripped line as written (prefix and every clause of the line included), the spec
+# that is reported when the line is removed, like simplify_acsl() does
+def find_houdini_candidates(lines):
+    candidates = []
+    in_annotation = False
+    for i, line in enumerate(lines):
+        clause = line.strip()
+        if not in_annotation and clause.startswith("//@"):
+            clause = clause[3:].strip()
+            if clause.endswith(";") and not clause.startswith(HOUDINI_NOT_CANDIDATES) and "assert " not in clause:
+                candidates.append((i, clause, line.strip()))
+            continue
+        if not in_annotation:
+            in_annotation = clause.startswith("/*@") and "*/" not in clause
+            continue
+        if "*/" in clause:
+            in_annotation = False
+            continue
+        if clause.endswith(";") and not clause.startswith(HOUDINI_NOT_CANDIDATES) and "assert " not in clause:
+            candidates.append((i, clause, clause))
+    return candidates
+
+
+def get_clause_category(clause):
+    for prefix, category in HOUDINI_CLAUSE_CATEGORIES:
+        if clause.startswith(prefix):
+            return category
+    return ""
+
+
+def _bit_count(bitset):
+    return bin(bitset).count("1")
+
+
+# the file with the candidates missing from kept replaced by blank lines (remove_dropped: deleted)
+def _write_houdini_file(target_path, lines, candidates, kept, remove_dropped = False):
+    dropped_lines = set(line_index for bit, (line_index, _, _) in enumerate(candidates) if not kept >> bit & 1)
+    with open(target_path, "w") as f:
+        if remove_dropped:
+            f.write("\n".join(line for i, line in enumerate(lines) if i not in dropped_lines))
+        else:
+            f.write("\n".join("" if i in dropped_lines else line for i, line in enumerate(lines)))
+
+
+# bitset of the candidates (among kept) that own an unproved goal
+def _get_failed_candidates(goals, line_to_bit, kept):
+    failed = 0
+    for goal in goals:
+        if not goal.proved and goal.line - 1 in line_to_bit:
+            failed |= 1 << line_to_bit[goal.line - 1]
+    return failed & kept
+
+
+# one partition of a round: the goals of one property category of one function
+# return (result_type, goals) of the run, result_type is "" when it was stopped
+def run_houdini_partition(Output_folder, gfile, time_out, function_name, category, cancel_event = None):
+    parser = WPOutputParser(scoped = True)
+    FRAMAC_Command = build_framac_command(Output_folder, gfile, time_out, [function_name], [category])
+    stdout_file, stderr_file, stop_reason = run_framac_command(FRAMAC_Command, os.path.join(Output_folder, gfile), parser, cancel_event)
+    stdout_file.close()
+    stderr_file.close()
+    if stop_reason in ("cancel", "timeout"):
+        return "", []
+    return parser.result_type, parser.goals
+
+
+# prune the candidates of Output_folder/gfile to their greatest inductive subset
+# output_std_file_name: output of a WP run of the file as it is, used as the first round
+# return (result_type, output_std_file_name, output_err_file_name, solve_time, removed_spec_list) of the last whole run
+def run_houdini(Output_folder, gfile, output_std_file_name = "", time_out = 8, wp_functions = None, max_workers = None):
+    target_path = os.path.join(Output_folder, gfile)
+    with open(target_path, "r") as f:
+        lines = f.read().split("\n")
+    candidates = find_houdini_candidates(lines)
+    line_to_bit = {line_index: bit for bit, (line_index, _, _) in enumerate(candidates)}
+    kept = (1 << len(candidates)) - 1
+    source = "\n".join(lines)
+    partition_of = {}
+    for bit, (line_index, clause, _) in enumerate(candidates):
+        function_name = get_owning_function(source, line_index + 1)
+        category = get_clause_category(clause)
+        if function_name != "" and category != "" and (not wp_functions or function_name in wp_functions):
+            partition_of[bit] = (function_name, category)
+
+    solve_time = datetime.timedelta(0)
+    output_result_type = ""
+    output_err_file_name = ""
+    whole_run = output_std_file_name != ""
+    confirm = False                 # the partitions found no failure, the next round is a whole run
+    goals = load_wp_report(output_std_file_name).goals if whole_run else None
+    max_rounds = 2 * len(candidates) + 2
+    for round_index in range(max_rounds):
+        if goals is None:
+            _write_houdini_file(target_path, lines, candidates, kept)
+            partitions = sorted(set(partition for bit, partition in partition_of.items() if kept >> bit & 1))
+            whole_run = _bit_count(kept) < HOUDINI_PARTITION_MIN_CANDIDATES or len(partitions) < 2 or confirm or round_index == max_rounds - 1
+            if not whole_run:
+                # every partition frama-c would otherwise write the same spliced input at once
+                get_framac_input_path(Output_folder, gfile)
+                executor = VerificationExecutor(max_workers=max_workers)
+                results = executor.run(run_houdini_partition, [(Output_folder, gfile, time_out, function_name, category) for function_name, category in partitions])
+                solve_time = solve_time + datetime.timedelta(seconds=executor.wall_time)
+                if all(result is not None and result[0].startswith(("Pass_", "Fail_")) for result in results):
+                    goals = [goal for result in results for goal in result[1]]
+                else:
+                    whole_run = True
+            if whole_run:
+                output_result_type, output_std_file_name, output_err_file_name, run_time = run_framac_with_wp(Output_folder, gfile, time_out, wp_functions = wp_functions)
+                solve_time = solve_time + run_time
+                if not output_result_type.startswith(("Pass_", "Fail_")) or output_std_file_name == "":
+                    break
+                goals = load_wp_report(output_std_file_name).goals
+        elif output_result_type == "":
+            output_result_type = load_wp_report(output_std_file_name).result_type
+
+        failed = _get_failed_candidates(goals, line_to_bit, kept)
+        logging.info("[HOUDINI] Round " + str(round_index) + (" (whole file)" if whole_run else " (partitioned)") + ": " +
+                     str(_bit_count(failed)) + " of " + str(_bit_count(kept)) + " candidates dropped in " + gfile)
+        # the goals that dropped a candidate, their text is only fetched (load_wp_goal_text) for a debug log
+        if failed != 0 and logging.getLogger().isEnabledFor(logging.DEBUG):
+            for goal in goals:
+                if not goal.proved and goal.line - 1 in line_to_bit and failed >> line_to_bit[goal.line - 1] & 1:
+                    logging.debug("[HOUDINI] " + candidates[line_to_bit[goal.line - 1]][2] + " dropped by:\n" + load_wp_goal_text(Output_folder, gfile, goal))
+        goals = None
+        confirm = failed == 0
+        if failed != 0:
+            kept = kept & ~failed
+        elif whole_run:
+            break
+
+    _write_houdini_file(target_path, lines, candidates, kept, remove_dropped = True)
+    removed_spec_list = [line_text for bit, (_, _, line_text) in enumerate(candidates) if not kept >> bit & 1]
+    return output_result_type, output_std_file_name, output_err_file_name, solve_time, removed_spec_list
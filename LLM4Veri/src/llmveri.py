@@ -8,8 +8,13 @@ import copy
 from itertools import combinations
 from typing import List
 from .framac import *
+from .cfunc import *
 from .baselib import *
 from .simplify_acsl import *
+from .spec_screen import *
+from .houdini import *
+from .candidate_mux import *
+from .prompt_slice import *
 from .prompt.prompt import *
 
 current_path = os.path.dirname(os.path.abspath(__file__))
@@ -18,6 +23,15 @@ from utils.qwencore import *
 
 SHOT_NUM = 3
 N_CHOICES = 8
+PARALLEL_CANDIDATE_VERIFICATION = 1     # Set 1 to verify the behavior candidates (_gen_N.c) concurrently
+PARALLEL_STOP_ON_FULL_PASS = 0          # Set 1 to cancel the other candidates once one of them fully passes
+TASK_SCOPED_VERIFICATION = 1            # Set 1 to prove only the goals of the function owning the current task (whole file at the final assertion check)
+HOUDINI_PRUNING = 1                     # Set 1 to prune the failing candidates to their greatest inductive subset (Houdini) instead of one simplify_acsl pass per WP run
+CLAUSE_SCREENING = 1                    # Set 1 to type-check every generated clause (kernel only, concurrently) before the first WP run
+CANDIDATE_MULTIPLEXING = 1              # Set 1 to verify the candidates of a scoped task as clones of its function in one frama-c run per batch
+STREAMING_LLM_RESPONSE = 1              # Set 1 to stream the replies and type-check their clauses while the model is still generating
+STREAM_MAX_DISTINCT_CLAUSES = int(os.environ.get("AUTOSPEC_STREAM_MAX_CLAUSES", "0"))  # stop the generation at this many distinct clauses, 0 means never
+PROMPT_SLICING = 1                      # Set 1 to send the LLM only the code relevant to the task (its function, callees' contracts, asserting callers, used globals)
 
 
 def determine_veri_clang():
@@ -95,6 +109,7 @@ def query_llm_and_get_verified_result_for_single_file(GPT_File, Output_folder, G
     # record return value
     return_value = False
     total_solve_time = datetime.timedelta(0)
+    resource_usage_start = get_framac_resource_usage()
     # open the file and get strings
     gpt_file_strings = ""
     with open(GPT_File, "r") as f:
@@ -104,8 +119,12 @@ def query_llm_and_get_verified_result_for_single_file(GPT_File, Output_folder, G
     rag_prompt = ''
 
     existing_spec_list = []
+    # index of this LLM query in the run, it selects the sampling seeds
+    query_index = 0
     if GPT_Task == 0: # Our Final Method
         cur_task_id, cur_task, new_infilled_file, existing_spec_list, iteration_times, is_outter_loop = AutoGenInfillFile(GPT_File, Output_folder)
+        # one query per task and iteration, a file has far fewer than 1000 tasks
+        query_index = iteration_times * 1000 + cur_task_id
 
         # continue the alg. based on cur_task
         if cur_task == "loopinv_gen":
@@ -138,17 +157,28 @@ def query_llm_and_get_verified_result_for_single_file(GPT_File, Output_folder, G
         chatveri = BaseChatClass(config=model_config, conversation_list=get_incontext_learning_contents('loop', sys_prompt, rag_prompt))
     else:
         raise Exception("Error: GPT_Task is not correct: " + str(GPT_Task))
+    # the tokens of the file are accounted (and budgeted) under its path
+    chatveri.ledger_tag = os.path.abspath(GPT_File)
         
 
+    # the LLM is asked with the task slice, the replies are filled into the whole question
+    prompt_file_strings = gpt_file_strings
+    if PROMPT_SLICING == 1 and GPT_Task in (1, 2, 3, 4):
+        prompt_file_strings = slice_task_question(gpt_file_strings)
+        if prompt_file_strings != gpt_file_strings:
+            logging.info("[SLICE] Question of %d tokens sliced to %d tokens" % (num_tokens_from_text(gpt_file_strings, model_config.model_name), num_tokens_from_text(prompt_file_strings, model_config.model_name)))
+
     # set user prompt as question
     if shot_num == 0:
         question = verification_prompt_template.replace("<The code I give you>", gpt_file_strings)
+        prompt_question = verification_prompt_template.replace("<The code I give you>", prompt_file_strings)
     elif shot_num >= 1:
         question = gpt_file_strings
+        prompt_question = prompt_file_strings
     else:
         raise Exception("Error: shot_num is not correct: " + str(shot_num))
 
-    logging.info(f"\U0001f47b: {question}\n")
+    logging.info(f"\U0001f47b: {prompt_question}\n")
     
     # query LLMs
     llms_start_time = datetime.datetime.now()
@@ -156,11 +186,29 @@ def query_llm_and_get_verified_result_for_single_file(GPT_File, Output_folder, G
     if temperature_arg >= 1.0:
         temperature_arg = 1.0
     
-    full_reply_content_list, tokens_usage = chatveri.get_respone(
-        question, 
-        temperature_arg=temperature_arg, 
-        n_choices = n_choices
-    )
+    # the clauses of the streamed replies are type-checked as they arrive
+    clause_screener = None
+    if STREAMING_LLM_RESPONSE == 1 and CLAUSE_SCREENING == 1 and GPT_Task in (1, 2, 3, 4):
+        clause_screener = ClauseScreener(Output_folder, question)
+    try:
+        full_reply_content_list, tokens_usage = chatveri.get_respone(
+            prompt_question, 
+            temperature_arg=temperature_arg, 
+            stream_out = STREAMING_LLM_RESPONSE == 1,
+            n_choices = n_choices,
+            on_line = clause_screener.submit if clause_screener is not None else None,
+            max_clauses = STREAM_MAX_DISTINCT_CLAUSES,
+            query_index = query_index
+        )
+    except LLMBudgetExceededError as e:
+        logging.info("[BUDGET] " + str(e))
+        if clause_screener is not None:
+            clause_screener.close()
+        return return_value, datetime.datetime.now() - llms_start_time, total_solve_time, 0
+    except Exception:
+        if clause_screener is not None:
+            clause_screener.close()
+        raise
 
     print("==============================================")
     # print(len(full_reply_content_list))
@@ -210,6 +258,17 @@ def query_llm_and_get_verified_result_for_single_file(GPT_File, Output_folder, G
             elif ">>> INFILL <<<" in each_line:
                 infill_str_prefix = each_line.replace(">>> INFILL <<<", "")
                 break
+
+        # the task only changes the specification of one function, its callees are assumed by their contracts
+        task_wp_functions = None
+        if TASK_SCOPED_VERIFICATION == 1:
+            task_function = get_infill_owning_function(gpt_file_strings)
+            if task_function != "":
+                task_wp_functions = [task_function]
+                logging.info("[SCOPE] Verifying the goals of function " + task_function)
+
+        # the candidates only differ at the infill location, preprocess the rest once
+        register_splice_skeleton(Output_folder, question)
         
         for each_reply in full_reply_content_list:
             saved_file = GPT_File_left + "_gen_" + str(cur_index) + GPT_File_right
@@ -398,7 +457,7 @@ def query_llm_and_get_verified_result_for_single_file(GPT_File, Output_folder, G
                             .replace("\n" + infill_str_prefix + ">>> INFILL <<<\n" + infill_str_prefix, "\n" + infill_str_prefix + each_spec + "\n" + infill_str_prefix)
                             .replace(">>> INFILL <<<", "\n" + infill_str_prefix + each_spec + "\n" + infill_str_prefix)
                         )
-                output_result_type, _, _, solve_time = run_framac_with_wp(Output_folder, loop_assigns_check_file, 3)
+                output_result_type, _, _, solve_time = run_framac_with_wp(Output_folder, loop_assigns_check_file, 3, fail_fast_goal_pattern = FAIL_FAST_ANY_GOAL, wp_functions = task_wp_functions)
                 total_solve_time = solve_time + total_solve_time
                 if "Fail_" in output_result_type or "Invalid" == output_result_type:
                     pass
@@ -421,7 +480,7 @@ def query_llm_and_get_verified_result_for_single_file(GPT_File, Output_folder, G
                                 .replace("\n" + infill_str_prefix + ">>> INFILL <<<\n" + infill_str_prefix, "\n" + infill_str_prefix + each_spec + "\n" + infill_str_prefix)
                                 .replace(">>> INFILL <<<", "\n" + infill_str_prefix + each_loop_assign[0] + "\n" + infill_str_prefix + each_loop_assign[1] + "\n" + infill_str_prefix)
                             )
-                    output_result_type, _, _, solve_time = run_framac_with_wp(Output_folder, loop_assigns_check_file, 3)
+                    output_result_type, _, _, solve_time = run_framac_with_wp(Output_folder, loop_assigns_check_file, 3, fail_fast_goal_pattern = FAIL_FAST_ANY_GOAL, wp_functions = task_wp_functions)
                     total_solve_time = solve_time + total_solve_time
                     if "Fail_" in output_result_type or "Invalid" == output_result_type:
                         pass
@@ -502,18 +561,16 @@ def query_llm_and_get_verified_result_for_single_file(GPT_File, Output_folder, G
         merge_spec_str = merge_spec_str + infill_str_prefix
 
         #write to file
+        merged_str = question \
+            .replace("/* @ >>> INFILL <<< */", "/*@>>> INFILL <<<*/") \
+            .replace("\n" + infill_str_prefix + ">>> INFILL <<<\n" + infill_str_prefix, merge_spec_str) \
+            .replace(">>> INFILL <<<", merge_spec_str)
         with open(os.path.join(Output_folder, merged_file_ori), "w") as f:
-            f.write(question
-                    .replace("/* @ >>> INFILL <<< */", "/*@>>> INFILL <<<*/")
-                    .replace("\n" + infill_str_prefix + ">>> INFILL <<<\n" + infill_str_prefix, merge_spec_str)
-                    .replace(">>> INFILL <<<", merge_spec_str)
-                )
+            f.write(merged_str)
         with open(os.path.join(Output_folder, merged_file), "w") as f:
-            f.write(question
-                    .replace("/* @ >>> INFILL <<< */", "/*@>>> INFILL <<<*/")
-                    .replace("\n" + infill_str_prefix + ">>> INFILL <<<\n" + infill_str_prefix, merge_spec_str)
-                    .replace(">>> INFILL <<<", merge_spec_str)
-                )
+            f.write(merged_str)
+        # the lines of the generated clauses in merged_file, the clause screening only touches these
+        infill_line_indexes = find_infill_spec_lines(question, merged_str, generated_acsl_spec_list)
             
     # 如果gpt_task是normal或loop，则直接保存结果
     else:
@@ -540,6 +597,36 @@ def query_llm_and_get_verified_result_for_single_file(GPT_File, Output_folder, G
         max_pass_goal = 0
         max_all_goal = 0
         best_target_file = ""
+
+        # the first run of every behavior candidate is independent of the others, do them all at once
+        prefetched_results = {}
+        if (GPT_Task == 2 or GPT_Task == 4) and assume_behavior_flag == True and PARALLEL_CANDIDATE_VERIFICATION == 1:
+            if CANDIDATE_MULTIPLEXING == 1 and task_wp_functions is not None:
+                prefetched_results, solve_time = run_multiplexed_candidates(Output_folder, generated_file_list, task_wp_functions[0], stop_on_full_pass = PARALLEL_STOP_ON_FULL_PASS == 1)
+            else:
+                prefetched_results, solve_time = run_framac_on_files(Output_folder, generated_file_list, stop_on_full_pass = PARALLEL_STOP_ON_FULL_PASS == 1, wp_functions = task_wp_functions)
+            total_solve_time = solve_time + total_solve_time
+            if PARALLEL_STOP_ON_FULL_PASS == 1:
+                # the cancelled candidates are not looked at
+                kept_index_list = [i for i in range(len(generated_file_list)) if generated_file_list[i] in prefetched_results]
+                generated_file_list = [generated_file_list[i] for i in kept_index_list]
+                full_reply_content_list = [full_reply_content_list[i] for i in kept_index_list]
+                if generated_file_list == []:
+                    print("No useful specification.")
+                    sys.exit()
+
+        # the ill-formed clauses are all removed at once instead of one Invalid WP run each
+        if CLAUSE_SCREENING == 1 and not ((GPT_Task == 2 or GPT_Task == 4) and assume_behavior_flag == True):
+            prescreened = clause_screener.get_results() if clause_screener is not None else None
+            rejected_clauses = screen_acsl_clauses(Output_folder, merged_file, generated_acsl_spec_list, prescreened = prescreened, line_indexes = infill_line_indexes)
+            if rejected_clauses != []:
+                remove_rejected_clauses(Output_folder, merged_file, rejected_clauses, line_indexes = infill_line_indexes)
+                for each_spec, reason in rejected_clauses:
+                    print("remove ill-formed spec =", each_spec, "(" + reason + ")")
+                    generated_acsl_spec_list.remove(each_spec)
+        if clause_screener is not None:
+            clause_screener.close()
+
         while 1:
             # input("Press Enter to continue...")
             if GPT_Task == 1 or GPT_Task == 3:
@@ -550,73 +637,40 @@ def query_llm_and_get_verified_result_for_single_file(GPT_File, Output_folder, G
                 else:
                     target_file = merged_file
 
-            output_result_type, output_std_file_name, output_err_file_name, solve_time = run_framac_with_wp(Output_folder, target_file)
-            total_solve_time = solve_time + total_solve_time
+            if target_file in prefetched_results:
+                # already verified (and timed) by run_framac_on_files
+                output_result_type, output_std_file_name, output_err_file_name, _ = prefetched_results.pop(target_file)
+            else:
+                output_result_type, output_std_file_name, output_err_file_name, solve_time = run_framac_with_wp(Output_folder, target_file, wp_functions = task_wp_functions)
+                total_solve_time = solve_time + total_solve_time
             if output_result_type == "Invalid":
-                ERROR_TAG = False
                 print("remove invalid spec and re-run.")
-                # open output_std_file_name
-                with open(output_std_file_name, "r") as f:
-                    lines = f.readlines()
-                    error_lead_to_invalid = False
-                    I_REACH_MAX = False
-                    for i in range(len(lines)):
-                        print(f"output_std_file_output line{i}:", i)
-                        print(lines[i], end="")
-                        if "[kernel:annot-error]" in lines[i] and os.path.join(Output_folder, target_file) in lines[i]\
-                            or "[kernel]" in lines[i] and os.path.join(Output_folder, target_file) in lines[i] and ("syntax error:" in lines[i+1] or "Invalid symbol:" in lines[i+1]):
-                            message_in_next_line = lines[i+1]
-                            if "complete or disjoint behaviors clause in a contract with empty list of behavior" in message_in_next_line:
-                                if "disjoint behaviors;" in generated_acsl_spec_list:
-                                    generated_acsl_spec_list.remove("")
-                                elif "complete behaviors;" in generated_acsl_spec_list:
-                                    generated_acsl_spec_list.remove("")
-                                break
-                            else:
-                                _, rightstr = lines[i].split(os.path.join(Output_folder, target_file)+":",1)
-                                lineNumStr, _ = rightstr.split(":",1)
-                                if generated_acsl_spec_list == []:
-                                    break
-                                removed_spec = remove_one_line_from_the_file(os.path.join(Output_folder, target_file), int(lineNumStr))
-                                print("generated_acsl_spec_list =", generated_acsl_spec_list) # (wcventure) delete
-                                print("removed_spec =", removed_spec)
-                                # if the spec is in the inner_loop
-                                if removed_spec not in generated_acsl_spec_list:
-                                    #input("66666666666666666, enter")
-                                    if is_outter_loop == True and (GPT_Task == 1 or GPT_Task ==3):
-                                        remove_from_inner_loop(GPT_File, cur_task_id, removed_spec)
-                                    #input("66666666666666666, enter")
-                                else:# remove spec here
-                                    generated_acsl_spec_list.remove(removed_spec)
-                                os.remove(output_std_file_name)
-                                print(lines[i], end="")
-                                print("  =============> delete invalid spec")
-                                break
-                        elif '[wp] ' in lines[i] and os.path.join(Output_folder, target_file) in lines[i] and "User Error:":
-                            # print("55555")
-                            _, rightstr = lines[i].split(os.path.join(Output_folder, target_file)+":",1)
-                            lineNumStr, _ = rightstr.split(":",1)
-                            if generated_acsl_spec_list == []:
-                                break
-                            removed_spec = remove_one_line_from_the_file(os.path.join(Output_folder, target_file), int(lineNumStr))
-                            if removed_spec in generated_acsl_spec_list:
-                                generated_acsl_spec_list.remove(removed_spec)
-                        # elif os.path.join(Output_folder, target_file) in lines[i] and "User Error:":
-                        else:
-                            ERROR_TAG = True
-                            break
-                        if i == len(lines) - 1:
-                            I_REACH_MAX = True
-                    if I_REACH_MAX == True:
-                        if GPT_Task == 2 or GPT_Task == 4:
-                            error_lead_to_invalid = True
+                target_path = os.path.join(Output_folder, target_file)
+                annot_errors = []
+                if output_std_file_name != "":
+                    annot_errors = load_wp_report(output_std_file_name).get_annot_errors(target_path)
+                for annot_error in annot_errors:
+                    print(annot_error.source, target_path + ":" + str(annot_error.line) + ":", annot_error.message)
+                if annot_errors == [] or generated_acsl_spec_list == []:
+                    # not an annotation error, nothing to remove
+                    if (GPT_Task == 2 or GPT_Task == 4) and assume_behavior_flag == True:
+                        ci = ci + 1
+                        if ci == len(generated_file_list):
                             break
-                    
-                    if error_lead_to_invalid == True:
                         continue
-
-                    if ERROR_TAG == True:
-                        break
+                    break
+                # bottom-up, so that the line numbers of the other errors stay valid
+                for line_num in sorted(set(annot_error.line for annot_error in annot_errors), reverse=True):
+                    removed_spec = remove_one_line_from_the_file(target_path, line_num)
+                    print("generated_acsl_spec_list =", generated_acsl_spec_list) # (wcventure) delete
+                    print("removed_spec =", removed_spec, "  =============> delete invalid spec")
+                    # if the spec is in the inner_loop
+                    if removed_spec not in generated_acsl_spec_list:
+                        if is_outter_loop == True and (GPT_Task == 1 or GPT_Task ==3):
+                            remove_from_inner_loop(GPT_File, cur_task_id, removed_spec)
+                    else:# remove spec here
+                        generated_acsl_spec_list.remove(removed_spec)
+                os.remove(output_std_file_name)
 
                 if generated_acsl_spec_list == []:
                     break
@@ -625,6 +679,33 @@ def query_llm_and_get_verified_result_for_single_file(GPT_File, Output_folder, G
                 if is_outter_loop == False and (GPT_Task == 1 or GPT_Task == 3):
                     break
 
+                if HOUDINI_PRUNING == 1:
+                    output_result_type, output_std_file_name, output_err_file_name, solve_time, removed_spec_list = \
+                        run_houdini(Output_folder, target_file, output_std_file_name, wp_functions = task_wp_functions)
+                    total_solve_time = solve_time + total_solve_time
+                    for each_spec in removed_spec_list:
+                        print("remove spec =", each_spec)
+                        # if the spec is in the inner_loop
+                        if each_spec not in generated_acsl_spec_list:
+                            if is_outter_loop == True and (GPT_Task == 1 or GPT_Task ==3):
+                                remove_from_inner_loop(GPT_File, cur_task_id, each_spec)
+                        else:# remove spec here
+                            generated_acsl_spec_list.remove(each_spec)
+                    # the fixpoint is reached, only an Invalid file goes back to the loop
+                    if output_result_type == "Invalid" and generated_acsl_spec_list != []:
+                        continue
+                    if target_file == merged_file:
+                        break
+                    # a behavior candidate: a pruned file that passes is recorded by the Pass branch
+                    # (without running frama-c again), the other ones move on to the next candidate
+                    if output_result_type != "Invalid" and "Fail_" not in output_result_type:
+                        prefetched_results[target_file] = (output_result_type, output_std_file_name, output_err_file_name, solve_time)
+                        continue
+                    ci = ci + 1
+                    if ci == len(generated_file_list):
+                        break
+                    continue
+
                 removed_spec_list = simplify_acsl(output_std_file_name, os.path.join(Output_folder, target_file))
                 if generated_acsl_spec_list == []:
                     break
@@ -720,11 +801,16 @@ def query_llm_and_get_verified_result_for_single_file(GPT_File, Output_folder, G
         SAVE_PICKLE['tokens_usage'] = SAVE_PICKLE['tokens_usage'] + tokens_usage
 
         # final task: assertion in main()
-        if len(SAVE_PICKLE['TaskList']) == SAVE_PICKLE['CurTaskID']:
+        final_task = len(SAVE_PICKLE['TaskList']) == SAVE_PICKLE['CurTaskID']
+        if final_task:
             file_alter(os.path.join(Output_folder, merged_file), "// @ assert", "//@ assert")
             output_result_type, output_std_file_name, output_err_file_name, solve_time = run_framac_with_wp(Output_folder, merged_file)
             total_solve_time = solve_time + total_solve_time
-            
+
+        # snapshot after the last frama-c run of this call, the final assertion check included
+        SAVE_PICKLE['resource_usage'] = add_framac_resource_usage(SAVE_PICKLE.get('resource_usage'), get_framac_resource_usage(resource_usage_start))
+
+        if final_task:
             # debug
             print(SAVE_PICKLE)
         
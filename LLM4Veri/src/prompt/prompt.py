@@ -1,4 +1,5 @@
 import sys
+import functools
 from .prompt_all import *
 from .prompt_loopinv_gen import *
 from .prompt_loopinv_infill import *
@@ -6,16 +7,15 @@ from .prompt_contract_gen import *
 from .prompt_contract_infill import *
 
 
-def get_incontext_learning_contents(content_type, sys_prompt, rag_shot, shot_num=3):
+# The few-shot prefix of a task type is the same for every task: it is built once and kept
+# immutable, so that every query starts with byte-identical messages and the provider-side
+# prompt cache hits. What changes per task (the RAG context, the question) comes after it.
+@functools.lru_cache(maxsize=None)
+def get_incontext_learning_prefix(content_type, sys_prompt, shot_num=3):
     ret_list = []
-    # rag_prompt = rag_sys_prompt + "\n" + rag_shot
-    rag_prompt = ''
-    # print("--------------------RAG---------------------")
-    # print(rag_prompt)
     if content_type == "loop_inv_gen":
         ret_list = [
             {'role': 'system', 'content': verification_gen_loop_inv},
-            {'role': 'system', 'content': rag_prompt},
             {'role': 'user', 'content': gen_loop_example_1_question},
             {'role': 'assistant', 'content': gen_loop_example_1_answer},
             {'role': 'user', 'content': gen_loop_example_2_question},
@@ -32,7 +32,6 @@ def get_incontext_learning_contents(content_type, sys_prompt, rag_shot, shot_num
     elif content_type == 'contract_gen':
         ret_list = [
             {'role': 'system', 'content': verification_gen_contract},
-            {'role': 'system', 'content': rag_prompt},
             {'role': 'user', 'content': gen_contract_example_1_question},
             {'role': 'assistant', 'content': gen_contract_example_1_answer},
             {'role': 'user', 'content': gen_contract_example_2_question},
@@ -83,19 +82,16 @@ def get_incontext_learning_contents(content_type, sys_prompt, rag_shot, shot_num
             ret_list = [{'role': 'system', 'content': sys_prompt}]
         elif shot_num == 1:
             ret_list = [{'role': 'system', 'content': sys_prompt},
-                        {'role': 'system', 'content': rag_prompt},
                         {'role': 'user', 'content': first_shot_example_question},
                         {'role': 'assistant', 'content': first_shot_example_answer}]
         elif shot_num == 2:
             ret_list = [{'role': 'system', 'content': sys_prompt},
-                        {'role': 'system', 'content': rag_prompt},
                         {'role': 'user', 'content': first_shot_example_question},
                         {'role': 'assistant', 'content': first_shot_example_answer},
                         {'role': 'user', 'content': second_shot_example_question},
                         {'role': 'assistant', 'content': second_shot_example_answer}]
         elif shot_num == 3:
             ret_list = [{'role': 'system', 'content': sys_prompt},
-                        {'role': 'system', 'content': rag_prompt},
                         {'role': 'user', 'content': first_shot_example_question},
                         {'role': 'assistant', 'content': first_shot_example_answer},
                         {'role': 'user', 'content': second_shot_example_question},
@@ -108,7 +104,6 @@ def get_incontext_learning_contents(content_type, sys_prompt, rag_shot, shot_num
     elif content_type == 'loop':
         ret_list = [
             {'role': 'system', 'content': sys_prompt},
-            {'role': 'system', 'content': rag_prompt},
             {'role': 'user', 'content': third_shot_example_question},
             {'role': 'assistant', 'content': third_shot_example_answer},
             {'role': 'user', 'content': loop_example_1_question},
@@ -118,5 +113,17 @@ def get_incontext_learning_contents(content_type, sys_prompt, rag_shot, shot_num
     else:
         pass
     
+    return tuple((message['role'], message['content']) for message in ret_list)
+
+
+def get_incontext_learning_contents(content_type, sys_prompt, rag_shot, shot_num=3):
+    # rag_prompt = rag_sys_prompt + "\n" + rag_shot
+    rag_prompt = ''
+    # print("--------------------RAG---------------------")
+    # print(rag_prompt)
+    # fresh dicts: the cached prefix itself is never appended to nor modified
+    ret_list = [{'role': role, 'content': content} for role, content in get_incontext_learning_prefix(content_type, sys_prompt, shot_num)]
+    if rag_prompt != '':
+        ret_list.append({'role': 'system', 'content': rag_prompt})
     return ret_list
     
\ No newline at end of file
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Task-focused slicing of the question sent to the LLM.
+#
+# A task only asks for the specification at one ">>> INFILL <<<" location, so the
+# prompt does not need the whole (possibly merged, inter-modular) file. The slice keeps:
+#   - the function owning the infill location, with its contract;
+#   - the callers of that function (transitively) when they carry assertions, since
+#     the specification has to support those downstream "//@ assert"s;
+#   - the callees of the kept functions as prototypes with their (verified) contracts;
+#   - the preprocessor lines, the global ACSL annotations and the top-level
+#     declarations (globals, types, prototypes) that the kept code refers to.
+# Only the prompt is sliced: the replies are still filled into the full question, so
+# the candidates are verified in the whole file. Like cfunc.py this is line based and
+# not a C parser; when the slice would not help (or loses the infill line) the full
+# question is used.
+
+import re
+from .cfunc import *
+
+C_IDENTIFIER_ALL_RE = re.compile(r"[A-Za-z_]\w*")
+C_CALL_RE = re.compile(r"\b([A-Za-z_]\w*)\s*\(")
+C_KEYWORDS = frozenset((
+    "auto", "break", "case", "char", "const", "continue", "default", "do", "double", "else", "enum", "extern",
+    "float", "for", "goto", "if", "inline", "int", "long", "register", "restrict", "return", "short", "signed",
+    "sizeof", "static", "struct", "switch", "typedef", "union", "unsigned", "void", "volatile", "while", "_Bool",
+))
+
+
+# 0-based [first_line, last_line] of a function definition, from its contract (the
+# annotation right above it, blank lines allowed) to its closing brace
+def _get_function_item_lines(lines, blanked_lines, start_line, end_line):
+    first_line = start_line - 1
+    # "int\nfoo(int n) {": the return type is on the lines above the name
+    while first_line > 0 and blanked_lines[first_line - 1].strip() != "" and not blanked_lines[first_line - 1].lstrip().startswith("#") \
+            and not blanked_lines[first_line - 1].rstrip().endswith((";", "}", "{")):
+        first_line -= 1
+    above = first_line
+    while above > 0 and lines[above - 1].strip() == "":
+        above -= 1
+    if above > 0 and blanked_lines[above - 1].strip() == "" and lines[above - 1].rstrip().endswith("*/"):
+        head_text = "\n".join(lines[:above])
+        first_line = head_text[:head_text.rfind("/*")].count("\n")
+    return first_line, end_line - 1
+
+
+# "int foo(int n) {...}" -> "int foo(int n);", the contract lines above are kept
+def _get_function_prototype(lines, blanked_lines, first_line, start_line):
+    name_pos = sum(len(line) + 1 for line in lines[first_line:start_line - 1])
+    brace_pos = "\n".join(blanked_lines[first_line:]).find("{", name_pos)
+    return "\n".join(lines[first_line:])[:brace_pos].rstrip() + ";"
+
+
+def _get_called_names(blanked_text, function_names):
+    return set(name for name in C_CALL_RE.findall(blanked_text) if name in function_names)
+
+
+# top-level chunks outside the function definitions: [(first_line, last_line, always_kept)], 0-based
+# a declaration takes the comments right above it; preprocessor lines and standalone
+# ACSL annotations (predicates, axiomatics, ...) are always kept, plain comments never
+def _get_top_level_chunks(lines, blanked_lines, item_of_line):
+    chunks = []
+    comment_start = -1
+    chunk_start = -1
+    depth = 0
+    for i, (line, blanked_line) in enumerate(zip(lines, blanked_lines)):
+        if item_of_line[i] is not None:
+            comment_start = chunk_start = -1
+            continue
+        if chunk_start < 0:
+            if line.strip() == "":
+                if comment_start >= 0:
+                    comment_text = "\n".join(lines[comment_start:i])
+                    chunks.append((comment_start, i - 1, "/*@" in comment_text or "//@" in comment_text))
+                comment_start = -1
+                continue
+            if blanked_line.strip() == "":
+                if comment_start < 0:
+                    comment_start = i
+                continue
+            if blanked_line.lstrip().startswith("#"):
+                chunks.append((i if comment_start < 0 else comment_start, i, True))
+                comment_start = -1
+                continue
+            chunk_start = i if comment_start < 0 else comment_start
+            comment_start = -1
+            depth = 0
+        depth += blanked_line.count("{") - blanked_line.count("}")
+        if depth <= 0 and blanked_line.rstrip().endswith((";", "}")):
+            chunks.append((chunk_start, i, False))
+            chunk_start = -1
+    if comment_start >= 0:
+        comment_text = "\n".join(lines[comment_start:])
+        chunks.append((comment_start, len(lines) - 1, "/*@" in comment_text or "//@" in comment_text))
+    elif chunk_start >= 0:
+        chunks.append((chunk_start, len(lines) - 1, False))
+    return chunks
+
+
+def _get_identifiers(text):
+    return set(C_IDENTIFIER_ALL_RE.findall(text)) - C_KEYWORDS
+
+
+# the names a top-level declaration introduces: parameter names and struct fields
+# (inside the parentheses and braces) are left out, enumerators are not
+def _get_declared_identifiers(blanked_text):
+    nested = r"\([^()]*\)" if re.search(r"\benum\b", blanked_text) else r"\([^()]*\)|\{[^{}]*\}"
+    stripped = None
+    while stripped != blanked_text:
+        stripped, blanked_text = blanked_text, re.sub(nested, " ", blanked_text)
+    return _get_identifiers(blanked_text)
+
+
+# the sliced question of a task file, or the question itself when it cannot be sliced
+def slice_task_question(question):
+    task_function = get_infill_owning_function(question)
+    if task_function == "":
+        return question
+    lines = question.split("\n")
+    blanked_lines = blank_c_comments_and_literals(question).split("\n")
+    functions = {}
+    item_of_line = [None] * len(lines)
+    for name, start_line, end_line in find_function_definitions(question):
+        first_line, last_line = _get_function_item_lines(lines, blanked_lines, start_line, end_line)
+        for i in range(first_line, last_line + 1):
+            item_of_line[i] = name
+        # several definitions of a name (merged inputs): only the first one is sliced
+        if name not in functions:
+            functions[name] = (start_line, first_line, last_line)
+    if task_function not in functions:
+        return question
+
+    calls = {}
+    for name, (start_line, first_line, last_line) in functions.items():
+        calls[name] = _get_called_names("\n".join(blanked_lines[start_line - 1:last_line + 1]), functions)
+
+    # the task function and the callers whose assertions depend on it
+    callers = set()
+    pending = [task_function]
+    while pending:
+        callee = pending.pop()
+        for name in functions:
+            if callee in calls[name] and name not in callers and name != task_function:
+                callers.add(name)
+                pending.append(name)
+    full_functions = {task_function}
+    if any("assert" in "\n".join(lines[functions[name][1]:functions[name][2] + 1]) for name in callers):
+        full_functions |= callers
+    prototype_functions = set().union(*(calls[name] for name in full_functions)) - full_functions
+
+    pieces = []
+    for name in full_functions:
+        start_line, first_line, last_line = functions[name]
+        pieces.append((first_line, last_line, "\n".join(lines[first_line:last_line + 1])))
+    for name in prototype_functions:
+        start_line, first_line, last_line = functions[name]
+        pieces.append((first_line, last_line, _get_function_prototype(lines, blanked_lines, first_line, start_line)))
+
+    # the top-level declarations referred to by the kept code, up to a fixpoint
+    used_identifiers = _get_identifiers("\n".join(text for first_line, last_line, text in pieces))
+    chunks = _get_top_level_chunks(lines, blanked_lines, item_of_line)
+    kept_chunks = set(i for i, (first_line, last_line, always_kept) in enumerate(chunks) if always_kept)
+    changed = True
+    while changed:
+        changed = False
+        for i, (first_line, last_line, always_kept) in enumerate(chunks):
+            if i in kept_chunks:
+                continue
+            chunk_identifiers = _get_declared_identifiers("\n".join(blanked_lines[first_line:last_line + 1]))
+            if chunk_identifiers & used_identifiers:
+                kept_chunks.add(i)
+                used_identifiers |= _get_identifiers("\n".join(lines[first_line:last_line + 1]))
+                changed = True
+    for i in kept_chunks:
+        first_line, last_line, always_kept = chunks[i]
+        pieces.append((first_line, last_line, "\n".join(lines[first_line:last_line + 1])))
+
+    # the pieces stay in the file order, a blank line where something was left out
+    sliced_question = ""
+    next_line = 0
+    for first_line, last_line, text in sorted(pieces):
+        sliced_question += ("\n" if first_line == next_line or sliced_question == "" else "\n\n") + text
+        next_line = last_line + 1
+    sliced_question = sliced_question.lstrip("\n") + "\n"
+    if ">>> INFILL <<<" not in sliced_question or len(sliced_question) >= len(question):
+        return question
+    return sliced_question
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Per goal kind prover statistics.
+#
+# Every live frama-c run records, for each goal that reached the SMT provers, which
+# prover returned Valid and how long it took. When several provers raced on a goal,
+# the fastest Valid one wins the race (races that nobody wins are not counted). select_provers() sends the goals of a kind to
+# the prover that wins (almost) all the races of that kind, and keeps the race for
+# the kinds without enough history.
+#
+# The same runs also record the prover time spent on the goals of every function, the
+# historical cost that balances the goal shards of a file (framac.run_framac_sharded).
+
+import os, sys, re
+import logging
+import sqlite3
+from .baselib import *
+
+PROVER_PORTFOLIO_ENABLE = int(os.environ.get("AUTOSPEC_PROVER_PORTFOLIO", "1"))     # Set 0 to always race all the provers
+PROVER_PORTFOLIO_MIN_RACES = 20         # races of a goal kind before a single prover is trusted with it
+PROVER_PORTFOLIO_MIN_WIN_RATE = 0.9     # share of the races the prover must have won
+
+
+def get_prover_portfolio_db():
+    return os.environ.get("AUTOSPEC_PROVER_PORTFOLIO_DB", os.path.join(get_autospec_cache_dir("provers"), "stats.db"))
+
+
+def _connect_prover_portfolio():
+    db = sqlite3.connect(get_prover_portfolio_db(), timeout=60)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("CREATE TABLE IF NOT EXISTS goal_kind_stats (kind TEXT, prover TEXT, attempts INTEGER, valid INTEGER, "
+               "races INTEGER, wins INTEGER, total_ms INTEGER, PRIMARY KEY (kind, prover))")
+    db.execute("CREATE TABLE IF NOT EXISTS function_cost (file TEXT, function TEXT, runs INTEGER, total_ms INTEGER, "
+               "PRIMARY KEY (file, function))")
+    return db
+
+
+# the candidates, merged files and spliced inputs of a question share their history
+# e.g. "/out/.foo_gen_3.spliced.i" -> "foo"
+def get_function_cost_file_key(target_path):
+    stem = os.path.basename(target_path).lstrip(".").split(".")[0]
+    return re.sub(r"(_gen_\d+|_merged_ori|_merged|_screen_\d+)$", "", stem)
+
+
+# goals: WPGoal list of one run, the slowest prover of a goal is its cost
+def record_function_costs(target_path, goals):
+    costs = {}
+    for goal in goals:
+        if goal.function == "":
+            continue
+        costs[goal.function] = costs.get(goal.function, 0) + goal.get_time_ms()
+    if costs == {}:
+        return
+    file_key = get_function_cost_file_key(target_path)
+    try:
+        db = _connect_prover_portfolio()
+        with db:
+            for function, total_ms in costs.items():
+                db.execute("INSERT INTO function_cost VALUES (?, ?, 1, ?) ON CONFLICT(file, function) DO UPDATE SET "
+                           "runs = runs + 1, total_ms = total_ms + ?", (file_key, function, total_ms, total_ms))
+        db.close()
+    except sqlite3.Error as e:
+        logging.warning("cannot record function costs: " + str(e))
+
+
+# {function: mean prover ms per run} recorded for the question of target_path
+def load_function_costs(target_path):
+    try:
+        db = _connect_prover_portfolio()
+        rows = db.execute("SELECT function, runs, total_ms FROM function_cost WHERE file = ?", (get_function_cost_file_key(target_path),)).fetchall()
+        db.close()
+    except sqlite3.Error as e:
+        logging.warning("cannot load function costs: " + str(e))
+        return {}
+    return {function: total_ms / runs for function, runs, total_ms in rows if runs > 0}
+
+
+# goals: WPGoal list of one run
+def record_prover_results(goals):
+    if PROVER_PORTFOLIO_ENABLE != 1:
+        return
+    updates = {}
+    for goal in goals:
+        results = {prover: result for prover, result in goal.provers.items() if prover != "Qed"}
+        # goals closed by Qed never reach the provers
+        if results == {} or goal.provers.get("Qed", ("", 0))[0] == "Valid":
+            continue
+        winner = ""
+        if len(results) > 1:
+            valid_results = [(time_ms, prover) for prover, (status, time_ms) in results.items() if status == "Valid"]
+            if valid_results != []:
+                winner = min(valid_results)[1]
+        for prover, (status, time_ms) in results.items():
+            attempts, valid, races, wins, total_ms = updates.get((goal.kind, prover), (0, 0, 0, 0, 0))
+            updates[(goal.kind, prover)] = (attempts + 1, valid + (status == "Valid"), races + (winner != ""),
+                                               wins + (prover == winner), total_ms + time_ms)
+    if updates == {}:
+        return
+    try:
+        db = _connect_prover_portfolio()
+        with db:
+            for (kind, prover), (attempts, valid, races, wins, total_ms) in updates.items():
+                db.execute("INSERT INTO goal_kind_stats VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(kind, prover) DO UPDATE SET "
+                           "attempts = attempts + ?, valid = valid + ?, races = races + ?, wins = wins + ?, total_ms = total_ms + ?",
+                           (kind, prover, attempts, valid, races, wins, total_ms, attempts, valid, races, wins, total_ms))
+        db.close()
+    except sqlite3.Error as e:
+        logging.warning("cannot record prover statistics: " + str(e))
+
+
+def load_prover_portfolio_stats():
+    try:
+        db = _connect_prover_portfolio()
+        rows = db.execute("SELECT kind, prover, attempts, valid, races, wins, total_ms FROM goal_kind_stats ORDER BY kind, prover").fetchall()
+        db.close()
+    except sqlite3.Error as e:
+        logging.warning("cannot load prover statistics: " + str(e))
+        return {}
+    stats = {}
+    for kind, prover, attempts, valid, races, wins, total_ms in rows:
+        stats.setdefault(kind, {})[prover] = {"attempts": attempts, "valid": valid, "races": races, "wins": wins, "total_ms": total_ms}
+    return stats
+
+
+# the prover that wins the races of a goal kind, "" while it is not clear
+def get_kind_winner(kind_stats):
+    best_prover = ""
+    best_wins = -1
+    races = 0
+    for prover, prover_stats in kind_stats.items():
+        races = max(races, prover_stats["races"])
+        if prover_stats["wins"] > best_wins:
+            best_prover = prover
+            best_wins = prover_stats["wins"]
+    if races < PROVER_PORTFOLIO_MIN_RACES or best_wins < PROVER_PORTFOLIO_MIN_WIN_RATE * races:
+        return ""
+    return best_prover
+
+
+# -wp-prover value for goals of these kinds, e.g. "Alt-Ergo,Z3" -> "Z3" when Z3 wins all of them
+def select_provers(goal_kinds, provers):
+    prover_list = provers.split(",")
+    if PROVER_PORTFOLIO_ENABLE != 1 or len(prover_list) < 2 or goal_kinds == []:
+        return provers
+    stats = load_prover_portfolio_stats()
+    selected = set()
+    for kind in set(goal_kinds):
+        winner = get_kind_winner(stats.get(kind, {}))
+        if winner not in prover_list:
+            return provers
+        selected.add(winner)
+    return ",".join(prover for prover in prover_list if prover in selected)
+
+
+def print_prover_portfolio_stats():
+    stats = load_prover_portfolio_stats()
+    print("statistics: ", get_prover_portfolio_db())
+    for kind, kind_stats in stats.items():
+        winner = get_kind_winner(kind_stats)
+        print(kind + ("  -> " + winner if winner != "" else "  -> race"))
+        for prover, prover_stats in kind_stats.items():
+            mean_ms = prover_stats["total_ms"] / prover_stats["attempts"] if prover_stats["attempts"] > 0 else 0
+            print("    %-12s attempts = %6d  valid = %6d  wins = %6d / %6d  mean = %8.1fms" % (
+                prover, prover_stats["attempts"], prover_stats["valid"], prover_stats["wins"], prover_stats["races"], mean_ms))
+
+
+# python3 -m src.prover_portfolio [stats|clear]
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "clear":
+        db = _connect_prover_portfolio()
+        with db:
+            db.execute("DELETE FROM goal_kind_stats")
+            db.execute("DELETE FROM function_cost")
+        db.close()
+        print("prover statistics cleared:", get_prover_portfolio_db())
+    else:
+        print_prover_portfolio_stats()
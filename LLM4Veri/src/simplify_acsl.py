@@ -1,4 +1,18 @@
 import os, sys, re
+from .wp_report import *
+from .framac import load_wp_goal_text
+
+
+# an "assigns \nothing" goal: described "Assigns nothing" by -wp-print; a compact goal only has
+# its name (typed_<f>_assigns...), its line usually holds the clause, otherwise its text is fetched
+def is_assigns_nothing_goal(goal, merged_lines, merged_file):
+    if goal.kind != "assigns":
+        return False
+    if goal.description == "Assigns nothing":
+        return True
+    if 0 < goal.line <= len(merged_lines) and "assigns \\nothing" in merged_lines[goal.line - 1]:
+        return True
+    return goal.name != "" and "Assigns nothing" in load_wp_goal_text(os.path.dirname(merged_file), os.path.basename(merged_file), goal)
 
 # ===== func 'simplify_acsl' start =====
 def simplify_acsl(output_std_file_name, merged_file):
@@ -6,83 +20,39 @@ def simplify_acsl(output_std_file_name, merged_file):
     fdict_list = []
     # create a list to store the information of all the removed specs
     removed_spec_list = []
-    # open the file and read the content into a list
-    with open(output_std_file_name, 'r') as f:
-        content = f.readlines()
-        # iterate over each line in the content list
-        for line_index in range(len(content)):
-            # if the line contains the goal name, we check if it is a failed goal
-            if "file " + merged_file in content[line_index] or "Goal Assigns " in content[line_index]:
-                # two flags to indicate if the goal is proved true or proved false
-                prove_true_flag = False
-                prove_false_flag = False
-                # the line index of the current line
-                tmp_index = line_index
-                # iterate over each line until we reach the end of the file
-                while tmp_index + 1 < len(content):
-                    # get the content of the next line
-                    next_line_content = content[tmp_index+1]
-                    # if the next line contains "Prove: true", the goal is proved true
-                    if "Prove: true." in next_line_content or ("Prover " in next_line_content and "returns Valid (" in next_line_content):
-                        prove_true_flag = True
-                        break
-                    # if the next line contains "Prove: false", the goal is proved false
-                    elif "Prove: false." in next_line_content or ("Prover " in next_line_content and "returns Timeout (" in next_line_content):
-                        #print(next_line_content)
-                        prove_false_flag = True
-                    # if the next line contains "----------", we reach the end of the file
-                    elif "----------" in next_line_content:
-                        break
-                    # if the next line does not contain anything useful, we continue
-                    else:
-                        pass
-                    # move to the next line
-                    tmp_index = tmp_index + 1
-
-                # if the goal is proved true, we continue to the next goal
-                if prove_true_flag:
-                    continue
-
-                # if the goal is proved false, we extract the goal name and line number
-                if prove_false_flag:
-                    if "Goal Assigns " in content[line_index]:
-                        merged_content = content[line_index].strip() + " " + content[line_index + 1].strip()
-                        # print(merged_content)
-                        try:
-                            goal = "Assigns"
-                            [(_, linestr, fnstr, linestr2)] = re.findall(r"Goal Assigns (.*), line (.*) in '(.*)' .*: Effect at line (.*)", merged_content)
-                        except:
-                            try:
-                                [(goal, fnstr, linestr)] = re.findall(r"Goal (.*) in '(.*)' .*: Effect at line (.*)", merged_content)
-                            except:
-                                [(goal, fnstr, linestr)] = re.findall(r"Goal (.*) in (.*): Effect at line (.*)", merged_content)
-                    elif "Goal Instance of 'Pre-condition" in content[line_index]:
-                        print("\n@@@@@@@@@@@@@@@@@@@@@")
-                        print(content[line_index])
-                        print("RUNNING simplify_acsl loc 62 branch")
-                        break
-                    elif "Goal Assertion 'missing_return'" in content[line_index]:
-                        print("\n@@@@@@@@@@@@@@@@@@@@@")
-                        print(content[line_index])
-                        sys.exit(-2)
-                    else:
-                        [(goal, linestr, fnstr)] = re.findall(r'Goal (.*)\(file .*.c, (.*)\)(.*):', content[line_index])
-                    goal = goal.strip()
-                    if ")" in linestr:
-                        linestr = linestr.split(")")[0]
-                    lineint = int(linestr.replace("line ", ""))
-                    if fnstr != '' and "in '" in fnstr:
-                        fnstr = fnstr.replace("in '", "").replace("'","")
-                    # print({"goal": goal, "line": lineint, "fn": fnstr}) # wcventure
-                    fdict_list.append({"goal": goal, "line": lineint, "fn": fnstr})
+    # the goals of the frama-c run, with their prover results
+    report = load_wp_report(output_std_file_name)
+    with open(merged_file, 'r') as f:
+        merged_lines = f.readlines()
+    for goal in report.goals:
+        # the goals of the merged file, and the assigns goals
+        if goal.file != merged_file and goal.kind != "assigns":
+            continue
+        # a goal proved by Qed or by one of the provers is kept
+        if not goal.is_failed():
+            continue
+        if goal.kind == "requires":
+            print("\n@@@@@@@@@@@@@@@@@@@@@")
+            print("Goal " + goal.description)
+            if goal.name != "":
+                print(load_wp_goal_text(os.path.dirname(merged_file), os.path.basename(merged_file), goal))
+            print("RUNNING simplify_acsl loc 62 branch")
+            break
+        elif "missing_return" in goal.description:
+            print("\n@@@@@@@@@@@@@@@@@@@@@")
+            print("Goal " + goal.description)
+            sys.exit(-2)
+        # print({"goal": goal.description, "line": goal.line, "fn": goal.function}) # wcventure
+        fdict_list.append({"goal": goal.description, "kind": goal.kind, "line": goal.line, "fn": goal.function,
+                           "assigns_nothing": is_assigns_nothing_goal(goal, merged_lines, merged_file)})
                     
     # if fdict_list's goal are all assign
     all_assign_flag = True
     for i in range(0, len(fdict_list)):
-        if not "Assigns " in fdict_list[i]['goal']:
+        if fdict_list[i]['kind'] != "assigns":
             all_assign_flag = False
         else:
-            if fdict_list[i]['goal'] == "Assigns nothing":
+            if fdict_list[i]['assigns_nothing']:
                 print("2222222222222222222222222")
                 removed_spec_list = ["assigns \\nothing;"]
                 fdict_list[i]['line'] = 0
@@ -102,7 +72,7 @@ def simplify_acsl(output_std_file_name, merged_file):
         # For each dictionary in the list of dictionaries
         for each_dict in fdict_list:
             # Replace the line in the file that is specified in the dictionary with a newline
-            if "Assigns nothing" in each_dict['goal']:
+            if each_dict['assigns_nothing']:
                 for i in range(0, len(content)):
                     if "assigns \\nothing;" in content[i]:
                         content[i] = "//\n"
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Kernel-only screening of the generated ACSL clauses.
+#
+# An ill-typed or ill-scoped clause makes the whole frama-c -wp run Invalid, and the
+# Invalid branch of llmveri.py then removes one clause per WP run. Here every clause
+# is instead parsed and typed on its own: one variant of the file per clause, where
+# the other generated clauses are blanked (line numbers do not move), checked by a
+# frama-c run without -wp. The variants run concurrently on a VerificationExecutor,
+# and the clauses whose own line is reported by the kernel are rejected in one batch.
+# With a streamed LLM response, a ClauseScreener checks every clause line as soon as
+# it arrives, in the task question, while the model is still generating.
+
+import os, sys, re
+import logging
+import threading
+import concurrent.futures
+from .framac import *
+
+def build_framac_kernel_command(Output_folder, gfile):
+    return ["frama-c", get_framac_input_path(Output_folder, gfile)]
+
+
+# the annotation errors of one variant: [WPAnnotError], [] when it parses and types
+def check_framac_kernel(Output_folder, gfile, cancel_event = None):
+    target_path = os.path.join(Output_folder, gfile)
+    FRAMAC_Command = build_framac_kernel_command(Output_folder, gfile)
+    parser = WPOutputParser()
+    stdout_file, stderr_file, stop_reason = run_framac_command(FRAMAC_Command, target_path, parser, cancel_event)
+    stdout_file.close()
+    stderr_file.close()
+    if stop_reason in ("cancel", "timeout"):
+        return []
+    return parser.report().annot_errors
+
+
+# 0-based indexes of the lines of merged_str (question with its infill location replaced by the
+# clauses of spec_list) that hold one of these clauses; the same clause elsewhere in the file
+# (another loop, an already verified function) is not part of them
+def find_infill_spec_lines(question, merged_str, spec_list):
+    question_lines = question.split("\n")
+    merged_lines = merged_str.split("\n")
+    infill_line = next((i for i, line in enumerate(question_lines) if ">>> INFILL <<<" in line), -1)
+    if infill_line < 0:
+        return []
+    spec_set = set(each_spec.strip() for each_spec in spec_list if each_spec.strip() != "")
+    last_line = infill_line + len(merged_lines) - len(question_lines)
+    return [i for i in range(infill_line, min(last_line, len(merged_lines) - 1) + 1) if merged_lines[i].strip() in spec_set]
+
+
+# return [(clause, reason)] for the clauses of spec_list that frama-c cannot parse or type in Output_folder/gfile
+# only single-line clauses ("...;") are screened, the others are left to the WP run;
+# prescreened ({clause: reason or None}, see ClauseScreener) gives the clauses already checked;
+# line_indexes (see find_infill_spec_lines) restricts the screened lines, None for the whole file
+def screen_acsl_clauses(Output_folder, gfile, spec_list, max_workers = None, prescreened = None, line_indexes = None):
+    target_path = os.path.join(Output_folder, gfile)
+    with open(target_path, "r") as f:
+        lines = f.read().split("\n")
+    prescreened = prescreened or {}
+    prescreened_rejections = []
+    clause_of = {}
+    for each_spec in spec_list:
+        if each_spec.strip() in prescreened:
+            if prescreened[each_spec.strip()] is not None and each_spec not in [clause for clause, _ in prescreened_rejections]:
+                prescreened_rejections.append((each_spec, prescreened[each_spec.strip()]))
+        elif each_spec.strip().endswith(";"):
+            clause_of.setdefault(each_spec.strip(), each_spec)
+    clause_line_indexes = [i for i, line in enumerate(lines) if line.strip() in clause_of and (line_indexes is None or i in line_indexes)]
+    clause_line_set = set(clause_line_indexes)
+    if clause_line_indexes == []:
+        return prescreened_rejections
+
+    # one hidden variant per clause line, the other clause lines are blanked
+    fleft, fright = os.path.splitext(gfile)
+    variant_list = []
+    for clause_index, line_index in enumerate(clause_line_indexes):
+        variant_file = "." + fleft + "_screen_" + str(clause_index) + fright
+        variant_lines = ["" if i in clause_line_set and i != line_index else line for i, line in enumerate(lines)]
+        with open(os.path.join(Output_folder, variant_file), "w") as f:
+            f.write("\n".join(variant_lines))
+        variant_list.append((variant_file, line_index, get_framac_input_path(Output_folder, variant_file)))
+
+    executor = VerificationExecutor(max_workers=max_workers)
+    try:
+        results = executor.run(check_framac_kernel, [(Output_folder, variant_file) for variant_file, _, _ in variant_list])
+    finally:
+        for variant_file, _, input_path in variant_list:
+            for path in set([os.path.join(Output_folder, variant_file), input_path]):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    rejected_clauses = list(prescreened_rejections)
+    for (variant_file, line_index, input_path), errors in zip(variant_list, results):
+        clause = clause_of[lines[line_index].strip()]
+        if errors is None or any(clause == rejected_clause for rejected_clause, _ in rejected_clauses):
+            continue
+        # an error located elsewhere (e.g. in the question itself) does not condemn the clause
+        for annot_error in errors:
+            if annot_error.line == line_index + 1 and annot_error.file in (os.path.join(Output_folder, variant_file), input_path):
+                rejected_clauses.append((clause, annot_error.message))
+                break
+    logging.info("[SCREEN] " + str(len(rejected_clauses)) + " of " + str(len(variant_list) + len(prescreened_rejections)) + " clauses rejected in " +
+                 gfile + " (" + str(round(executor.wall_time, 2)) + "s)")
+    return rejected_clauses
+
+
+# remove the lines of the rejected clauses from Output_folder/gfile, only among line_indexes when given
+def remove_rejected_clauses(Output_folder, gfile, rejected_clauses, line_indexes = None):
+    target_path = os.path.join(Output_folder, gfile)
+    rejected = set(clause.strip() for clause, _ in rejected_clauses)
+    with open(target_path, "r") as f:
+        lines = f.readlines()
+    with open(target_path, "w") as f:
+        for i, line in enumerate(lines):
+            if line.strip() not in rejected or (line_indexes is not None and i not in line_indexes):
+                f.write(line)
+
+
+# the task question with clause at its infill location, as llmveri.py writes a reply
+def fill_clause_in_question(question, clause):
+    if ">>> INFILL <<<\n" in question:
+        return question.replace(">>> INFILL <<<", clause, 1)
+    return question.replace("/* @ >>> INFILL <<< */", "/*@ " + clause + " */").replace(">>> INFILL <<<", clause)
+
+
+class ClauseScreener:
+    # kernel checks of the clause lines of streamed replies, in the background while the replies are generated
+    def __init__(self, Output_folder, question, max_workers = None):
+        self.Output_folder = Output_folder
+        self.question = question
+        self.infill_line = next((i for i, line in enumerate(question.split("\n")) if ">>> INFILL <<<" in line), -1)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or get_verification_worker_num())
+        self.futures = {}               # clause -> future of its rejection reason, None when it parses and types
+        self.lock = threading.Lock()
+
+    # on_line callback of BaseChatClass.get_respone(): every new single-line clause is checked once
+    def submit(self, line):
+        clause = line.strip()
+        if self.infill_line < 0 or not clause.endswith(";") or clause.startswith("//") or "INFILL" in clause:
+            return
+        with self.lock:
+            if clause not in self.futures:
+                self.futures[clause] = self.executor.submit(self._check_clause, clause, len(self.futures))
+
+    def _check_clause(self, clause, clause_index):
+        variant_file = ".stream_screen_" + str(clause_index) + ".c"
+        variant_path = os.path.join(self.Output_folder, variant_file)
+        with open(variant_path, "w") as f:
+            f.write(fill_clause_in_question(self.question, clause))
+        input_path = get_framac_input_path(self.Output_folder, variant_file)
+        try:
+            errors = check_framac_kernel(self.Output_folder, variant_file)
+        finally:
+            for path in set([variant_path, input_path]):
+                if os.path.exists(path):
+                    os.remove(path)
+        for annot_error in errors:
+            if annot_error.line == self.infill_line + 1 and annot_error.file in (variant_path, input_path):
+                return annot_error.message
+        return None
+
+    # wait for the checks, return {clause: reason or None} for screen_acsl_clauses(prescreened=...)
+    def get_results(self):
+        self.executor.shutdown(wait=True)
+        results = {clause: future.result() for clause, future in self.futures.items() if future.exception() is None}
+        logging.info("[SCREEN] " + str(sum(1 for reason in results.values() if reason is not None)) + " of " + str(len(results)) +
+                     " streamed clauses rejected")
+        return results
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Machine-wide admission control of the frama-c runs.
+#
+# auto_run.py runs one main.py per model, and every main.py runs its own executor of
+# frama-c processes (each with its provers): nothing bounds the solvers alive on the
+# machine. The daemon is a long-lived local service on a Unix socket. Before starting
+# frama-c, a pipeline process asks it for a slot (VerificationSlot); the daemon admits
+# the jobs within the cores and the available memory, interactive runs (main.py) before
+# batch runs (auto_run.py sets AUTOSPEC_JOB_PRIORITY=batch), and gives every admitted
+# job a -wp-par share of the free cores. The slot is held by the open connection, so a
+# crashed client releases it. Without a running daemon the slots are granted at once.
+#
+# Protocol: one JSON object per line, {"op": "acquire", "priority": ...} answered by
+# {"granted": true, "wp_par": n} once admitted, the slot is released by closing the
+# connection; {"op": "stats"} answers the current queue.
+
+import os, sys, re
+import time
+import json
+import socket
+import select
+import logging
+import threading
+import subprocess
+import socketserver
+from .baselib import *
+from .veri_executor import *
+
+VERI_DAEMON_ENABLE = int(os.environ.get("AUTOSPEC_VERI_DAEMON", "1"))           # Set 0 to never ask the daemon for a slot
+VERI_DAEMON_MAX_CORES = int(os.environ.get("AUTOSPEC_VERI_DAEMON_CORES", "0"))  # 0 means all the cores
+VERI_DAEMON_MAX_WP_PAR = 4          # -wp-par of one job, the provers of a file rarely use more
+VERI_DAEMON_RAMP_SECONDS = 5        # a job admitted less than this ago may not show in MemAvailable yet
+VERI_DAEMON_PRIORITIES = {"interactive": 0, "batch": 1}
+
+
+def get_veri_daemon_socket():
+    return os.environ.get("AUTOSPEC_VERI_DAEMON_SOCKET", os.path.join(get_autospec_cache_dir("daemon"), "veri.sock"))
+
+
+def get_job_priority():
+    priority = os.environ.get("AUTOSPEC_JOB_PRIORITY", "interactive")
+    return priority if priority in VERI_DAEMON_PRIORITIES else "interactive"
+
+
+class VerificationAdmission:
+    # queue of the waiting jobs and cores of the admitted ones, shared by the connection threads
+    def __init__(self, max_cores = VERI_DAEMON_MAX_CORES, mem_per_job_mb = VERI_EXECUTOR_MEM_PER_JOB_MB):
+        self.max_cores = max_cores if max_cores > 0 else (os.cpu_count() or 1)
+        self.mem_per_job_mb = mem_per_job_mb
+        self.condition = threading.Condition()
+        self.waiting = []               # [(priority rank, ticket)], the first one is admitted next
+        self.running = {}               # ticket -> (wp_par, admission time, priority)
+        self.next_ticket = 0
+        self.admitted = {"interactive": 0, "batch": 0}
+
+    def _can_admit(self):
+        used_cores = sum(wp_par for wp_par, _, _ in self.running.values())
+        if used_cores >= self.max_cores:
+            return False
+        if self.running == {}:
+            return True
+        available_mb = get_available_memory_mb()
+        if available_mb <= 0 or self.mem_per_job_mb <= 0:
+            return True
+        ramping = sum(1 for _, admitted_at, _ in self.running.values() if time.time() - admitted_at < VERI_DAEMON_RAMP_SECONDS)
+        return available_mb - ramping * self.mem_per_job_mb >= self.mem_per_job_mb
+
+    # wait for the turn of a new job, return (ticket, wp_par); None when is_gone() says the client left
+    def acquire(self, priority, is_gone):
+        with self.condition:
+            ticket = self.next_ticket
+            self.next_ticket += 1
+            entry = (VERI_DAEMON_PRIORITIES[priority], ticket)
+            self.waiting.append(entry)
+            self.waiting.sort()
+            while self.waiting[0] != entry or not self._can_admit():
+                # memory is freed without any release, look again from time to time
+                self.condition.wait(timeout=1.0)
+                if is_gone():
+                    self.waiting.remove(entry)
+                    self.condition.notify_all()
+                    return None
+            self.waiting.pop(0)
+            free_cores = self.max_cores - sum(wp_par for wp_par, _, _ in self.running.values())
+            # the free cores are shared with the jobs still waiting and the next one to come
+            wp_par = max(1, min(VERI_DAEMON_MAX_WP_PAR, free_cores // (len(self.waiting) + 2)))
+            self.running[ticket] = (wp_par, time.time(), priority)
+            self.admitted[priority] += 1
+            self.condition.notify_all()
+            return ticket, wp_par
+
+    def release(self, ticket):
+        with self.condition:
+            self.running.pop(ticket, None)
+            self.condition.notify_all()
+
+    def get_stats(self):
+        with self.condition:
+            return {
+                "max_cores": self.max_cores,
+                "used_cores": sum(wp_par for wp_par, _, _ in self.running.values()),
+                "running": {priority: sum(1 for _, _, p in self.running.values() if p == priority) for priority in VERI_DAEMON_PRIORITIES},
+                "waiting": {priority: sum(1 for rank, _ in self.waiting if rank == VERI_DAEMON_PRIORITIES[priority]) for priority in VERI_DAEMON_PRIORITIES},
+                "admitted": dict(self.admitted),
+                "available_mb": get_available_memory_mb(),
+            }
+
+
+def _is_connection_closed(sock):
+    readable, _, _ = select.select([sock], [], [], 0)
+    if readable == []:
+        return False
+    try:
+        return sock.recv(1, socket.MSG_PEEK) == b""
+    except OSError:
+        return True
+
+
+class VerificationDaemonHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode("utf-8"))
+        except ValueError:
+            return
+        admission = self.server.admission
+        if request.get("op") == "stats":
+            self.wfile.write((json.dumps(admission.get_stats()) + "\n").encode("utf-8"))
+            return
+        if request.get("op") == "stop":
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+            return
+        if request.get("op") != "acquire":
+            return
+        priority = request.get("priority", "interactive")
+        if priority not in VERI_DAEMON_PRIORITIES:
+            priority = "interactive"
+        granted = admission.acquire(priority, lambda: _is_connection_closed(self.connection))
+        if granted is None:
+            return
+        ticket, wp_par = granted
+        try:
+            self.wfile.write((json.dumps({"granted": True, "wp_par": wp_par}) + "\n").encode("utf-8"))
+            self.wfile.flush()
+            # the slot is held until the client closes the connection
+            while self.connection.recv(4096) != b"":
+                pass
+        except OSError:
+            pass
+        finally:
+            admission.release(ticket)
+
+
+class VerificationDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, admission):
+        self.admission = admission
+        super().__init__(socket_path, VerificationDaemonHandler)
+
+
+def serve_verification_daemon(socket_path = None):
+    socket_path = socket_path or get_veri_daemon_socket()
+    if ping_verification_daemon(socket_path):
+        print("verification daemon already running:", socket_path)
+        return
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    admission = VerificationAdmission()
+    server = VerificationDaemon(socket_path, admission)
+    logging.info("[DAEMON] Serving " + socket_path + " with " + str(admission.max_cores) + " cores")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+# one request and its one-line answer, None when the daemon does not answer
+def _ask_verification_daemon(request, socket_path = None, timeout = 5):
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(socket_path or get_veri_daemon_socket())
+        sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        answer = sock.makefile("rb").readline()
+        sock.close()
+    except OSError:
+        return None
+    try:
+        return json.loads(answer.decode("utf-8")) if answer != b"" else {}
+    except ValueError:
+        return None
+
+
+def ping_verification_daemon(socket_path = None):
+    return _ask_verification_daemon({"op": "stats"}, socket_path) is not None
+
+
+# start a detached daemon unless one is already serving, return True once it answers
+def ensure_verification_daemon(timeout = 10):
+    if VERI_DAEMON_ENABLE != 1:
+        return False
+    if ping_verification_daemon():
+        return True
+    llm4veri_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.Popen([sys.executable, "-m", "src.veri_daemon", "serve"], cwd=llm4veri_dir, start_new_session=True,
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if ping_verification_daemon():
+            return True
+        time.sleep(0.2)
+    logging.warning("[DAEMON] the verification daemon did not start")
+    return False
+
+
+class VerificationSlot:
+    # admission of one frama-c run; wp_par is the -wp-par granted by the daemon, None without daemon
+    def __init__(self, priority = None, socket_path = None):
+        self.priority = priority or get_job_priority()
+        self.socket_path = socket_path or get_veri_daemon_socket()
+        self.sock = None
+        self.wp_par = None
+        self.cancelled = False
+
+    # blocks until the daemon admits the job; cancel_event set while waiting gives up (cancelled)
+    def acquire(self, cancel_event = None):
+        if VERI_DAEMON_ENABLE != 1 or not os.path.exists(self.socket_path):
+            return self
+        try:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(self.socket_path)
+            self.sock.sendall((json.dumps({"op": "acquire", "priority": self.priority, "pid": os.getpid()}) + "\n").encode("utf-8"))
+            answer = b""
+            while not answer.endswith(b"\n"):
+                readable, _, _ = select.select([self.sock], [], [], 0.5)
+                if cancel_event is not None and cancel_event.is_set():
+                    self.cancelled = True
+                    self.release()
+                    return self
+                if readable != []:
+                    data = self.sock.recv(4096)
+                    if data == b"":
+                        break
+                    answer = answer + data
+            self.wp_par = json.loads(answer.decode("utf-8")).get("wp_par")
+        except (OSError, ValueError) as e:
+            # a stale socket or a daemon that went away: run without admission control
+            logging.warning("[DAEMON] no slot from " + self.socket_path + ": " + str(e))
+            self.release()
+        return self
+
+    def release(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
+
+
+# python3 -m src.veri_daemon [serve|stats|stop]
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    command = sys.argv[1] if len(sys.argv) > 1 else "stats"
+    if command == "serve":
+        serve_verification_daemon()
+    elif command == "stop":
+        print("verification daemon stopped" if _ask_verification_daemon({"op": "stop"}) is not None else "no verification daemon")
+    else:
+        stats = _ask_verification_daemon({"op": "stats"})
+        print("daemon: ", get_veri_daemon_socket())
+        print(json.dumps(stats, indent=2) if stats is not None else "not running")
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Bounded executor for independent verifier jobs.
+#
+# Every job spawns its own frama-c (and solver) processes, so the Python side only
+# waits: a thread pool is enough, what matters is how many jobs are alive at once.
+# The bound is the number of cores and the memory that is currently available.
+
+import os, sys
+import time
+import logging
+import threading
+import concurrent.futures
+
+VERI_EXECUTOR_MEM_PER_JOB_MB = int(os.environ.get("AUTOSPEC_VERI_MEM_PER_JOB_MB", "1024"))   # frama-c + alt-ergo + z3
+VERI_EXECUTOR_MAX_WORKERS = int(os.environ.get("AUTOSPEC_VERI_MAX_WORKERS", "0"))             # 0 means decided by cores and memory
+
+
+def get_available_memory_mb():
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) // 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+
+def get_verification_worker_num(job_num = 0, mem_per_job_mb = VERI_EXECUTOR_MEM_PER_JOB_MB):
+    if VERI_EXECUTOR_MAX_WORKERS > 0:
+        worker_num = VERI_EXECUTOR_MAX_WORKERS
+    else:
+        worker_num = os.cpu_count() or 1
+        available_mb = get_available_memory_mb()
+        if available_mb > 0 and mem_per_job_mb > 0:
+            worker_num = min(worker_num, max(1, available_mb // mem_per_job_mb))
+    if job_num > 0:
+        worker_num = min(worker_num, job_num)
+    return max(1, worker_num)
+
+
+class VerificationExecutor:
+    def __init__(self, max_workers = None, mem_per_job_mb = VERI_EXECUTOR_MEM_PER_JOB_MB):
+        self.max_workers = max_workers
+        self.mem_per_job_mb = mem_per_job_mb
+        # set once the remaining jobs are not needed any more, jobs poll it to kill their processes
+        self.cancel_event = threading.Event()
+        self.wall_time = 0.0
+
+    # run job_fn(*job_args, cancel_event=...) for every element of job_args_list
+    # stop_when(result) -> True cancels the jobs that are still queued or running
+    # return the results in the order of job_args_list, None for the cancelled jobs
+    def run(self, job_fn, job_args_list, stop_when = None):
+        starttime = time.time()
+        results = [None] * len(job_args_list)
+        if len(job_args_list) == 0:
+            return results
+
+        worker_num = self.max_workers or get_verification_worker_num(len(job_args_list), self.mem_per_job_mb)
+        logging.info("[EXECUTOR] " + str(len(job_args_list)) + " verification jobs on " + str(worker_num) + " workers")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=worker_num) as executor:
+            future_to_index = {}
+            for index, job_args in enumerate(job_args_list):
+                future = executor.submit(job_fn, *job_args, cancel_event=self.cancel_event)
+                future_to_index[future] = index
+            for future in concurrent.futures.as_completed(future_to_index):
+                if future.cancelled():
+                    continue
+                index = future_to_index[future]
+                try:
+                    results[index] = future.result()
+                except Exception as e:
+                    logging.error("[EXECUTOR] verification job " + str(job_args_list[index]) + " failed: " + str(e))
+                    continue
+                if stop_when is not None and not self.cancel_event.is_set() and stop_when(results[index]):
+                    logging.info("[EXECUTOR] stop condition reached, cancelling the remaining jobs")
+                    self.cancel_event.set()
+                    for other_future in future_to_index:
+                        other_future.cancel()
+        self.wall_time = time.time() - starttime
+        return results
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Shared WP/Why3 prover cache.
+#
+# Frama-C can replay prover answers for goals it has already discharged
+# (-wp-cache update, cache directory taken from FRAMAC_WP_CACHEDIR with -wp-cache-env).
+# All the frama-c runs of the project (every worker, model and round) use the same
+# directory. Runs hold a shared lock on it, the size-capped eviction takes the
+# exclusive lock, and every run appends its per-prover cache hits to stats.jsonl.
+
+import os, sys, re
+import time
+import json
+import fcntl
+import logging
+from .baselib import *
+
+WP_CACHE_ENABLE = int(os.environ.get("AUTOSPEC_WP_CACHE", "1"))              # Set 0 to prove every goal from scratch
+WP_CACHE_MODE = os.environ.get("AUTOSPEC_WP_CACHE_MODE", "update")          # none, update, replay, rebuild, offline, cleanup
+WP_CACHE_MAX_BYTES = int(os.environ.get("AUTOSPEC_WP_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+WP_CACHE_EVICT_INTERVAL = 600       # seconds between two size checks of the cache directory
+WP_CACHE_LOCK_FILE = ".autospec.lock"
+WP_CACHE_STATS_FILE = "stats.jsonl"
+WP_CACHE_STAMP_FILE = ".autospec.evicted"
+
+# e.g. "  Alt-Ergo 2.4.0:    4  (8ms-12ms-15ms) (20) (cached: 4)"
+WP_PROVER_SUMMARY_RE = re.compile(r"^\s+([A-Za-z][\w\-\. ]*?):\s+(\d+)\b(.*)$")
+WP_CACHED_RE = re.compile(r"\(cached: (\d+)\)")
+
+
+def get_wp_cache_dir():
+    return os.environ.get("AUTOSPEC_WP_CACHE_DIR", get_autospec_cache_dir("wp"))
+
+
+# extra frama-c arguments that enable the shared cache
+def get_wp_cache_args():
+    if WP_CACHE_ENABLE != 1:
+        return []
+    return ["-wp-cache", WP_CACHE_MODE, "-wp-cache-env"]
+
+
+# environment of a frama-c process using the shared cache
+def get_wp_cache_env(env = None):
+    env = dict(os.environ if env is None else env)
+    if WP_CACHE_ENABLE == 1:
+        env["FRAMAC_WP_CACHE"] = WP_CACHE_MODE
+        env["FRAMAC_WP_CACHEDIR"] = get_wp_cache_dir()
+    return env
+
+
+class WPCacheLock:
+    # shared for frama-c runs, exclusive for eviction
+    def __init__(self, exclusive = False, blocking = True):
+        self.exclusive = exclusive
+        self.blocking = blocking
+        self.fd = None
+        self.locked = False
+
+    def acquire(self):
+        if WP_CACHE_ENABLE != 1:
+            return self
+        self.fd = open(os.path.join(get_wp_cache_dir(), WP_CACHE_LOCK_FILE), "a")
+        flags = fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH
+        if not self.blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(self.fd, flags)
+            self.locked = True
+        except BlockingIOError:
+            self.locked = False
+        return self
+
+    def release(self):
+        if self.fd is not None:
+            if self.locked:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+                self.locked = False
+            self.fd.close()
+            self.fd = None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
+
+
+# parse the per-prover summary printed after "[wp] Proved goals:"
+# return {"goals": int, "provers": {name: {"goals": int, "cached": int}}}
+def parse_wp_cache_summary(output_lines):
+    summary = {"goals": 0, "provers": {}}
+    in_summary = False
+    for line in output_lines:
+        if "[wp] Proved goals:" in line:
+            in_summary = True
+            try:
+                summary["goals"] = int(line.split("/")[-1].strip())
+            except ValueError:
+                pass
+            continue
+        if not in_summary:
+            continue
+        prover_line = WP_PROVER_SUMMARY_RE.match(line)
+        if prover_line is None:
+            break
+        cached = WP_CACHED_RE.search(prover_line.group(3))
+        summary["provers"][prover_line.group(1)] = {
+            "goals": int(prover_line.group(2)),
+            "cached": int(cached.group(1)) if cached is not None else 0,
+        }
+    return summary
+
+
+def record_wp_cache_run(target_path, output_lines):
+    if WP_CACHE_ENABLE != 1:
+        return
+    summary = parse_wp_cache_summary(output_lines)
+    if summary["goals"] == 0:
+        return
+    # Qed never reaches the cache, only the external provers count
+    prover_goals = sum(v["goals"] for k, v in summary["provers"].items() if k != "Qed")
+    cached = sum(v["cached"] for v in summary["provers"].values())
+    record = {
+        "time": time.time(),
+        "file": os.path.basename(target_path),
+        "goals": summary["goals"],
+        "prover_goals": prover_goals,
+        "cached": cached,
+        "hit_rate": round(cached / prover_goals, 4) if prover_goals > 0 else 0.0,
+    }
+    try:
+        with open(os.path.join(get_wp_cache_dir(), WP_CACHE_STATS_FILE), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(json.dumps(record) + "\n")
+            fcntl.flock(f, fcntl.LOCK_UN)
+    except OSError as e:
+        logging.warning("cannot record wp cache stats: " + str(e))
+    maybe_evict_wp_cache()
+
+
+def get_wp_cache_size():
+    total_size = 0
+    entries = []
+    for root, _, files in os.walk(get_wp_cache_dir()):
+        for name in files:
+            if name in (WP_CACHE_LOCK_FILE, WP_CACHE_STATS_FILE, WP_CACHE_STAMP_FILE):
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            total_size += st.st_size
+            # atime is the last replay when the file system keeps it, mtime the last write
+            entries.append((max(st.st_atime, st.st_mtime), st.st_size, path))
+    return total_size, entries
+
+
+# delete the least recently used entries until the cache fits in max_bytes
+def evict_wp_cache(max_bytes = None, blocking = True):
+    if max_bytes is None:
+        max_bytes = WP_CACHE_MAX_BYTES
+    with WPCacheLock(exclusive=True, blocking=blocking) as lock:
+        if not lock.locked:
+            return 0
+        total_size, entries = get_wp_cache_size()
+        evicted = 0
+        for _, size, path in sorted(entries):
+            if total_size <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_size -= size
+            evicted += 1
+        with open(os.path.join(get_wp_cache_dir(), WP_CACHE_STAMP_FILE), "w") as f:
+            f.write(str(time.time()))
+    return evicted
+
+
+# size check at most every WP_CACHE_EVICT_INTERVAL seconds, skipped while other runs use the cache
+def maybe_evict_wp_cache():
+    stamp = os.path.join(get_wp_cache_dir(), WP_CACHE_STAMP_FILE)
+    if os.path.exists(stamp) and time.time() - os.path.getmtime(stamp) < WP_CACHE_EVICT_INTERVAL:
+        return 0
+    return evict_wp_cache(blocking=False)
+
+
+def load_wp_cache_stats(last_n = 0):
+    records = []
+    stats_file = os.path.join(get_wp_cache_dir(), WP_CACHE_STATS_FILE)
+    if os.path.exists(stats_file):
+        with open(stats_file, "r") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    if last_n > 0:
+        records = records[-last_n:]
+    return records
+
+
+def print_wp_cache_stats(last_n = 20):
+    records = load_wp_cache_stats()
+    total_size, entries = get_wp_cache_size()
+    print("cache dir: ", get_wp_cache_dir())
+    print("entries: ", len(entries), ", size: ", total_size, "bytes")
+    for record in records[-last_n:]:
+        print("%s  %-40s goals = %4d  prover goals = %4d  cached = %4d  hit rate = %5.1f%%" % (
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record["time"])), record["file"],
+            record["goals"], record["prover_goals"], record["cached"], 100.0 * record["hit_rate"]))
+    prover_goals = sum(record["prover_goals"] for record in records)
+    cached = sum(record["cached"] for record in records)
+    if prover_goals > 0:
+        print("runs: ", len(records), ", overall hit rate: %.1f%%" % (100.0 * cached / prover_goals))
+
+
+# python3 -m src.wp_cache [stats [N]|evict|clear]
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "evict":
+        print("evicted entries:", evict_wp_cache())
+    elif len(sys.argv) > 1 and sys.argv[1] == "clear":
+        print("evicted entries:", evict_wp_cache(max_bytes=0))
+    else:
+        print_wp_cache_stats(int(sys.argv[2]) if len(sys.argv) > 2 else 20)
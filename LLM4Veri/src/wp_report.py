@@ -0,0 +1,508 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+# Incremental parser of the frama-c -wp output, and the typed report it produces.
+#
+# The parser is fed one line at a time while frama-c is still running, so the caller
+# can stop the process as soon as the outcome is known (fatal kernel error, or a goal
+# it cares about coming back Timeout/Failed) instead of buffering the whole output.
+# Its WPReport (result type, goals with their provers, annotation errors) is what the
+# consumers of a run look at; load_wp_report() gives the report of a saved _fstd_ file
+# without reading the file again when it was written by this process.
+#
+# The goals come either from the -wp-print goal blocks, or in compact mode from one
+# "[wp:goal]" line per goal (see format_wp_goal_line()) written from the JSON report of
+# frama-c: status, location and timing only, the goal text is fetched on demand.
+
+import os
+import re
+import json
+
+# the outcome is "Invalid" as soon as one of these lines shows up
+WP_INVALID_MARKERS = ("[kernel] Frama-C aborted:", "[kernel] Plug-in wp aborted", "[wp] Warning: No goal generated", "error: invalid preprocessing directive")
+# frama-c will not produce anything useful after one of these lines
+WP_FATAL_MARKERS = ("[kernel] Frama-C aborted", "Plug-in wp aborted", "[kernel:annot-error]")
+# a goal that was not proved, e.g. "[wp] [Timeout] typed_foo_loop_invariant_preserved (Qed 2ms) (Alt-Ergo)"
+WP_UNPROVED_GOAL_RE = re.compile(r"\[wp\] \[(Timeout|Failed|Unknown|Stepout)\] (typed_\S+)")
+WP_SCHEDULED_GOALS_RE = re.compile(r"\[wp\] (\d+) goals? scheduled")
+WP_NO_GOAL_MARKER = "[wp] Warning: No goal generated"
+# -wp-print goal blocks, e.g. "Goal Preservation of Invariant (file foo.c, line 12):"
+# and "Prover Alt-Ergo 2.4.0 returns Valid (Qed:1ms) (8ms)"
+WP_GOAL_HEADER_RE = re.compile(r"^Goal (.*?) \(file (.*?), line (\d+)\)")
+WP_GOAL_NO_LOCATION_RE = re.compile(r"^Goal (.*?)(?: in '[^']*')?(?: \(\d+/\d+\))?:?\s*$")
+WP_GOAL_FUNCTION_RE = re.compile(r" in '([^']+)'")
+WP_PROVER_RESULT_RE = re.compile(r"^Prover (\S+)(?: [\w\.\-]+)? returns (\w+)")
+WP_PROVER_TIME_RE = re.compile(r"\((\d+(?:\.\d+)?)(ms|s)\)\s*$")
+# compact goal lines: "[wp:goal]<TAB>name<TAB>function<TAB>file<TAB>line<TAB>prover:status:ms,..."
+WP_COMPACT_GOAL_MARKER = "[wp:goal]"
+# located messages, e.g. "[kernel:annot-error] foo.c:12: Warning: " then "  unbound logic variable j"
+WP_LOCATED_MESSAGE_RE = re.compile(r"^\[(kernel[^\]]*|wp)\] (\S+?):(\d+):\s*(.*)$")
+
+# goal kind from the description of a goal block, the first match wins
+WP_GOAL_KINDS = (
+    ("Preservation of Invariant", "loop_invariant_preserved"),
+    ("Establishment of Invariant", "loop_invariant_established"),
+    ("Loop assigns", "loop_assigns"),
+    ("Assigns", "assigns"),
+    ("Post-condition", "ensures"),
+    ("Assertion 'rte", "rte"),
+    ("Assertion", "assert"),
+    ("Loop variant", "variant"),
+    ("Pre-condition", "requires"),
+)
+
+
+# -wp-prop category of a goal, from the property kind in its name, "" when unknown
+# e.g. "typed_foo_loop_invariant_2_preserved" -> "@invariant"
+WP_GOAL_CATEGORIES = (
+    ("_loop_invariant", "@invariant"),
+    ("_loop_assigns", "@assigns"),
+    ("_loop_variant", "@variant"),
+    ("_assert", "@assert"),
+    ("_ensures", "@ensures"),
+    ("_assigns", "@assigns"),
+    ("_complete", "@complete_behaviors"),
+    ("_disjoint", "@disjoint_behaviors"),
+    ("_requires", "@requires"),
+)
+
+
+# goal kind from the property kind in a goal name, same kinds as WP_GOAL_KINDS, the first match wins
+# e.g. "typed_foo_loop_invariant_2_preserved" -> "loop_invariant_preserved"
+WP_GOAL_NAME_KINDS = (
+    ("_loop_invariant", "loop_invariant"),
+    ("_loop_assigns", "loop_assigns"),
+    ("_loop_variant", "variant"),
+    ("_assert_rte", "rte"),
+    ("_assert", "assert"),
+    ("_ensures", "ensures"),
+    ("_assigns", "assigns"),
+    ("_requires", "requires"),
+)
+
+# prover names of the JSON report -> the names printed by -wp-print
+WP_PROVER_NAMES = {"qed": "Qed", "alt-ergo": "Alt-Ergo", "z3": "Z3", "cvc4": "CVC4", "cvc5": "CVC5"}
+WP_VERDICTS = {"valid": "Valid", "timeout": "Timeout", "unknown": "Unknown", "failed": "Failed", "stepout": "Stepout",
+               "invalid": "Failed", "error": "Failed", "computing": "Unknown", "none": "Unknown"}
+
+
+def is_requires_goal(goal_name):
+    return "_requires (" in goal_name or "_requires_" in goal_name or goal_name.endswith("_requires")
+
+
+def get_goal_kind(goal_description):
+    for marker, kind in WP_GOAL_KINDS:
+        if marker in goal_description:
+            return kind
+    return "other"
+
+
+def get_goal_category(goal_name, function_name = ""):
+    if function_name != "":
+        # a function named like a kind must not be taken for it
+        goal_name = goal_name.replace("typed_" + function_name, "typed", 1)
+    for kind, category in WP_GOAL_CATEGORIES:
+        if kind in goal_name:
+            return category
+    return ""
+
+
+def get_goal_kind_from_name(goal_name, function_name = ""):
+    if function_name != "":
+        goal_name = goal_name.replace("typed_" + function_name, "typed", 1)
+    for marker, kind in WP_GOAL_NAME_KINDS:
+        if marker in goal_name:
+            if kind == "loop_invariant":
+                return "loop_invariant_established" if "_established" in goal_name else "loop_invariant_preserved"
+            return kind
+    return "other"
+
+
+# function of a goal, "typed_<function>_..." matched against the known function names, "" when unknown
+def get_goal_function(goal_name, function_names):
+    matched = ""
+    for name in function_names:
+        if goal_name.startswith("typed_" + name + "_") and len(name) > len(matched):
+            matched = name
+    return matched
+
+
+class WPGoal:
+    def __init__(self, description, kind, function = "", file = "", line = 0):
+        self.description = description     # e.g. "Preservation of Invariant", "Assigns nothing", the goal name in compact mode
+        self.kind = kind                   # see WP_GOAL_KINDS
+        self.function = function
+        self.file = file
+        self.line = line                   # source line of the property, 0 when the goal has no location
+        self.provers = {}                  # prover -> (status, ms), "Qed" when the goal is closed by simplification
+        self.proved = False
+        self.name = ""                     # e.g. "typed_foo_loop_invariant_preserved", only known in compact mode
+        self.text = None                   # the -wp-print block, None until it is printed or fetched (framac.load_wp_goal_text)
+
+    # "Valid", or the answer of the provers (e.g. "Timeout"), "Unknown" when no prover answered
+    def get_status(self):
+        if self.proved:
+            return "Valid"
+        for status, _ in self.provers.values():
+            return status
+        return "Unknown"
+
+    # the prover that proved the goal, "" when it is not proved
+    def get_prover(self):
+        valid_results = [(time_ms, prover) for prover, (status, time_ms) in self.provers.items() if status == "Valid"]
+        return min(valid_results)[1] if valid_results != [] else ""
+
+    # time of the slowest prover on the goal
+    def get_time_ms(self):
+        return max([time_ms for _, time_ms in self.provers.values()] + [0])
+
+    # the provers answered and none of them proved it
+    def is_failed(self):
+        return not self.proved and self.provers != {}
+
+
+class WPAnnotError:
+    def __init__(self, source, file, line, message):
+        self.source = source               # "kernel:annot-error", "kernel" (syntax error) or "wp" (user error)
+        self.file = file
+        self.line = line
+        self.message = message
+
+
+class WPReport:
+    def __init__(self):
+        self.result_type = "UK"             # Pass_x_y, Fail_x_y, Invalid or UK
+        self.proved_goals = -1              # x and y of "[wp] Proved goals: x / y", -1 without summary
+        self.all_goals = -1
+        self.scheduled_goals = 0
+        self.timeout_in_requires = 0
+        self.goals = []                     # [WPGoal], the -wp-print goal blocks or the compact goal lines
+        self.unproved_goals = []            # names of the goals reported Timeout/Failed/Unknown/Stepout
+        self.annot_errors = []              # [WPAnnotError], in output order
+        self.fatal_line = ""
+        self.summary_lines = []
+        self.replayed = False
+
+    def is_pass(self):
+        return self.result_type.startswith("Pass_")
+
+    def is_fail(self):
+        return self.result_type.startswith("Fail_")
+
+    def get_failed_goals(self, file = None):
+        return [goal for goal in self.goals if goal.is_failed() and (file is None or goal.file == file)]
+
+    def get_annot_errors(self, file = None):
+        return [annot_error for annot_error in self.annot_errors if file is None or annot_error.file == file]
+
+    # the result type decided by the run (scoped "No goal generated", fail-fast stop) wins over the parsed one
+    def set_result_type(self, result_type):
+        self.result_type = result_type
+        if result_type.startswith(("Pass_", "Fail_")):
+            _, proved_str, all_str = result_type.split("_")
+            self.proved_goals, self.all_goals = int(proved_str), int(all_str)
+
+
+class WPOutputParser:
+    # scoped: the run is restricted to some functions (-wp-fct), a function without goals passes
+    # keep_text: keep the lines of every -wp-print goal block in its WPGoal.text
+    def __init__(self, fail_fast_goal_pattern = None, scoped = False, keep_text = False):
+        self.result_type = "UK"
+        self.done = False                   # the result type is known, later lines do not change it
+        self.timeout_in_requires = 0
+        self.scheduled_goals = 0
+        self.unproved_goals = []
+        self.fatal_line = ""                # first fatal marker line
+        self.no_goal = False                # "No goal generated" was seen, the run has 0 / 0 goals
+        self.fail_fast_goal = ""            # first unproved goal matched by fail_fast_goal_pattern
+        self.fail_fast_goal_re = re.compile(fail_fast_goal_pattern) if fail_fast_goal_pattern is not None else None
+        self.scoped = scoped
+        self._stop_after_next_line = False
+        self.line_num = 0
+        self.summary_lines = []             # "[wp] Proved goals:" and the per-prover lines below it
+        self.goals = []                     # [WPGoal] of the -wp-print goal blocks and of the compact goal lines
+        self.keep_text = keep_text
+        self.annot_errors = []              # [WPAnnotError]
+        self._pending_location = None       # located message whose text may continue on the next line
+        self.replayed = False               # fed from the result cache instead of a live frama-c
+
+    # feed one output line, return True once frama-c can be stopped (then call abort())
+    def feed(self, line):
+        self.line_num += 1
+        self._feed_annot_error(line)
+        if WP_NO_GOAL_MARKER in line:
+            self.no_goal = True
+        if self._stop_after_next_line:
+            # keep the message that follows a "[kernel:annot-error] file:line:" header
+            self._stop_after_next_line = False
+            return True
+
+        if any(marker in line for marker in WP_FATAL_MARKERS) and self.fatal_line == "":
+            self.fatal_line = line.rstrip("\n")
+            if "[kernel:annot-error]" in line:
+                self._stop_after_next_line = True
+            self._feed_result_type(line)
+            return not self._stop_after_next_line
+
+        unproved_goal = WP_UNPROVED_GOAL_RE.search(line)
+        if unproved_goal is not None:
+            self.unproved_goals.append(unproved_goal.group(2))
+            if self.fail_fast_goal_re is not None and self.fail_fast_goal == "" and \
+                not is_requires_goal(line) and self.fail_fast_goal_re.search(unproved_goal.group(2)):
+                self.fail_fast_goal = unproved_goal.group(2)
+                self._feed_result_type(line)
+                return True
+
+        if "[wp] Proved goals:" in line or (self.summary_lines != [] and line.startswith(" ") and len(self.summary_lines) < 32):
+            self.summary_lines.append(line.rstrip("\n"))
+
+        self._feed_goal_block(line)
+
+        scheduled_goals = WP_SCHEDULED_GOALS_RE.search(line)
+        if scheduled_goals is not None:
+            self.scheduled_goals = int(scheduled_goals.group(1))
+
+        self._feed_result_type(line)
+        return False
+
+    # "[kernel:annot-error] file:line: ..." and the message line that follows it
+    def _feed_annot_error(self, line):
+        if self._pending_location is not None:
+            source, file, line_num, message = self._pending_location
+            self._pending_location = None
+            if line.startswith(" "):
+                message = (message + " " + line.strip()).strip()
+            if source == "kernel:annot-error" or (source == "kernel" and ("syntax error" in message or "Invalid symbol" in message)) \
+                or (source == "wp" and "User Error" in message):
+                self.annot_errors.append(WPAnnotError(source, file, line_num, message))
+        location = WP_LOCATED_MESSAGE_RE.match(line.rstrip("\n"))
+        if location is not None and location.group(1) in ("kernel:annot-error", "kernel", "wp"):
+            self._pending_location = (location.group(1), location.group(2), int(location.group(3)), location.group(4).strip())
+
+    def _feed_goal_block(self, line):
+        if line.startswith(WP_COMPACT_GOAL_MARKER):
+            goal = parse_wp_goal_line(line)
+            if goal is not None:
+                self.goals.append(goal)
+            return
+        if line.startswith("Goal "):
+            header = WP_GOAL_HEADER_RE.match(line)
+            function = WP_GOAL_FUNCTION_RE.search(line[header.end():] if header is not None else line)
+            if header is not None:
+                goal = WPGoal(header.group(1), get_goal_kind(header.group(1)), "", header.group(2), int(header.group(3)))
+            else:
+                # e.g. "Goal Assigns nothing in 'foo':" has no location
+                no_location = WP_GOAL_NO_LOCATION_RE.match(line.rstrip("\n"))
+                description = no_location.group(1) if no_location is not None else line[5:].strip()
+                goal = WPGoal(description, get_goal_kind(description))
+            goal.function = function.group(1) if function is not None else ""
+            if self.keep_text:
+                goal.text = line
+            self.goals.append(goal)
+        elif self.goals != [] and self.goals[-1].name == "":
+            goal = self.goals[-1]
+            if goal.text is not None and self.summary_lines == [] and not line.startswith(("[wp]", "-" * 20, "Function ")):
+                goal.text = goal.text + line
+            if line.startswith("Prove: true"):
+                goal.provers["Qed"] = ("Valid", 0)
+                goal.proved = True
+            elif line.startswith("Prove: false"):
+                goal.provers.setdefault("Qed", ("Unknown", 0))
+            elif line.startswith("Prover "):
+                prover_result = WP_PROVER_RESULT_RE.match(line)
+                if prover_result is not None:
+                    prover_time = WP_PROVER_TIME_RE.search(line)
+                    time_ms = 0
+                    if prover_time is not None:
+                        time_ms = int(float(prover_time.group(1)) * (1 if prover_time.group(2) == "ms" else 1000))
+                    goal.provers[prover_result.group(1)] = (prover_result.group(2), time_ms)
+                    if prover_result.group(2) == "Valid":
+                        goal.proved = True
+
+    # same classification as the historical framac.get_result_type()
+    def _feed_result_type(self, line):
+        if self.done:
+            return
+        if self.scoped and WP_NO_GOAL_MARKER in line:
+            self.result_type = "Pass_0_0"
+            self.done = True
+            return
+        # If the line contains the string "[kernel] Frama-C aborted:", then the
+        # build is invalid.
+        if any(marker in line for marker in WP_INVALID_MARKERS):
+            self.result_type = "Invalid"
+            self.done = True
+        elif "[wp] [Timeout] typed_" in line and ("_requires (" in line or "_requires_" in line):
+            self.timeout_in_requires += 1
+        # If the line contains the string "[wp] Proved goals:", then the build
+        # is valid. The number of proved goals is given in the form "x/y",
+        # where x is the number of proved goals and y is the number of total
+        # goals. If x == y, then the build is a pass. Otherwise, the build is
+        # a fail.
+        elif "[wp] Proved goals:" in line:
+            proportion = line.split(":")[-1]
+            left, right = proportion.split("/")
+            left = left.strip()
+            right = right.strip()
+            if int(left) + int(self.timeout_in_requires) == int(right):
+                self.result_type = "Pass_" + left + "_" + right
+            else:
+                self.result_type = "Fail_" + left + "_" + right
+            self.done = True
+
+    # the process is stopped before the summary, settle the result type from what has been seen
+    def abort(self):
+        if self.done:
+            return
+        if self.fatal_line != "":
+            # annot-error is fatal for frama-c, it would have aborted right after
+            self.result_type = "Invalid"
+        elif self.fail_fast_goal != "":
+            # the proved count is unknown, only the failure is certain
+            self.result_type = "Fail_0_" + str(max(1, self.scheduled_goals))
+        self.done = True
+
+    # a fail-fast result is partial: it depends on the caller's goal pattern, not only on the file
+    def is_fail_fast_abort(self):
+        return self.fail_fast_goal != ""
+
+    # the report of what has been fed so far
+    def report(self):
+        if self._pending_location is not None:
+            self._feed_annot_error("")
+        report = WPReport()
+        report.result_type = self.result_type
+        if self.result_type.startswith(("Pass_", "Fail_")):
+            _, proved_str, all_str = self.result_type.split("_")
+            report.proved_goals, report.all_goals = int(proved_str), int(all_str)
+        elif self.no_goal:
+            # Invalid, but there is nothing to prove: 0 / 0 like the "[wp] Proved goals:" summary
+            report.proved_goals, report.all_goals = 0, 0
+        report.scheduled_goals = self.scheduled_goals
+        report.timeout_in_requires = self.timeout_in_requires
+        report.goals = self.goals
+        report.unproved_goals = self.unproved_goals
+        report.annot_errors = self.annot_errors
+        report.fatal_line = self.fatal_line
+        report.summary_lines = self.summary_lines
+        report.replayed = self.replayed
+        return report
+
+
+# compact goal line of a WPGoal, see WP_COMPACT_GOAL_MARKER
+def format_wp_goal_line(goal):
+    provers = ",".join("%s:%s:%d" % (prover, status, time_ms) for prover, (status, time_ms) in goal.provers.items())
+    return "\t".join([WP_COMPACT_GOAL_MARKER, goal.name, goal.function, goal.file, str(goal.line), provers]) + "\n"
+
+
+def parse_wp_goal_line(line):
+    fields = line.rstrip("\n").split("\t")
+    if len(fields) != 6 or not fields[4].isdigit():
+        return None
+    _, name, function, file, line_num, provers = fields
+    goal = WPGoal(name, get_goal_kind_from_name(name, function), function, file, int(line_num))
+    goal.name = name
+    for prover_result in provers.split(","):
+        prover_fields = prover_result.split(":")
+        if len(prover_fields) == 3 and prover_fields[2].isdigit():
+            goal.provers[prover_fields[0]] = (prover_fields[1], int(prover_fields[2]))
+            goal.proved = goal.proved or prover_fields[1] == "Valid"
+    return goal
+
+
+def _get_json_number(value, default = 0):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+# the per goal entries of a frama-c -wp-report-json file -> [WPGoal], in report order
+# an entry is an object with a "goal" name; its prover results are either a "provers" list
+# or the entry itself when the report has one entry per goal and prover
+def read_wp_json_goals(json_file_name):
+    with open(json_file_name, "r", encoding="utf-8", errors="replace") as f:
+        data = json.load(f)
+    goals = {}
+    pending = [data]
+    while pending != []:
+        node = pending.pop(0)
+        if isinstance(node, list):
+            pending = node + pending
+            continue
+        if not isinstance(node, dict):
+            continue
+        if not isinstance(node.get("goal"), str):
+            pending = list(node.values()) + pending
+            continue
+        name = node["goal"]
+        goal = goals.get(name)
+        if goal is None:
+            function = str(node.get("function", node.get("fct", "")) or "")
+            location = node.get("loc", node)
+            goal = WPGoal(name, get_goal_kind_from_name(name, function), function,
+                          str(location.get("file", "") or ""), int(_get_json_number(location.get("line", 0))))
+            goal.name = name
+            goals[name] = goal
+        prover_results = node.get("provers", [node] if "prover" in node else [])
+        if isinstance(prover_results, dict):
+            prover_results = [dict(result, prover=prover) for prover, result in prover_results.items() if isinstance(result, dict)]
+        for result in prover_results:
+            if not isinstance(result, dict) or "prover" not in result:
+                continue
+            prover = re.split(r"[: ]", str(result["prover"]))[0]
+            prover = WP_PROVER_NAMES.get(prover.lower(), prover)
+            verdict = str(result.get("verdict", result.get("result", result.get("status", "unknown"))))
+            status = WP_VERDICTS.get(verdict.lower(), verdict.capitalize())
+            goal.provers[prover] = (status, int(_get_json_number(result.get("time", 0)) * 1000))
+            goal.proved = goal.proved or status == "Valid"
+        # a goal level verdict only: closed by WP itself, or not proved
+        if goal.provers == {} and ("passed" in node or "verdict" in node):
+            status = "Valid" if node.get("passed") is True else WP_VERDICTS.get(str(node.get("verdict", "unknown")).lower(), "Unknown")
+            goal.provers["Qed"] = (status, int(_get_json_number(node.get("time", 0)) * 1000))
+            goal.proved = status == "Valid"
+    return list(goals.values())
+
+
+# report of a whole frama-c output given as bytes, str or lines, in one pass
+def parse_wp_report(output, scoped = False):
+    if isinstance(output, bytes):
+        output = output.decode("utf-8", errors="replace")
+    if isinstance(output, str):
+        output = output.splitlines(True)
+    parser = WPOutputParser(scoped = scoped)
+    for line in output:
+        parser.feed(line)
+    return parser.report()
+
+
+# _fstd_ file -> (mtime, size, WPReport) of the reports written by this process
+WP_REPORTS = {}
+WP_FSTD_RESULT_TYPE_RE = re.compile(r"_fstd_.*?_((?:Pass|Fail)_\d+_\d+|Invalid|UK)\.txt$")
+
+
+def register_wp_report(file_name, report):
+    st = os.stat(file_name)
+    WP_REPORTS[os.path.abspath(file_name)] = (st.st_mtime_ns, st.st_size, report)
+
+
+# ..._fstd_N_Pass_3_5.txt -> "Pass_3_5", "" when the name carries no result type
+def get_result_type_from_file_name(file_name):
+    match = WP_FSTD_RESULT_TYPE_RE.search(os.path.basename(file_name))
+    return match.group(1) if match is not None else ""
+
+
+# report of a saved frama-c output (_fstd_ file), parsed only when this process did not write it;
+# the result type is the one the run saved in the file name
+def load_wp_report(file_name):
+    st = os.stat(file_name)
+    registered = WP_REPORTS.get(os.path.abspath(file_name))
+    if registered is not None and registered[0] == st.st_mtime_ns and registered[1] == st.st_size:
+        return registered[2]
+    with open(file_name, "r", encoding="utf-8", errors="replace") as f:
+        report = parse_wp_report(f)
+    saved_result_type = get_result_type_from_file_name(file_name)
+    if saved_result_type != "" and saved_result_type != report.result_type:
+        report.set_result_type(saved_result_type)
+    WP_REPORTS[os.path.abspath(file_name)] = (st.st_mtime_ns, st.st_size, report)
+    return report
@@ -1,4 +1,5 @@
 import os
+import sys
 import glob
 import subprocess
 import re
@@ -6,6 +7,11 @@ import shutil
 import json
 import argparse
 
+# share the WP prover cache with the LLM4Veri runs
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "LLM4Veri"))
+from src.wp_cache import get_wp_cache_args, get_wp_cache_env, record_wp_cache_run
+from src.wp_report import parse_wp_report
+
 # Timeout for Frama-C (seconds) to prevent certain files from hanging
 TIMEOUT_SECONDS = 60
 
@@ -15,7 +21,7 @@ def run_framac_and_check(file_path):
     Returns: (is_success (bool), output_log (str))
     """
     # Construct the command: frama-c -wp path/*.c
-    cmd = ["frama-c", "-wp", file_path]
+    cmd = ["frama-c", "-wp"] + get_wp_cache_args() + [file_path]
     
     try:
         # Execute the command, capturing stdout and stderr
@@ -24,22 +30,22 @@ def run_framac_and_check(file_path):
             cmd, 
             capture_output=True, 
             text=True, 
-            timeout=TIMEOUT_SECONDS
+            timeout=TIMEOUT_SECONDS,
+            env=get_wp_cache_env()
         )
         output = result.stdout
+        record_wp_cache_run(file_path, output.splitlines())
         
         # If stdout is empty, sometimes error messages are in stderr, so concatenate for debugging
         # But usually, WP proof results are in stdout
         full_log = output + "\n" + result.stderr
 
-        # Regex match: [wp] Proved goals:    n / m
-        # \s+ matches one or more spaces
-        # (\d+) captures numbers
-        match = re.search(r'\[wp\] Proved goals:\s+(\d+)\s+/\s+(\d+)', output)
+        # Same report as LLM4Veri: the "[wp] Proved goals:    n / m" summary, goals and errors
+        report = parse_wp_report(output)
         
-        if match:
-            proved_n = int(match.group(1))
-            total_m = int(match.group(2))
+        if report.all_goals >= 0:
+            proved_n = report.proved_goals
+            total_m = report.all_goals
             
             # Core judgment logic: n == m means success
             # Note: If m=0 (no goals), it is usually considered as nothing to do. This depends on specific needs,
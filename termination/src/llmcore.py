@@ -1,17 +1,23 @@
 import os
+import sys
 from openai import OpenAI, OpenAIError
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from utils.llm_client import get_llm_client
+
 # --- 1. Initialize OpenAI Client ---
 
 # Get API key from environment variables
 # You must set this variable in your terminal first:
 # export OPENAI_API_KEY='sk-...'
 api_key = os.environ.get("OPENAI_API_KEY")
-base_url = "https://api.openai-proxy.org/v1"
+# OPENAI_BASE_URL points the client elsewhere, e.g. at the local mock server (utils/mock_llm_server.py)
+base_url = os.environ.get("OPENAI_BASE_URL", "https://api.openai-proxy.org/v1")
 if not api_key:
     print("Error: OPENAI_API_KEY environment variable is not set.")
 
-client = OpenAI(api_key=api_key, base_url=base_url)
+# The process-wide pooled client (utils/llm_client.py): every loop reuses its connections
+client = get_llm_client(base_url, api_key) if api_key else None
 
 # --- 2. Define the System Prompt ---
 
@@ -0,0 +1,143 @@
+import os, sys
+import time
+import json
+import logging
+import sqlite3
+import hashlib
+
+# 磁盘上的 LLM 回答缓存（sqlite），键为一次 chat.completions 请求的 (model, messages, temperature, n, seed, max_tokens, ...)
+#
+# AUTOSPEC_LLM_CACHE 选择模式：
+#   off       不读不写
+#   readwrite 先查缓存，未命中再请求并写入（默认）
+#   record    总是请求，并写入（覆盖）缓存
+#   replay    只读缓存，未命中时抛出 LLMCacheMissError，不访问网络；用来复现整个 auto_run.py 实验
+LLM_CACHE_MODES = ["off", "readwrite", "record", "replay"]
+LLM_CACHE_MODE = os.environ.get("AUTOSPEC_LLM_CACHE", "readwrite")
+LLM_CACHE_MAX_BYTES = int(os.environ.get("AUTOSPEC_LLM_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+# 参与缓存键的请求参数，timeout 和 stream 不改变回答
+LLM_CACHE_KEY_ARGS = ["model", "messages", "temperature", "n", "seed", "max_tokens", "top_p", "stop", "frequency_penalty", "presence_penalty"]
+
+# 当前进程的命中统计
+LLM_CACHE_STATS = {"hit": 0, "miss": 0, "store": 0, "evict": 0, "saved_tokens": 0}
+
+
+class LLMCacheMissError(RuntimeError):
+    pass
+
+
+def get_llm_cache_mode():
+    return LLM_CACHE_MODE if LLM_CACHE_MODE in LLM_CACHE_MODES else "readwrite"
+
+
+def get_llm_cache_dir():
+    cache_dir = os.environ.get("AUTOSPEC_LLM_CACHE_DIR", os.path.join(os.environ.get("AUTOSPEC_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "autospec")), "llm"))
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def _connect_llm_cache():
+    db = sqlite3.connect(os.path.join(get_llm_cache_dir(), "index.db"), timeout=60)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, model TEXT, response TEXT, tokens INTEGER, "
+               "size INTEGER, created REAL, last_access REAL)")
+    db.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)")
+    return db
+
+
+def make_llm_cache_key(request_args):
+    key_args = {name: request_args.get(name) for name in LLM_CACHE_KEY_ARGS}
+    return hashlib.sha256(json.dumps(key_args, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def _bump_stat(db, name, value = 1):
+    LLM_CACHE_STATS[name] += value
+    db.execute("INSERT INTO stats (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + ?", (name, value, value))
+
+
+# 返回缓存的回答（chat.completions 的 JSON 字符串），未命中返回 None
+def lookup_llm_response(cache_key):
+    try:
+        db = _connect_llm_cache()
+        with db:
+            row = db.execute("SELECT response, tokens FROM responses WHERE key = ?", (cache_key,)).fetchone()
+            if row is None:
+                _bump_stat(db, "miss")
+            else:
+                db.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), cache_key))
+                _bump_stat(db, "hit")
+                _bump_stat(db, "saved_tokens", row[1])
+        db.close()
+    except sqlite3.Error as e:
+        logging.warning("llm cache lookup failed: " + str(e))
+        return None
+    return row[0] if row is not None else None
+
+
+def store_llm_response(cache_key, model, response_json, tokens):
+    size = len(response_json.encode("utf-8"))
+    now = time.time()
+    try:
+        db = _connect_llm_cache()
+        with db:
+            db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)", (cache_key, model, response_json, tokens, size, now, now))
+            _bump_stat(db, "store")
+            evict_llm_cache(db)
+        db.close()
+    except sqlite3.Error as e:
+        logging.warning("llm cache store failed: " + str(e))
+
+
+# 按最近最少使用淘汰，直到缓存不超过 LLM_CACHE_MAX_BYTES
+def evict_llm_cache(db, max_bytes = None):
+    if max_bytes is None:
+        max_bytes = LLM_CACHE_MAX_BYTES
+    total_size = db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+    if total_size <= max_bytes:
+        return 0
+    evicted = 0
+    for key, size in db.execute("SELECT key, size FROM responses ORDER BY last_access ASC").fetchall():
+        if total_size <= max_bytes:
+            break
+        db.execute("DELETE FROM responses WHERE key = ?", (key,))
+        total_size -= size
+        evicted += 1
+    _bump_stat(db, "evict", evicted)
+    return evicted
+
+
+def get_llm_cache_stats():
+    stats = {"mode": get_llm_cache_mode(), "process": dict(LLM_CACHE_STATS)}
+    try:
+        db = _connect_llm_cache()
+        stats["total"] = dict(db.execute("SELECT name, value FROM stats").fetchall())
+        stats["entries"], stats["bytes"] = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        db.close()
+    except sqlite3.Error as e:
+        stats["error"] = str(e)
+    return stats
+
+
+def format_llm_cache_stats():
+    hit = LLM_CACHE_STATS["hit"]
+    miss = LLM_CACHE_STATS["miss"]
+    rate = 100.0 * hit / (hit + miss) if hit + miss > 0 else 0.0
+    return "mode = %s, hit = %d, miss = %d, hit_rate = %.1f%%, saved_tokens = %d" % (get_llm_cache_mode(), hit, miss, rate, LLM_CACHE_STATS["saved_tokens"])
+
+
+def clear_llm_cache():
+    db = _connect_llm_cache()
+    with db:
+        db.execute("DELETE FROM responses")
+        db.execute("DELETE FROM stats")
+    db.execute("VACUUM")
+    db.close()
+
+
+# python3 -m utils.llm_cache [stats|clear]
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "clear":
+        clear_llm_cache()
+        print("llm cache cleared:", get_llm_cache_dir())
+    else:
+        print(json.dumps(get_llm_cache_stats(), indent=4))
@@ -0,0 +1,74 @@
+import os, sys
+import asyncio
+import logging
+import threading
+import weakref
+import httpx
+from httpx import HTTPTransport, AsyncHTTPTransport
+from openai import OpenAI, AsyncOpenAI
+
+# 进程内共享的 LLM 客户端：同一个 (base_url, api_key) 只建一个带连接池、keep-alive 的客户端，
+# 每个任务、每轮、每个文件的请求都复用已经建立的 TCP/TLS 连接
+LLM_MAX_CONNECTIONS = int(os.environ.get("AUTOSPEC_LLM_MAX_CONNECTIONS", "32"))   # 连接池大小，即同时进行的请求数上限
+LLM_KEEPALIVE_EXPIRY = 120          # 空闲连接保留的秒数
+LLM_CONNECT_RETRIES = 2             # 建立连接失败时的重试次数
+
+_llm_clients = {}
+_async_llm_clients = weakref.WeakKeyDictionary()    # event loop -> {(base_url, api_key): AsyncOpenAI}
+_llm_clients_lock = threading.Lock()
+
+
+def _get_llm_pool_limits():
+    return httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_CONNECTIONS, keepalive_expiry=LLM_KEEPALIVE_EXPIRY)
+
+
+# 共享的同步客户端，线程安全，可以被多个线程同时使用
+def get_llm_client(base_url, api_key):
+    key = (base_url, api_key)
+    with _llm_clients_lock:
+        client = _llm_clients.get(key)
+        if client is None:
+            http_client = httpx.Client(transport=HTTPTransport(retries=LLM_CONNECT_RETRIES, limits=_get_llm_pool_limits()))
+            client = OpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+            _llm_clients[key] = client
+            logging.info(f"[LLM] New pooled client for {base_url}")
+        return client
+
+
+# 共享的异步客户端；httpx 的异步连接池属于创建它的 event loop，所以每个 loop 一个
+def get_async_llm_client(base_url, api_key):
+    loop = asyncio.get_running_loop()
+    key = (base_url, api_key)
+    with _llm_clients_lock:
+        loop_clients = _async_llm_clients.setdefault(loop, {})
+        client = loop_clients.get(key)
+        if client is None:
+            http_client = httpx.AsyncClient(transport=AsyncHTTPTransport(retries=LLM_CONNECT_RETRIES, limits=_get_llm_pool_limits()))
+            client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client)
+            loop_clients[key] = client
+        return client
+
+
+def get_llm_client_for_config(config):
+    return get_llm_client(config.base_url, config.api_key)
+
+
+def get_async_llm_client_for_config(config):
+    return get_async_llm_client(config.base_url, config.api_key)
+
+
+# 关闭当前 event loop 的异步客户端，在 loop 结束前调用
+async def close_async_llm_clients():
+    loop = asyncio.get_running_loop()
+    with _llm_clients_lock:
+        loop_clients = _async_llm_clients.pop(loop, {})
+    for client in loop_clients.values():
+        await client.close()
+
+
+def close_llm_clients():
+    with _llm_clients_lock:
+        clients = list(_llm_clients.values())
+        _llm_clients.clear()
+    for client in clients:
+        client.close()
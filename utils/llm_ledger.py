@@ -0,0 +1,158 @@
+import os, sys
+import time
+import json
+import logging
+import threading
+import functools
+
+# LLM 调用账本和 token 预算
+#
+# 每次 chat.completions 请求（包括缓存命中）写一行 JSON 到账本：模型、耗时、prompt/completion tokens、是否命中缓存。
+# token 数优先取平台返回的 usage，没有时用 tiktoken 估算（estimated = true）。
+# 一个账本文件就是一次实验（campaign）：auto_run.py 每次运行用一个新账本，单独运行 main.py 时默认用缓存目录下的账本。
+# 预算按账本统计，缓存命中也计入，这样 replay 的实验和原实验在预算上的行为一致：
+#   AUTOSPEC_LLM_FILE_TOKEN_BUDGET      每个输入文件的 token 上限，0 表示不限
+#   AUTOSPEC_LLM_CAMPAIGN_TOKEN_BUDGET  整个账本的 token 上限，0 表示不限
+# 剩余预算不够 n_choices 个回答时先减少回答数（降级），预算用完时停止查询这个文件。
+LLM_FILE_TOKEN_BUDGET = int(os.environ.get("AUTOSPEC_LLM_FILE_TOKEN_BUDGET", "0"))
+LLM_CAMPAIGN_TOKEN_BUDGET = int(os.environ.get("AUTOSPEC_LLM_CAMPAIGN_TOKEN_BUDGET", "0"))
+LLM_COMPLETION_TOKENS_ESTIMATE = 1024   # 账本里还没有记录时，一个回答的 completion tokens 估计值
+
+_ledger_lock = threading.Lock()
+_ledger_totals = {"file": "", "offset": 0, "total": 0, "tags": {}, "completion_tokens": 0, "choices": 0, "prompt_tokens": 0, "cached_prompt_tokens": 0, "throttle_ms": 0}
+
+
+class LLMBudgetExceededError(RuntimeError):
+    pass
+
+
+def get_llm_ledger_file():
+    ledger_file = os.environ.get("AUTOSPEC_LLM_LEDGER")
+    if ledger_file is None:
+        cache_dir = os.path.join(os.environ.get("AUTOSPEC_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "autospec")), "llm")
+        ledger_file = os.path.join(cache_dir, "ledger.jsonl")
+    os.makedirs(os.path.dirname(os.path.abspath(ledger_file)), exist_ok=True)
+    return ledger_file
+
+
+@functools.lru_cache(maxsize=None)
+def _get_token_encoding(model):
+    import tiktoken
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+# tiktoken 的编码，拿不到时（没有安装，或者离线下载不了编码表）按 4 个字符一个 token 估算
+def num_tokens_from_text(text, model="qwen-turbo"):
+    if not text:
+        return 0
+    try:
+        return len(_get_token_encoding(model).encode(text, disallowed_special=()))
+    except Exception:
+        return (len(text) + 3) // 4
+
+
+def num_tokens_from_messages(messages, model="qwen-turbo"):
+    # 每条消息有 3 个格式 token，回答前还有 3 个
+    return sum(3 + num_tokens_from_text(message.get("content") or "", model) for message in messages) + 3
+
+
+def record_llm_call(model, tag, latency_ms, prompt_tokens, completion_tokens, n, cache_hit, estimated, cached_prompt_tokens = 0, throttle_ms = 0):
+    entry = {
+        "time": round(time.time(), 3),
+        "model": model,
+        "tag": tag,
+        "latency_ms": int(latency_ms),
+        "throttle_ms": int(throttle_ms),    # 限流和重试退避的等待时间，不计入 latency_ms
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "cached_prompt_tokens": cached_prompt_tokens,   # prompt tokens 中命中平台前缀缓存的部分
+        "total_tokens": prompt_tokens + completion_tokens,
+        "n": n,
+        "cache_hit": cache_hit,
+        "estimated": estimated,
+    }
+    # 一次 write 追加一整行，多个进程可以同时写同一个账本
+    with open(get_llm_ledger_file(), "a") as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+# 账本的 token 总数和每个 tag 的 token 数，只读上次之后新追加的行
+def get_llm_ledger_totals():
+    ledger_file = get_llm_ledger_file()
+    with _ledger_lock:
+        if _ledger_totals["file"] != ledger_file:
+            _ledger_totals.update({"file": ledger_file, "offset": 0, "total": 0, "tags": {}, "completion_tokens": 0, "choices": 0, "prompt_tokens": 0, "cached_prompt_tokens": 0, "throttle_ms": 0})
+        if os.path.exists(ledger_file):
+            with open(ledger_file, "rb") as f:
+                f.seek(_ledger_totals["offset"])
+                for line in f:
+                    # 还没写完的行下次再读
+                    if not line.endswith(b"\n"):
+                        break
+                    _ledger_totals["offset"] += len(line)
+                    try:
+                        entry = json.loads(line.decode("utf-8"))
+                    except ValueError:
+                        continue
+                    _ledger_totals["total"] += entry.get("total_tokens", 0)
+                    tag = entry.get("tag", "")
+                    _ledger_totals["tags"][tag] = _ledger_totals["tags"].get(tag, 0) + entry.get("total_tokens", 0)
+                    _ledger_totals["completion_tokens"] += entry.get("completion_tokens", 0)
+                    _ledger_totals["choices"] += entry.get("n", 1)
+                    _ledger_totals["prompt_tokens"] += entry.get("prompt_tokens", 0)
+                    _ledger_totals["cached_prompt_tokens"] += entry.get("cached_prompt_tokens", 0)
+                    _ledger_totals["throttle_ms"] += entry.get("throttle_ms", 0)
+        return dict(_ledger_totals, tags=dict(_ledger_totals["tags"]))
+
+
+# 一个回答的平均 completion tokens，账本里还没有记录时用估计值
+def get_average_completion_tokens():
+    totals = get_llm_ledger_totals()
+    return totals["completion_tokens"] // totals["choices"] if totals["choices"] > 0 else LLM_COMPLETION_TOKENS_ESTIMATE
+
+
+# 剩余的 token 预算，None 表示不限
+def get_llm_token_budget_left(tag = ""):
+    if LLM_FILE_TOKEN_BUDGET <= 0 and LLM_CAMPAIGN_TOKEN_BUDGET <= 0:
+        return None
+    totals = get_llm_ledger_totals()
+    budget_left = []
+    if LLM_FILE_TOKEN_BUDGET > 0:
+        budget_left.append(LLM_FILE_TOKEN_BUDGET - totals["tags"].get(tag, 0))
+    if LLM_CAMPAIGN_TOKEN_BUDGET > 0:
+        budget_left.append(LLM_CAMPAIGN_TOKEN_BUDGET - totals["total"])
+    return max(0, min(budget_left))
+
+
+def is_llm_budget_exhausted(tag = ""):
+    return get_llm_token_budget_left(tag) == 0
+
+
+# 剩余预算能负担的回答数（不超过 n_choices），每个回答按 prompt tokens 加平均 completion tokens 计算；
+# 预算还有剩余时至少一个，用完时为 0
+def get_budgeted_n_choices(n_choices, prompt_tokens, tag = ""):
+    budget_left = get_llm_token_budget_left(tag)
+    if budget_left is None:
+        return n_choices
+    if budget_left == 0:
+        return 0
+    return max(1, min(n_choices, budget_left // max(1, prompt_tokens + get_average_completion_tokens())))
+
+
+def format_llm_ledger_totals(tag = None):
+    totals = get_llm_ledger_totals()
+    text = "ledger = %s, total_tokens = %d, cached_prompt_tokens = %d / %d, throttle = %.1fs" % (totals["file"], totals["total"], totals["cached_prompt_tokens"], totals["prompt_tokens"], totals["throttle_ms"] / 1000.0)
+    if tag is not None:
+        text += ", file_tokens = %d" % totals["tags"].get(tag, 0)
+    return text
+
+
+# python3 -m utils.llm_ledger [stats]
+if __name__ == "__main__":
+    totals = get_llm_ledger_totals()
+    print(json.dumps({"ledger": totals["file"], "total_tokens": totals["total"], "files": totals["tags"],
+                      "prompt_tokens": totals["prompt_tokens"], "cached_prompt_tokens": totals["cached_prompt_tokens"], "throttle_ms": totals["throttle_ms"],
+                      "file_budget": LLM_FILE_TOKEN_BUDGET, "campaign_budget": LLM_CAMPAIGN_TOKEN_BUDGET}, indent=4, ensure_ascii=False))
@@ -0,0 +1,123 @@
+import os, sys
+import time
+import json
+import fcntl
+import random
+import logging
+
+# 每个平台模板（models_config.yaml 的 ConfigTemplates）一个令牌桶限流器，同一台机器上的所有线程和进程共享
+#
+# 模板中的 requests_per_minute / tokens_per_minute 是平台给的每分钟请求数和 token 数（不写或 0 表示不限）。
+# 桶的状态存在缓存目录下的一个小 JSON 文件里，用 flock 互斥，auto_run.py 并发的各个 main.py 进程看到同一个桶。
+# 桶满时最多允许一分钟的额度突发；取不到令牌的请求按缺口计算等待时间（加一点抖动，避免同时醒来）。
+LLM_RATELIMIT_JITTER = 0.1          # 等待时间上额外随机增加的比例
+LLM_RATELIMIT_UNLIMITED = 1e12      # 不限的一项当作这么大的桶，永远是满的
+
+
+def get_llm_ratelimit_dir():
+    ratelimit_dir = os.path.join(os.environ.get("AUTOSPEC_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "autospec")), "llm", "ratelimit")
+    os.makedirs(ratelimit_dir, exist_ok=True)
+    return ratelimit_dir
+
+
+def _get_bucket_file(bucket_name):
+    return os.path.join(get_llm_ratelimit_dir(), "".join(c if c.isalnum() or c in "-_." else "_" for c in bucket_name) + ".json")
+
+
+# 在文件锁内读出桶、按经过的时间补充令牌，调用 update(state) 修改后写回
+def _update_bucket(bucket_name, requests_per_minute, tokens_per_minute, update):
+    with open(_get_bucket_file(bucket_name), "a+") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            f.seek(0)
+            try:
+                state = json.loads(f.read() or "{}")
+            except ValueError:
+                state = {}
+            now = time.time()
+            elapsed = max(0.0, now - state.get("time", now))
+            # 新桶是满的
+            state["requests"] = min(requests_per_minute, state.get("requests", requests_per_minute) + elapsed * requests_per_minute / 60.0)
+            state["tokens"] = min(tokens_per_minute, state.get("tokens", tokens_per_minute) + elapsed * tokens_per_minute / 60.0)
+            state["time"] = now
+            result = update(state)
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(state))
+            f.flush()
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+    return result
+
+
+# 取一个请求和 tokens 个 token 的令牌，不够时等待；返回等待（被限流）的秒数
+def acquire_llm_rate(bucket_name, requests_per_minute, tokens_per_minute, tokens):
+    if requests_per_minute <= 0 and tokens_per_minute <= 0:
+        return 0.0
+    rpm = requests_per_minute if requests_per_minute > 0 else LLM_RATELIMIT_UNLIMITED
+    tpm = tokens_per_minute if tokens_per_minute > 0 else LLM_RATELIMIT_UNLIMITED
+    # 一次请求比整个桶还大时，等桶满就放行
+    tokens = min(tokens, tpm)
+
+    def take(state):
+        if state["requests"] >= 1 and state["tokens"] >= tokens:
+            state["requests"] -= 1
+            state["tokens"] -= tokens
+            return 0.0
+        wait_requests = (1 - state["requests"]) * 60.0 / rpm if state["requests"] < 1 else 0.0
+        wait_tokens = (tokens - state["tokens"]) * 60.0 / tpm if state["tokens"] < tokens else 0.0
+        return max(wait_requests, wait_tokens)
+
+    throttle_time = 0.0
+    while True:
+        wait_time = _update_bucket(bucket_name, rpm, tpm, take)
+        if wait_time <= 0:
+            if throttle_time > 0:
+                logging.info(f"[RATE] {bucket_name} throttled for {throttle_time:.2f}s")
+            return throttle_time
+        wait_time *= 1 + random.uniform(0, LLM_RATELIMIT_JITTER)
+        time.sleep(wait_time)
+        throttle_time += wait_time
+
+
+# 请求完成后按实际 token 数修正预扣的 token（实际更多时桶会暂时为负，后面的请求多等一会）
+def settle_llm_rate(bucket_name, requests_per_minute, tokens_per_minute, reserved_tokens, used_tokens):
+    if tokens_per_minute <= 0 or used_tokens == reserved_tokens:
+        return
+    rpm = requests_per_minute if requests_per_minute > 0 else LLM_RATELIMIT_UNLIMITED
+
+    def settle(state):
+        state["tokens"] = min(tokens_per_minute, state["tokens"] + min(reserved_tokens, tokens_per_minute) - used_tokens)
+
+    _update_bucket(bucket_name, rpm, tokens_per_minute, settle)
+
+
+# 重试的等待时间：指数退避加完全抖动，平台给了 Retry-After 时至少等这么久
+def get_llm_backoff_time(attempt, retry_after = None, base = 1.0, cap = 60.0):
+    backoff_time = random.uniform(0, min(cap, base * (2 ** attempt)))
+    if retry_after is not None:
+        backoff_time = max(backoff_time, retry_after)
+    return backoff_time
+
+
+def get_llm_ratelimit_stats():
+    stats = {}
+    ratelimit_dir = get_llm_ratelimit_dir()
+    for file_name in sorted(os.listdir(ratelimit_dir)):
+        if file_name.endswith(".json"):
+            try:
+                with open(os.path.join(ratelimit_dir, file_name)) as f:
+                    stats[file_name[:-len(".json")]] = json.loads(f.read() or "{}")
+            except (OSError, ValueError):
+                continue
+    return stats
+
+
+# python3 -m utils.llm_ratelimit [stats|clear]
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "clear":
+        for file_name in os.listdir(get_llm_ratelimit_dir()):
+            os.remove(os.path.join(get_llm_ratelimit_dir(), file_name))
+        print("llm rate limiters cleared:", get_llm_ratelimit_dir())
+    else:
+        print(json.dumps(get_llm_ratelimit_stats(), indent=4))
@@ -0,0 +1,265 @@
+import os, sys
+import time
+import json
+import random
+import hashlib
+import logging
+import argparse
+import threading
+import http.server
+import httpx
+from utils.llm_ledger import num_tokens_from_text, num_tokens_from_messages
+
+# 本地的 OpenAI 兼容 LLM 服务（/v1/chat/completions），用来离线压测整个流水线
+#
+# 回答来自录制的 cassette（JSONL，每行 {"key": 消息列表的 sha256, "contents": [回答, ...]}），
+# 第 i 个回答取 contents[(seed + i) % len(contents)]；cassette 里没有的请求：
+#   - 给了 --upstream 时转发到真实平台，把回答追加到 cassette（录制）
+#   - 否则返回 --fallback-text（默认 loop invariant \true;），或者用 --strict 返回 404
+# 模拟的耗时：首个 token 的延迟服从对数正态分布（中位数 --ttft，--ttft-sigma），生成速度服从正态分布
+# （--tokens-per-second，--tps-sigma）。错误注入：按概率返回 429（带 Retry-After）、500，或者挂起 --hang 秒后断开（超时）。
+# usage 中的 prompt_tokens_details.cached_tokens 模拟平台的前缀缓存：之前请求过的最长消息前缀算作命中。
+#
+#   python3 -m utils.mock_llm_server --port 8765 --cassette ~/.cache/autospec/llm/cassette.jsonl
+#   curl http://127.0.0.1:8765/stats
+MOCK_LLM_PORT = 8765
+MOCK_LLM_FALLBACK_TEXT = "loop invariant \\true;"
+MOCK_LLM_MAX_PREFIXES = 100000      # 记住的消息前缀数，超过时清空
+
+
+def get_messages_key(messages):
+    messages = [{"role": message.get("role"), "content": message.get("content")} for message in messages]
+    return hashlib.sha256(json.dumps(messages, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class MockLLMServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, args):
+        super().__init__(address, MockLLMHandler)
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.lock = threading.Lock()
+        self.cassette = {}
+        self.prefixes = set()
+        self.stats = {"requests": 0, "hit": 0, "miss": 0, "recorded": 0, "fallback": 0, "error_429": 0, "error_500": 0, "timeout": 0,
+                      "prompt_tokens": 0, "cached_prompt_tokens": 0, "completion_tokens": 0}
+        if args.cassette and os.path.exists(args.cassette):
+            with open(args.cassette) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.cassette.setdefault(entry["key"], []).extend(entry["contents"])
+        logging.info(f"[MOCK] {len(self.cassette)} recorded prompts from {args.cassette}")
+
+    def bump(self, name, value = 1):
+        with self.lock:
+            self.stats[name] += value
+
+    # 随机数发生器被多个线程共用
+    def draw(self, name, *params):
+        with self.lock:
+            return getattr(self.random, name)(*params)
+
+    # 之前请求过的最长消息前缀的 token 数
+    def get_cached_prompt_tokens(self, messages, model):
+        keys = [get_messages_key(messages[:k]) for k in range(1, len(messages))]
+        with self.lock:
+            cached = next((k for k in range(len(keys), 0, -1) if keys[k - 1] in self.prefixes), 0)
+            if len(self.prefixes) > MOCK_LLM_MAX_PREFIXES:
+                self.prefixes.clear()
+            self.prefixes.update(keys)
+        return num_tokens_from_messages(messages[:cached], model) - 3 if cached > 0 else 0
+
+    # n 个回答；第二个返回值是 cassette 命中、录制或 fallback，None 表示（--strict）没有回答
+    def get_contents(self, body):
+        key = get_messages_key(body["messages"])
+        n = body.get("n") or 1
+        with self.lock:
+            contents = self.cassette.get(key)
+        if contents:
+            self.bump("hit")
+            source = "hit"
+        elif self.args.upstream:
+            contents = self.record(key, body)
+            self.bump("miss")
+            self.bump("recorded")
+            source = "recorded"
+        elif self.args.strict:
+            self.bump("miss")
+            return None, "miss"
+        else:
+            self.bump("miss")
+            self.bump("fallback")
+            return [self.args.fallback_text] * n, "fallback"
+        seed = body.get("seed") or 0
+        return [contents[(seed + i) % len(contents)] for i in range(n)], source
+
+    # 把 cassette 没有的请求转发到真实平台，回答追加到 cassette
+    def record(self, key, body):
+        api_key = os.environ.get(self.args.upstream_key_env, "")
+        upstream_body = dict(body, stream = False)
+        upstream_body.pop("stream_options", None)
+        response = httpx.post(self.args.upstream.rstrip("/") + "/chat/completions", json=upstream_body,
+                              headers={"Authorization": "Bearer " + api_key}, timeout=600)
+        response.raise_for_status()
+        contents = [choice["message"]["content"] or "" for choice in response.json()["choices"]]
+        with self.lock:
+            self.cassette.setdefault(key, []).extend(contents)
+            if self.args.cassette:
+                with open(self.args.cassette, "a") as f:
+                    f.write(json.dumps({"key": key, "contents": contents}, ensure_ascii=False) + "\n")
+            return list(self.cassette[key])
+
+
+class MockLLMHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logging.debug("[MOCK] " + format % args)
+
+    def send_json(self, status, payload, headers = None):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self.send_json(200, {"object": "list", "data": [{"id": "mock-llm", "object": "model", "owned_by": "autospec"}]})
+        elif self.path.rstrip("/") == "/stats":
+            with self.server.lock:
+                self.send_json(200, dict(self.server.stats, cassette_prompts = len(self.server.cassette)))
+        else:
+            self.send_json(404, {"error": {"message": "not found: " + self.path}})
+
+    def do_POST(self):
+        server = self.server
+        args = server.args
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_json(404, {"error": {"message": "not found: " + self.path}})
+            return
+        server.bump("requests")
+
+        # 错误注入
+        error_draw = server.draw("random")
+        if error_draw < args.error_429:
+            server.bump("error_429")
+            self.send_json(429, {"error": {"message": "Rate limit reached (mock)", "type": "rate_limit_error"}}, {"Retry-After": str(args.retry_after)})
+            return
+        if error_draw < args.error_429 + args.error_500:
+            server.bump("error_500")
+            self.send_json(500, {"error": {"message": "Internal server error (mock)", "type": "server_error"}})
+            return
+        if error_draw < args.error_429 + args.error_500 + args.timeout:
+            server.bump("timeout")
+            time.sleep(args.hang)
+            self.close_connection = True
+            return
+
+        contents, source = server.get_contents(body)
+        if contents is None:
+            self.send_json(404, {"error": {"message": "no recorded response for this prompt (mock --strict)", "type": "invalid_request_error"}})
+            return
+        model = body.get("model", "mock-llm")
+        prompt_tokens = num_tokens_from_messages(body["messages"], model)
+        cached_prompt_tokens = server.get_cached_prompt_tokens(body["messages"], model)
+        completion_tokens = [num_tokens_from_text(content, model) for content in contents]
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": sum(completion_tokens), "total_tokens": prompt_tokens + sum(completion_tokens),
+                 "prompt_tokens_details": {"cached_tokens": cached_prompt_tokens}}
+        server.bump("prompt_tokens", prompt_tokens)
+        server.bump("cached_prompt_tokens", cached_prompt_tokens)
+        server.bump("completion_tokens", sum(completion_tokens))
+
+        # 回放过来的回答按模拟的速度生成，录制的回答已经等过真实平台
+        simulate = source != "recorded"
+        ttft = server.draw("lognormvariate", 0, args.ttft_sigma) * args.ttft if simulate and args.ttft > 0 else 0.0
+        tokens_per_second = max(1.0, server.draw("gauss", args.tokens_per_second, args.tps_sigma)) if simulate else float("inf")
+        response_id = "chatcmpl-mock-" + hashlib.sha256((self.requestline + str(time.time())).encode()).hexdigest()[:16]
+        created = int(time.time())
+        time.sleep(ttft)
+
+        if not body.get("stream"):
+            time.sleep(sum(completion_tokens) / tokens_per_second)
+            self.send_json(200, {
+                "id": response_id, "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": i, "finish_reason": "stop", "message": {"role": "assistant", "content": content}} for i, content in enumerate(contents)],
+                "usage": usage,
+            })
+            return
+
+        # 流式回答（SSE）：每行一个 chunk
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def send_chunk(choices, chunk_usage = None):
+            chunk = {"id": response_id, "object": "chat.completion.chunk", "created": created, "model": model, "choices": choices}
+            if chunk_usage is not None:
+                chunk["usage"] = chunk_usage
+            self.wfile.write(("data: " + json.dumps(chunk, ensure_ascii=False) + "\n\n").encode("utf-8"))
+            self.wfile.flush()
+
+        try:
+            for i, content in enumerate(contents):
+                send_chunk([{"index": i, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}])
+                for piece in content.splitlines(True):
+                    time.sleep(num_tokens_from_text(piece, model) / tokens_per_second)
+                    send_chunk([{"index": i, "delta": {"content": piece}, "finish_reason": None}])
+                send_chunk([{"index": i, "delta": {}, "finish_reason": "stop"}])
+            if (body.get("stream_options") or {}).get("include_usage"):
+                send_chunk([], usage)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端提前停止了生成
+            pass
+
+
+def parse_mock_llm_args(argv = None):
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible mock LLM server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=MOCK_LLM_PORT)
+    parser.add_argument("--cassette", default=os.environ.get("AUTOSPEC_MOCK_LLM_CASSETTE", ""), help="JSONL file of the recorded responses")
+    parser.add_argument("--upstream", default="", help="record: base_url of the real provider asked on a cassette miss")
+    parser.add_argument("--upstream-key-env", default="OPENAI_API_KEY", help="environment variable of the upstream API key")
+    parser.add_argument("--strict", action="store_true", help="answer 404 on a cassette miss instead of the fallback text")
+    parser.add_argument("--fallback-text", default=MOCK_LLM_FALLBACK_TEXT)
+    parser.add_argument("--ttft", type=float, default=0.5, help="median seconds to the first token")
+    parser.add_argument("--ttft-sigma", type=float, default=0.5, help="sigma of the log-normal first token latency")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--tps-sigma", type=float, default=10.0)
+    parser.add_argument("--error-429", type=float, default=0.0, help="probability of a 429 answer")
+    parser.add_argument("--error-500", type=float, default=0.0, help="probability of a 500 answer")
+    parser.add_argument("--timeout", type=float, default=0.0, help="probability of hanging without an answer")
+    parser.add_argument("--hang", type=float, default=30.0, help="seconds a timed out request hangs before the connection is closed")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After of the 429 answers")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the latency and error draws")
+    return parser.parse_args(argv)
+
+
+def serve_mock_llm(args):
+    server = MockLLMServer((args.host, args.port), args)
+    logging.info(f"[MOCK] serving http://{args.host}:{server.server_port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+# python3 -m utils.mock_llm_server [--port 8765] [--cassette FILE] [--upstream URL] ...
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    serve_mock_llm(parse_mock_llm_args())
@@ -1,15 +1,48 @@
 import os, sys, time
 import openai
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import httpx
 from httpx import HTTPTransport
 from typing import List
 from openai import OpenAI
+from openai.types.chat import ChatCompletion
 from LLM4Veri.src.config_manager import ModelConfig
+from utils.llm_client import *
+from utils.llm_cache import *
+from utils.llm_ledger import *
+from utils.llm_ratelimit import *
 
 
-def num_tokens_from_messages(messages, model="qwen-turbo"):
-    return 0
+# 原生支持 n>1 的平台，其它平台用 n_choices 个并发请求（每个请求不同的 seed）代替
+NATIVE_N_PLATFORMS = ["OpenAI"]
+LLM_REQUEST_RETRIES = 5    # 可以在 models_config.yaml 中用 max_retries 覆盖
+# 对话历史（few-shot 前缀之后的问答）的 token 上限，超过时丢掉最早的问答；0 表示不限。可以在 models_config.yaml 中用 max_history_tokens 覆盖
+LLM_HISTORY_MAX_TOKENS = int(os.environ.get("AUTOSPEC_LLM_HISTORY_MAX_TOKENS", "8192"))
+
+
+# 一次回答的 (prompt_tokens, completion_tokens, 是否估算)：优先用平台返回的 usage，没有时用 tiktoken 计算
+def get_response_tokens(response, request_args):
+    if response.usage is not None and response.usage.total_tokens:
+        return response.usage.prompt_tokens, response.usage.completion_tokens, False
+    completion_tokens = sum(num_tokens_from_text(each_choice.message.content, request_args["model"]) for each_choice in response.choices)
+    return num_tokens_from_messages(request_args["messages"], request_args["model"]), completion_tokens, True
+
+
+# prompt tokens 中命中平台前缀缓存的部分：OpenAI / DashScope 在 prompt_tokens_details.cached_tokens，DeepSeek 在 prompt_cache_hit_tokens
+def get_cached_prompt_tokens(usage):
+    if usage is None:
+        return 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", None) if details is not None else None
+    if cached_tokens is None:
+        cached_tokens = (usage.model_extra or {}).get("prompt_cache_hit_tokens")
+    return cached_tokens or 0
+
+
+def log_prompt_cache_usage(prompt_tokens, cached_prompt_tokens):
+    logging.info(f"[LLM] prompt_tokens = {prompt_tokens}, cached = {cached_prompt_tokens}, uncached = {prompt_tokens - cached_prompt_tokens}")
 
 
 def find_best_reply_content(reply_list):
@@ -18,19 +51,24 @@ def find_best_reply_content(reply_list):
 
 class BaseChatClass:
     # [修改点 2] 构造函数现在接收一个 ModelConfig 实例
-    def __init__(self, config: ModelConfig, conversation_list=[], continuous_talking=True) -> None:
+    def __init__(self, config: ModelConfig, conversation_list=None, continuous_talking=True, ledger_tag="") -> None:
         
         self.config = config
+        # 账本中这个对话的 tag（输入文件），按文件统计 token 预算
+        self.ledger_tag = ledger_tag
 
-        # [修改点 3] 实例化局部 client，使用 ModelConfig 中的配置
-        self.client = OpenAI(
-            api_key = config.api_key,
-            base_url = config.base_url,
-        )
+        # 同一个 base_url + key 的所有实例共享一个带连接池的客户端（utils/llm_client.py）
+        # 重试和退避由 request_completion 负责（经过限流器），客户端自己不再重试
+        self.client = get_llm_client_for_config(config).with_options(max_retries=0)
+        # 每个线程当前请求的限流等待时间和预扣的 token 数
+        self.rate_state = threading.local()
         
         # 初始化对话列表，可以加入一个key为system的字典，有助于形成更加个性化的回答
-        self.conversation_list = conversation_list
+        # 传入的列表（few-shot 前缀）复制一份，各个实例的对话互不影响；前缀在每次请求中保持不变，便于命中平台的前缀缓存
+        self.conversation_list = list(conversation_list) if conversation_list is not None else []
+        self.prefix_len = len(self.conversation_list)
         self.continuous_talking = continuous_talking
+        self.max_history_tokens = config.params.get('max_history_tokens', LLM_HISTORY_MAX_TOKENS)
     
     # 打印对话
     def show_conversation(self, msg_list):
@@ -40,9 +78,186 @@ class BaseChatClass:
             else:
                 print(f"\U0001f47D: {msg['content']}\n")
 
+    # 对话历史超过 max_history_tokens 时，从前缀之后最早的问答开始丢弃（一次丢一问一答），前缀和最新的问题总是保留
+    def trim_conversation_history(self):
+        if self.max_history_tokens <= 0:
+            return
+        history_tokens = num_tokens_from_messages(self.conversation_list[self.prefix_len:-1], self.config.model_name)
+        dropped = 0
+        while history_tokens > self.max_history_tokens and len(self.conversation_list) - 1 > self.prefix_len:
+            turn_len = 2 if len(self.conversation_list) - 1 > self.prefix_len + 1 and self.conversation_list[self.prefix_len + 1]['role'] == 'assistant' else 1
+            history_tokens -= num_tokens_from_messages(self.conversation_list[self.prefix_len:self.prefix_len + turn_len], self.config.model_name) - 3
+            del self.conversation_list[self.prefix_len:self.prefix_len + turn_len]
+            dropped += turn_len
+        if dropped > 0:
+            logging.info(f"[LLM] dropped {dropped} history messages, history_tokens = {history_tokens}")
+
+    # (限流器名, 每分钟请求数, 每分钟 token 数)，models_config.yaml 中不写表示不限
+    def get_rate_limits(self):
+        return self.config.template_id or self.config.platform, self.config.params.get('requests_per_minute', 0), self.config.params.get('tokens_per_minute', 0)
+
+    def reset_throttle_time(self):
+        self.rate_state.throttle_time = 0.0
+        self.rate_state.reserved_tokens = 0
+
+    def get_throttle_time(self):
+        return getattr(self.rate_state, "throttle_time", 0.0)
+
+    # 平台是否支持一次请求返回 n 个回答，可以在 models_config.yaml 中用 native_n 覆盖
+    def supports_native_n(self):
+        return self.config.params.get('native_n', self.config.platform in NATIVE_N_PLATFORMS)
+
+    # 一次 chat.completions 请求，经过磁盘缓存（utils/llm_cache.py），失败时重试，并记入账本（utils/llm_ledger.py）
+    def create_completion(self, request_args, n, seed=None):
+        request_args = dict(request_args, n = n)
+        if seed is not None:
+            request_args["seed"] = seed
+        start_time = time.time()
+        self.reset_throttle_time()
+        response, cache_hit = self.create_cached_completion(request_args)
+        prompt_tokens, completion_tokens, estimated = get_response_tokens(response, request_args)
+        cached_prompt_tokens = get_cached_prompt_tokens(response.usage)
+        log_prompt_cache_usage(prompt_tokens, cached_prompt_tokens)
+        throttle_time = self.get_throttle_time()
+        record_llm_call(request_args["model"], self.ledger_tag, (time.time() - start_time - throttle_time) * 1000, prompt_tokens, completion_tokens, n, cache_hit, estimated, cached_prompt_tokens, throttle_time * 1000)
+        return response
+
+    # 返回 (response, 是否命中缓存)
+    def create_cached_completion(self, request_args):
+        cache_mode = get_llm_cache_mode()
+        if cache_mode == "off" or request_args.get("stream"):
+            return self.request_completion(request_args), False
+        cache_key = make_llm_cache_key(request_args)
+        if cache_mode in ("readwrite", "replay"):
+            cached_response = lookup_llm_response(cache_key)
+            if cached_response is not None:
+                return ChatCompletion.model_validate_json(cached_response), True
+            if cache_mode == "replay":
+                raise LLMCacheMissError(f"no cached response of {request_args['model']} for this request (AUTOSPEC_LLM_CACHE=replay)")
+        response = self.request_completion(request_args)
+        store_llm_response(cache_key, request_args["model"], response.model_dump_json(), response.usage.total_tokens if response.usage is not None else 0)
+        return response, False
+
+    # 流式请求 n 个回答（n > 1 只用于原生支持 n 的平台）：每收到某个回答完整的一行调用 on_line(line)，
+    # stop_event 置位后关闭连接（提前停止，丢掉每个回答最后不完整的一行）
+    # 命中缓存时按行回放缓存的回答；只有完整的回答写入缓存。返回 (回答内容列表, prompt + completion tokens)
+    def stream_completion(self, request_args, n, seed, on_line, stop_event):
+        request_args = dict(request_args, n = n, seed = seed, stream = True)
+        start_time = time.time()
+        self.reset_throttle_time()
+        cache_mode = get_llm_cache_mode()
+        cache_key = make_llm_cache_key(request_args)
+        if cache_mode in ("readwrite", "replay"):
+            cached_response = lookup_llm_response(cache_key)
+            if cached_response is not None:
+                response = ChatCompletion.model_validate_json(cached_response)
+                contents = []
+                for each_choice in response.choices:
+                    content_lines = []
+                    for line in (each_choice.message.content or "").split("\n"):
+                        if stop_event.is_set():
+                            break
+                        content_lines.append(line)
+                        on_line(line)
+                    contents.append("\n".join(content_lines))
+                prompt_tokens, completion_tokens, estimated = get_response_tokens(response, request_args)
+                cached_prompt_tokens = get_cached_prompt_tokens(response.usage)
+                log_prompt_cache_usage(prompt_tokens, cached_prompt_tokens)
+                record_llm_call(request_args["model"], self.ledger_tag, (time.time() - start_time) * 1000, prompt_tokens, completion_tokens, n, True, estimated, cached_prompt_tokens)
+                return contents, prompt_tokens + completion_tokens
+            if cache_mode == "replay":
+                raise LLMCacheMissError(f"no cached response of {request_args['model']} for this request (AUTOSPEC_LLM_CACHE=replay)")
+
+        stream = self.request_completion(dict(request_args, stream_options = {"include_usage": True}))
+        # 按 choice.index 分开的各个回答
+        content_lines = {}
+        pending = {}
+        usage = None
+        stopped = False
+        try:
+            for chunk in stream:
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                for each_choice in chunk.choices:
+                    if not each_choice.delta.content:
+                        continue
+                    pending[each_choice.index] = pending.get(each_choice.index, "") + each_choice.delta.content
+                    while "\n" in pending[each_choice.index]:
+                        line, pending[each_choice.index] = pending[each_choice.index].split("\n", 1)
+                        content_lines.setdefault(each_choice.index, []).append(line)
+                        on_line(line)
+                if stop_event.is_set():
+                    stopped = True
+                    break
+        finally:
+            stream.close()
+        if not stopped:
+            for index, line in pending.items():
+                if line != "":
+                    content_lines.setdefault(index, []).append(line)
+                    on_line(line)
+        contents = ["\n".join(content_lines[index]) for index in sorted(content_lines)]
+
+        # 提前停止的流没有 usage，用 tiktoken 计算
+        if usage is not None and usage.total_tokens:
+            prompt_tokens, completion_tokens, estimated = usage.prompt_tokens, usage.completion_tokens, False
+        else:
+            prompt_tokens, completion_tokens, estimated = num_tokens_from_messages(request_args["messages"], request_args["model"]), sum(num_tokens_from_text(content, request_args["model"]) for content in contents), True
+        cached_prompt_tokens = get_cached_prompt_tokens(usage)
+        log_prompt_cache_usage(prompt_tokens, cached_prompt_tokens)
+        throttle_time = self.get_throttle_time()
+        record_llm_call(request_args["model"], self.ledger_tag, (time.time() - start_time - throttle_time) * 1000, prompt_tokens, completion_tokens, n, False, estimated, cached_prompt_tokens, throttle_time * 1000)
+        settle_llm_rate(*self.get_rate_limits(), self.rate_state.reserved_tokens, prompt_tokens + completion_tokens)
+        if cache_mode != "off" and not stopped:
+            response = ChatCompletion.model_validate({
+                "id": "stream", "object": "chat.completion", "created": int(start_time), "model": request_args["model"],
+                "choices": [{"index": index, "finish_reason": "stop", "message": {"role": "assistant", "content": content}} for index, content in enumerate(contents)],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens,
+                          "prompt_tokens_details": {"cached_tokens": cached_prompt_tokens}},
+            })
+            store_llm_response(cache_key, request_args["model"], response.model_dump_json(), prompt_tokens + completion_tokens)
+        return contents, prompt_tokens + completion_tokens
+
+    # 一次网络请求：先从平台的限流器（utils/llm_ratelimit.py）取令牌，429、5xx、超时和连接错误按指数退避加抖动重试；
+    # 限流和退避的等待时间记在 rate_state 中，与 LLM 耗时分开统计
+    def request_completion(self, request_args):
+        bucket_name, requests_per_minute, tokens_per_minute = self.get_rate_limits()
+        reserved_tokens = 0
+        if tokens_per_minute > 0:
+            reserved_tokens = (num_tokens_from_messages(request_args["messages"], request_args["model"]) + get_average_completion_tokens()) * request_args.get("n", 1)
+        self.rate_state.reserved_tokens = reserved_tokens
+        max_retries = self.config.params.get('max_retries', LLM_REQUEST_RETRIES)
+        for i in range(max_retries + 1):
+            self.rate_state.throttle_time = self.get_throttle_time() + acquire_llm_rate(bucket_name, requests_per_minute, tokens_per_minute, reserved_tokens)
+            try:
+                response = self.client.chat.completions.create(**request_args)
+            except Exception as e:
+                # 失败的请求没有生成 token，退还这次预扣的 token，重试时重新预扣
+                settle_llm_rate(bucket_name, requests_per_minute, tokens_per_minute, reserved_tokens, 0)
+                if not isinstance(e, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)) or i == max_retries:
+                    raise
+                retry_after = None
+                if isinstance(e, openai.APIStatusError):
+                    try:
+                        retry_after = float(e.response.headers.get("retry-after"))
+                    except (TypeError, ValueError):
+                        pass
+                backoff_time = get_llm_backoff_time(i, retry_after)
+                logging.warning(f"LLM request failed ({e}), retrying in {backoff_time:.1f}s ...")
+                time.sleep(backoff_time)
+                self.rate_state.throttle_time += backoff_time
+                continue
+            # 流式请求在读完后修正
+            if not request_args.get("stream") and response.usage is not None:
+                settle_llm_rate(bucket_name, requests_per_minute, tokens_per_minute, reserved_tokens, response.usage.total_tokens)
+            return response
+
     # 提示chatgpt
     # [修改点 4] 移除 model 参数，使用 config 中的 model_name
-    def get_respone(self, prompt, maxTokens=None, temperature_arg=None, stream_out=False, stop_str=None, n_choices=1):
+    # stream_out: 流式请求（支持 n 的平台一次请求 n 个回答，其它平台每个回答单独请求），每收到完整的一行调用 on_line(line)（在请求线程中），
+    # 所有回答里不同的子句（以 ; 结尾的行）达到 max_clauses 个时停止生成（0 表示不限）
+    # query_index: 这次查询在整个流程中的序号（例如轮次和任务），决定 seed
+    def get_respone(self, prompt, maxTokens=None, temperature_arg=None, stream_out=False, stop_str=None, n_choices=1, on_line=None, max_clauses=0, query_index=0):
         
         # [新增点] 从 config 或传入参数中确定实际使用的参数值
         used_model = self.config.model_name
@@ -54,38 +269,86 @@ class BaseChatClass:
         
         # 下面这一步是把用户的问题也添加到对话列表中，这样下一次问问题的时候就能形成上下文了
         self.conversation_list.append({"role":"user", "content":prompt})
+        self.trim_conversation_history()
         
-        for i in range(3):
-                # [修改点 5] 使用 self.client 和从 config 获取的参数
-                response = self.client.chat.completions.create(
-                    model = used_model,
-                    messages = self.conversation_list,
-                    max_tokens = used_maxTokens,
-                    temperature = used_temperature,
-                    timeout = used_timeout, # 增加 timeout 参数
-                    frequency_penalty = 0,
-                    presence_penalty = 0,
-                    top_p = 1,
-                    stream = stream_out,
-                    stop = stop_str,
-                    n = 1,
-                )
-                break
+        request_args = {
+            "model": used_model,
+            "messages": self.conversation_list,
+            "max_tokens": used_maxTokens,
+            "temperature": used_temperature,
+            "timeout": used_timeout, # 增加 timeout 参数
+            "frequency_penalty": 0,
+            "presence_penalty": 0,
+            "top_p": 1,
+            "stream": stream_out,
+            "stop": stop_str,
+        }
+        # 第 query_index 次查询的回答用 seed + query_index * n_choices + i：重新运行时同一次查询的请求相同，可以命中缓存
+        # （replay 能复现录制的运行），不同轮次的相同问题 seed 不同，得到不同的回答，也不会互相覆盖缓存
+        base_seed = self.config.params.get('seed', 0) + query_index * n_choices
+
+        # token 预算（utils/llm_ledger.py）不够时减少回答数，一个回答都不够时不再查询
+        budgeted_n_choices = get_budgeted_n_choices(n_choices, num_tokens_from_messages(self.conversation_list, used_model), self.ledger_tag)
+        if budgeted_n_choices <= 0:
+            self.conversation_list.pop()
+            raise LLMBudgetExceededError(f"token budget of {self.ledger_tag or used_model} exhausted ({format_llm_ledger_totals(self.ledger_tag)})")
+        if budgeted_n_choices < n_choices:
+            logging.info(f"[BUDGET] {n_choices} -> {budgeted_n_choices} choices within the token budget")
+            n_choices = budgeted_n_choices
+
         logging.info("LLM querying ...\n")
         full_reply_content_list = []
+        tokens_usage = 0
 
         # use stream of chunks
         if stream_out:
-            pass 
+            clause_set = set()
+            clause_lock = threading.Lock()
+            stop_event = threading.Event()
+            def on_stream_line(line):
+                if on_line is not None:
+                    on_line(line)
+                clause = line.strip()
+                if max_clauses > 0 and clause.endswith(";") and not clause.startswith("//"):
+                    with clause_lock:
+                        clause_set.add(clause)
+                        if len(clause_set) >= max_clauses and not stop_event.is_set():
+                            logging.info(f"[STREAM] {len(clause_set)} distinct clauses, stopping the generation")
+                            stop_event.set()
+            stream_results = []
+            if n_choices > 1 and self.supports_native_n():
+                stream_results.append(self.stream_completion(request_args, n_choices, base_seed, on_stream_line, stop_event))
+            # 平台不支持 n（或返回的回答不够）时，剩下的回答各自并发流式请求
+            missing_choices = n_choices - sum(len(reply_contents) for reply_contents, _ in stream_results)
+            if missing_choices > 0 and not stop_event.is_set():
+                with ThreadPoolExecutor(max_workers=missing_choices) as executor:
+                    stream_results.extend(executor.map(lambda i: self.stream_completion(request_args, 1, base_seed + i, on_stream_line, stop_event), range(missing_choices)))
+            for reply_contents, one_tokens_usage in stream_results:
+                for one_reply_content in reply_contents:
+                    full_reply_content_list.append(one_reply_content)
+                    logging.info(f"\U0001f47D: {one_reply_content}\n")
+                tokens_usage += one_tokens_usage
+            full_reply_content_list = full_reply_content_list[:n_choices]
         # don't use stream of chunks
         else:
-            # get the reply content
-            for each_choice in response.choices:
-                one_reply_content = each_choice.message.content
-                full_reply_content_list.append(one_reply_content)
-                logging.info(f"\U0001f47D: {one_reply_content}\n")
-            #get the useage of the API
-            tokens_usage = response.usage.completion_tokens
+            responses = []
+            if n_choices > 1 and self.supports_native_n():
+                responses.append(self.create_completion(request_args, n_choices, base_seed))
+            # 平台不支持 n（或返回的 choices 不够）时，剩下的回答并发请求，总耗时接近单次请求
+            missing_choices = n_choices - sum(len(response.choices) for response in responses)
+            if missing_choices > 0:
+                with ThreadPoolExecutor(max_workers=missing_choices) as executor:
+                    responses.extend(executor.map(lambda i: self.create_completion(request_args, 1, base_seed + i), range(missing_choices)))
+            for response in responses:
+                # get the reply content
+                for each_choice in response.choices:
+                    one_reply_content = each_choice.message.content
+                    full_reply_content_list.append(one_reply_content)
+                    logging.info(f"\U0001f47D: {one_reply_content}\n")
+                #get the useage of the API（prompt + completion）
+                prompt_tokens, completion_tokens, _ = get_response_tokens(response, request_args)
+                tokens_usage += prompt_tokens + completion_tokens
+            full_reply_content_list = full_reply_content_list[:n_choices]
             
         # find the best reply
         best_reply_content = find_best_reply_content(full_reply_content_list)